@@ -1,7 +1,9 @@
 # backend/main.py
 
 import os
-from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
+import time
+from typing import Optional
+from fastapi import FastAPI, Request, Response, HTTPException, BackgroundTasks, Query, Depends, Header
 from dotenv import load_dotenv
 import logging
 import hmac
@@ -10,7 +12,8 @@ import hashlib
 # Assuming worker tasks are defined relative to the project root or PYTHONPATH is set
 # This might need adjustment based on actual project structure/deployment
 try:
-    from worker.tasks import analyze_pull_request
+    from worker.tasks import analyze_pull_request, scan_repository_baseline
+    from worker.coalescing import claim_delivery, release_delivery, schedule_coalesced_analysis
 except ImportError:
     # Fallback for different structure if needed
     # This indicates a potential issue with how modules are discovered
@@ -19,12 +22,45 @@ except ImportError:
     class PlaceholderTask:
         def delay(self, *args, **kwargs):
             logging.warning("analyze_pull_request task not imported, using placeholder delay.")
-    analyze_pull_request = PlaceholderTask()
+    analyze_pull_request = scan_repository_baseline = PlaceholderTask()
+
+    # Without the worker package there is no shared Redis state to coalesce or dedupe against
+    def claim_delivery(delivery_id):
+        return True
+
+    def release_delivery(delivery_id):
+        pass
+
+    def schedule_coalesced_analysis(task, task_data):
+        return task.delay(task_data)
+
+try:
+    from worker.metrics import record_webhook, render_metrics
+except ImportError:
+    record_webhook = render_metrics = None
+
+try:
+    from worker.findings_store import get_findings_store
+except ImportError:
+    get_findings_store = None
+
+from webhook_ingest import (
+    ANALYZED_PR_ACTIONS,
+    HANDLED_EVENTS,
+    InvalidPayload,
+    decode_payload,
+    extract_baseline_repositories,
+    extract_pull_request_fields,
+    should_decode,
+)
 
 
 # Load environment variables from .env file for local development
 load_dotenv()
 
+# Full-repository scan of every repository the App is installed on (see worker/baseline_scan.py)
+BASELINE_SCAN_ENABLED = os.getenv("BASELINE_SCAN_ENABLED", "true").lower() in ("1", "true", "yes")
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -64,88 +100,218 @@ async def health_check():
     logger.info("Health check endpoint called.")
     return {"status": "ok"}
 
+@app.get("/metrics", tags=["Status"])
+async def metrics():
+    """Prometheus metrics of this process (webhook counts and latency)."""
+    if render_metrics is None:
+        raise HTTPException(status_code=503, detail="Metrics unavailable")
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+# --- Scan History API ---
+# Plain (sync) handlers: FastAPI runs them in its threadpool, so queries never block the event loop.
+# Pages are newest first; pass the returned next_cursor back as `cursor` for the next page.
+# Until the frontend has user auth (see the OAuth TODO below), callers present an API key
+# (Authorization: Bearer <key>) scoped to installations via HISTORY_API_KEYS, formatted
+# "<key>=<installation_id>[,<installation_id>...];<key>=...". Without keys the routes are off.
+
+def _parse_history_api_keys(value: str) -> dict:
+    """Maps the SHA-256 of each key to the installation ids it may read."""
+    keys = {}
+    for entry in filter(None, (part.strip() for part in value.split(";"))):
+        key, _, installations = entry.partition("=")
+        ids = frozenset(int(i) for i in installations.split(",") if i.strip())
+        if key.strip() and ids:
+            keys[hashlib.sha256(key.strip().encode("utf-8")).hexdigest()] = ids
+    return keys
+
+HISTORY_API_KEYS = _parse_history_api_keys(os.getenv("HISTORY_API_KEYS", ""))
+
+def history_installations(authorization: Optional[str] = Header(None)) -> frozenset:
+    """The installations the caller's API key may read; 404 while the API is off, 401 without a valid key."""
+    if not HISTORY_API_KEYS:
+        raise HTTPException(status_code=404, detail="Not Found")
+    scheme, _, key = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not key:
+        raise HTTPException(status_code=401, detail="Missing API key", headers={"WWW-Authenticate": "Bearer"})
+    digest = hashlib.sha256(key.strip().encode("utf-8")).hexdigest()
+    # Constant-time comparison against every configured key
+    allowed = None
+    for candidate, installations in HISTORY_API_KEYS.items():
+        if hmac.compare_digest(candidate, digest):
+            allowed = installations
+    if allowed is None:
+        raise HTTPException(status_code=401, detail="Invalid API key", headers={"WWW-Authenticate": "Bearer"})
+    return allowed
+
+def _scoped_installation(installation_id: Optional[int], allowed: frozenset) -> int:
+    """Every query is pinned to one installation the caller may read."""
+    if installation_id is None:
+        if len(allowed) != 1:
+            raise HTTPException(status_code=400, detail="installation_id is required for keys scoped to several installations")
+        return next(iter(allowed))
+    if installation_id not in allowed:
+        raise HTTPException(status_code=403, detail="Not allowed for this installation")
+    return installation_id
+
+def _findings_store():
+    if get_findings_store is None:
+        raise HTTPException(status_code=503, detail="Findings store unavailable")
+    try:
+        return get_findings_store()
+    except Exception as e:
+        logger.error(f"Findings store unavailable: {e}")
+        raise HTTPException(status_code=503, detail="Findings store unavailable")
+
+@app.get("/api/scans", tags=["History"])
+def list_scans(
+    installation_id: Optional[int] = None,
+    repo: Optional[str] = None,
+    pr_number: Optional[int] = None,
+    head_sha: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[int] = None,
+    allowed: frozenset = Depends(history_installations),
+):
+    """Scan history of one installation, filtered by repository ("owner/name"), PR and/or head SHA."""
+    return _findings_store().list_scans(
+        limit=limit, cursor=cursor, installation_id=_scoped_installation(installation_id, allowed),
+        repo_full_name=repo, pr_number=pr_number, head_sha=head_sha,
+    )
+
+@app.get("/api/findings", tags=["History"])
+def list_findings(
+    installation_id: Optional[int] = None,
+    repo: Optional[str] = None,
+    pr_number: Optional[int] = None,
+    head_sha: Optional[str] = None,
+    scan_id: Optional[int] = None,
+    fingerprint: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[int] = None,
+    allowed: frozenset = Depends(history_installations),
+):
+    """Recorded findings of one installation; filtering by fingerprint gives the history of one finding across heads."""
+    return _findings_store().list_findings(
+        limit=limit, cursor=cursor, installation_id=_scoped_installation(installation_id, allowed),
+        repo_full_name=repo, pr_number=pr_number, head_sha=head_sha, scan_id=scan_id, fingerprint=fingerprint,
+    )
+
+def enqueue_analysis(task_data: dict):
+    """Enqueues the analysis task; runs as a background task after the webhook response is sent.
+
+    Redeliveries of the same X-GitHub-Delivery are dropped, and rapid pushes to one PR are
+    coalesced so only the newest head SHA gets analyzed.
+    """
+    delivery_id = task_data.get("delivery_id")
+    if not claim_delivery(delivery_id):
+        logger.info(f"Ignoring redelivery {delivery_id} for {task_data['repo_full_name']}# {task_data['pr_number']}")
+        return
+    try:
+        schedule_coalesced_analysis(analyze_pull_request, task_data)
+        logger.info(f"Enqueued analysis task for {task_data['repo_full_name']}# {task_data['pr_number']}")
+    except Exception as e:
+        # The response has already gone out, so GitHub will not redeliver; the delivery ID lets us replay it
+        release_delivery(delivery_id)
+        logger.error(f"Failed to enqueue Celery task for delivery {delivery_id}: {e}", exc_info=True)
+
+def enqueue_baseline_scans(installation_id: int, repositories: list, delivery_id: str):
+    """Enqueues one baseline scan per added repository (background task, like enqueue_analysis)."""
+    if not claim_delivery(delivery_id):
+        logger.info(f"Ignoring redelivery {delivery_id} of installation {installation_id}")
+        return
+    try:
+        for repo_full_name in repositories:
+            scan_repository_baseline.delay(installation_id, repo_full_name)
+        logger.info(f"Enqueued baseline scans of {len(repositories)} repositories for installation {installation_id}")
+    except Exception as e:
+        # Scans already enqueued for this delivery resume rather than restart if it is replayed
+        release_delivery(delivery_id)
+        logger.error(f"Failed to enqueue baseline scans for delivery {delivery_id}: {e}", exc_info=True)
+
 @app.post("/webhook/github", tags=["GitHub"])
 async def github_webhook(request: Request, background_tasks: BackgroundTasks):
-    """Handles incoming GitHub webhooks (e.g., pull_request events)."""
+    """Handles incoming GitHub webhooks, recording their count and latency by event and outcome."""
+    started = time.perf_counter()
+    status = "error"
+    try:
+        result = await handle_github_webhook(request, background_tasks)
+        status = result.get("status", "ok")
+        return result
+    except HTTPException as e:
+        status = str(e.status_code)
+        raise
+    finally:
+        if record_webhook is not None:
+            # The header is caller-controlled (and unverified on 403s); unknown events share one label
+            event_type = request.headers.get("X-GitHub-Event")
+            event_label = event_type if event_type in HANDLED_EVENTS else "other"
+            record_webhook(event_label, status, time.perf_counter() - started)
+
+async def handle_github_webhook(request: Request, background_tasks: BackgroundTasks):
+    """Handles incoming GitHub webhooks (e.g., pull_request events).
+
+    The raw body is read once, verified, and only decoded when the event (and, for
+    pull_request, the action peeked from the first bytes) is one we act on.
+    """
     payload_bytes = await request.body()
     signature = request.headers.get("X-Hub-Signature-256")
 
-    # --- Signature Verification ---
-    # Uncomment in production after setting GITHUB_WEBHOOK_SECRET
-    # if not verify_github_signature(payload_bytes, signature):
-    #     logger.error("Webhook signature verification failed.")
-    #     raise HTTPException(status_code=403, detail="Invalid signature")
-    # logger.info("Webhook signature verified successfully.")
+    # --- Signature Verification (on the raw bytes, before any parsing) ---
+    if not verify_github_signature(payload_bytes, signature):
+        logger.error("Webhook signature verification failed.")
+        raise HTTPException(status_code=403, detail="Invalid signature")
     # -----------------------------
 
-    try:
-        payload = await request.json() # Parse JSON after reading body for signature check
-    except Exception as e:
-        logger.error(f"Failed to parse webhook JSON payload: {e}")
-        raise HTTPException(status_code=400, detail="Invalid JSON payload")
-
     event_type = request.headers.get("X-GitHub-Event")
     delivery_id = request.headers.get("X-GitHub-Delivery")
     logger.info(f"Received GitHub webhook event: {event_type}, Delivery ID: {delivery_id}")
 
-    if event_type == "pull_request":
-        action = payload.get("action")
-        pr = payload.get("pull_request", {})
-        repo = payload.get("repository", {})
-        installation_id = payload.get("installation", {}).get("id")
+    if event_type == "ping":
+        logger.info("Received ping event from GitHub.")
+        return {"status": "pong"}
+    if not should_decode(event_type, payload_bytes):
+        logger.info(f"Ignoring GitHub event {event_type} without decoding the payload.")
+        return {"status": "ignored"}
 
-        if action in ["opened", "synchronize", "reopened"]:
-            pr_number = pr.get("number")
-            repo_full_name = repo.get("full_name")
-            pr_head_sha = pr.get("head", {}).get("sha")
+    try:
+        payload = decode_payload(payload_bytes)
+    except InvalidPayload as e:
+        logger.error(f"Failed to parse webhook JSON payload: {e}")
+        raise HTTPException(status_code=400, detail="Invalid JSON payload")
+
+    if event_type == "pull_request":
+        fields = extract_pull_request_fields(payload)
+        action = fields["action"]
 
-            if not all([pr_number, repo_full_name, installation_id, pr_head_sha]):
+        if action in ANALYZED_PR_ACTIONS:
+            if not all([fields["pr_number"], fields["repo_full_name"], fields["installation_id"], fields["pr_head_sha"]]):
                 logger.warning("Missing required information in pull_request payload.")
                 return {"status": "ignored", "reason": "Missing data"}
 
-            logger.info(f"Processing pull_request event (action: {action}) for {repo_full_name}# {pr_number}")
-            
+            logger.info(f"Processing pull_request event (action: {action}) for {fields['repo_full_name']}# {fields['pr_number']}")
+
             # Prepare data for the Celery task
             task_data = {
                 "event_type": event_type,
-                "action": action,
-                "repo_full_name": repo_full_name,
-                "pr_number": pr_number,
-                "pr_head_sha": pr_head_sha,
-                "installation_id": installation_id,
+                **fields,
                 "delivery_id": delivery_id # For tracing
             }
 
-            # Enqueue job for AI analysis using Celery
-            # Using background_tasks.add_task for FastAPI integration, 
-            # but direct .delay() call is standard Celery practice.
-            # Choose one method based on deployment strategy.
-            try:
-                analyze_pull_request.delay(task_data)
-                logger.info(f"Enqueued analysis task for {repo_full_name}# {pr_number}")
-            except Exception as e:
-                logger.error(f"Failed to enqueue Celery task: {e}", exc_info=True)
-                # Depending on the error, might need specific handling
-                raise HTTPException(status_code=500, detail="Failed to enqueue analysis task")
+            # Enqueue after the response is sent so broker latency never delays GitHub's delivery
+            background_tasks.add_task(enqueue_analysis, task_data)
 
         else:
             logger.info(f"Ignoring pull_request action: {action}")
 
-    elif event_type == "installation":
-        action = payload.get("action")
-        logger.info(f"Processing installation event (action: {action})")
-        # TODO: Handle app installation/uninstallation logic (e.g., update DB)
-        pass
-    elif event_type == "installation_repositories":
+    elif event_type in ("installation", "installation_repositories"):
         action = payload.get("action")
-        logger.info(f"Processing installation_repositories event (action: {action})")
-        # TODO: Handle repositories being added/removed from installation
-        pass
-    elif event_type == "ping":
-        logger.info("Received ping event from GitHub.")
-        return {"status": "pong"}
-    else:
-        logger.info(f"Ignoring unhandled GitHub event type: {event_type}")
+        logger.info(f"Processing {event_type} event (action: {action})")
+        # TODO: Handle uninstallation and removed repositories (e.g., update DB)
+        repositories = extract_baseline_repositories(event_type, payload)
+        installation_id = (payload.get("installation") or {}).get("id")
+        if BASELINE_SCAN_ENABLED and repositories and installation_id:
+            background_tasks.add_task(enqueue_baseline_scans, installation_id, repositories, delivery_id)
 
     return {"status": "received"}
 
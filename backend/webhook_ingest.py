@@ -0,0 +1,72 @@
+# backend/webhook_ingest.py
+
+import re
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# orjson decodes large payloads several times faster than the stdlib; it is optional
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# Events we do anything with; everything else is acknowledged without decoding the body
+HANDLED_EVENTS = {"pull_request", "installation", "installation_repositories", "ping"}
+ANALYZED_PR_ACTIONS = {"opened", "synchronize", "reopened"}
+# Actions that give the App new repositories, each of which gets a baseline scan
+BASELINE_ACTIONS = {"installation": "created", "installation_repositories": "added"}
+
+# GitHub serializes "action" as the first key, so it can be read without decoding the whole payload
+_ACTION_RE = re.compile(rb'"action"\s*:\s*"([A-Za-z_]+)"')
+_ACTION_PEEK_BYTES = 256
+
+class InvalidPayload(ValueError):
+    pass
+
+def peek_action(payload_bytes: bytes):
+    """Returns the payload's "action" from its first few bytes, or None if it is not there."""
+    match = _ACTION_RE.search(payload_bytes, 0, _ACTION_PEEK_BYTES)
+    return match.group(1).decode("ascii") if match else None
+
+def should_decode(event_type: str, payload_bytes: bytes) -> bool:
+    """Decides from headers and a byte peek alone whether the payload is worth decoding."""
+    if event_type not in HANDLED_EVENTS or event_type == "ping":
+        return False
+    if event_type == "pull_request":
+        action = peek_action(payload_bytes)
+        # Only skip when we are sure; fall back to decoding if the peek found nothing
+        return action is None or action in ANALYZED_PR_ACTIONS
+    return True
+
+def decode_payload(payload_bytes: bytes) -> dict:
+    try:
+        payload = _json_loads(payload_bytes)
+    except ValueError as e:  # orjson.JSONDecodeError and json.JSONDecodeError both subclass ValueError
+        raise InvalidPayload(str(e)) from e
+    if not isinstance(payload, dict):
+        raise InvalidPayload("Webhook payload is not a JSON object")
+    return payload
+
+def extract_pull_request_fields(payload: dict) -> dict:
+    """Pulls out only the fields the analysis task needs from a pull_request payload."""
+    pr = payload.get("pull_request") or {}
+    return {
+        "action": payload.get("action"),
+        "repo_full_name": (payload.get("repository") or {}).get("full_name"),
+        "pr_number": pr.get("number"),
+        "pr_head_sha": (pr.get("head") or {}).get("sha"),
+        "installation_id": (payload.get("installation") or {}).get("id"),
+        # PR size picks the priority lane
+        "additions": pr.get("additions"),
+        "deletions": pr.get("deletions"),
+    }
+
+def extract_baseline_repositories(event_type: str, payload: dict) -> list:
+    """Full names of the repositories an installation/installation_repositories event added ([] otherwise)."""
+    if payload.get("action") != BASELINE_ACTIONS.get(event_type):
+        return []
+    key = "repositories" if event_type == "installation" else "repositories_added"
+    return [repo["full_name"] for repo in payload.get(key) or () if repo.get("full_name")]
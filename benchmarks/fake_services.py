@@ -0,0 +1,359 @@
+# benchmarks/fake_services.py
+"""Local HTTP stand-ins for the GitHub REST API and the OpenAI chat completions API.
+
+Both servers run on 127.0.0.1 in background threads and inject configurable latency,
+server errors and rate limiting, so the real worker clients (requests, httpx, the
+OpenAI SDK) can be benchmarked without network access or credentials:
+    GITHUB_API_BASE_URL=<github.url>  OPENAI_BASE_URL=<openai.url>/v1
+
+Also provides synthetic_diff(), the diff generator used for the fake pull requests.
+"""
+
+import re
+import json
+import time
+import random
+import threading
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# --- Synthetic Diffs ---
+
+# Pull request size classes: (Python files, added lines per file)
+PR_SIZES = {
+    "small": (1, 20),
+    "medium": (8, 150),
+    "large": (40, 500),
+    "huge": (150, 2000),
+}
+
+_BENIGN_LINES = (
+    "    total = sum(item.price for item in items)",
+    "    logger.info(\"processed %d items\", len(items))",
+    "    if not items:",
+    "        return None",
+    "    result = {\"id\": record.id, \"name\": record.name}",
+    "    values = [normalize(v) for v in values]",
+    "    return result",
+)
+_RISKY_LINES = (
+    "    os.system(\"convert \" + request.args[\"file\"])",
+    "    cursor.execute(\"SELECT * FROM users WHERE name = '%s'\" % name)",
+    "    data = pickle.loads(request.data)",
+    "    digest = hashlib.md5(password.encode()).hexdigest()",
+)
+
+def synthetic_diff(size, seed=0, risky_ratio=0.02):
+    """Builds a unified diff for a PR of the given size class, with some risky lines mixed in.
+
+    "huge" PRs also carry a vendored file and a minified bundle, as generated-code PRs do.
+    """
+    files, lines_per_file = PR_SIZES[size]
+    rng = random.Random(seed)
+    parts = []
+    for index in range(files):
+        path = f"app/module_{seed}_{index}.py"
+        body = ["import os", "", f"def handler_{index}(request, items, cursor, name, password, values, record):"]
+        for _ in range(lines_per_file - len(body)):
+            body.append(rng.choice(_RISKY_LINES) if rng.random() < risky_ratio else rng.choice(_BENIGN_LINES))
+        parts.append(_added_file(path, body))
+    if size == "huge":
+        parts.append(_added_file("vendor/requests/api.py", [rng.choice(_BENIGN_LINES) for _ in range(2000)]))
+        parts.append(_added_file("static/app.min.js", ["var a=" + "1+" * 5000 + "1;"]))
+    return "".join(parts)
+
+def _added_file(path, lines):
+    header = (
+        f"diff --git a/{path} b/{path}\nnew file mode 100644\nindex 0000000..1111111\n"
+        f"--- /dev/null\n+++ b/{path}\n@@ -0,0 +1,{len(lines)} @@\n"
+    )
+    return header + "".join(f"+{line}\n" for line in lines)
+
+def diff_line_counts(size):
+    files, lines_per_file = PR_SIZES[size]
+    return files * lines_per_file
+
+# --- Fault Injection ---
+
+class ServiceBehavior:
+    """Latency and fault injection shared by both fake services."""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit_rate=0.0, retry_after=1.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def delay(self, extra=0.0):
+        with self.lock:
+            jitter = self.rng.uniform(0, self.jitter) if self.jitter else 0.0
+        time.sleep(self.latency + jitter + extra)
+
+    def fault(self):
+        """Returns "rate_limit", "error" or None for the next request."""
+        with self.lock:
+            roll = self.rng.random()
+        if roll < self.rate_limit_rate:
+            return "rate_limit"
+        if roll < self.rate_limit_rate + self.error_rate:
+            return "error"
+        return None
+
+class _FakeServer:
+    handler_class = None
+
+    def __init__(self, behavior=None):
+        self.behavior = behavior or ServiceBehavior()
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self.handler_class)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name=type(self).__name__, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, key, amount=1):
+        with self.stats_lock:
+            self.stats[key] = self.stats.get(key, 0) + amount
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like the real APIs
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def respond(self, status, body=b"", content_type="application/json", headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode("utf-8")
+        elif isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+# --- GitHub ---
+
+class _GitHubHandler(_Handler):
+    TOKEN_RE = re.compile(r"^/app/installations/(\d+)/access_tokens$")
+    PULL_RE = re.compile(r"^/repos/[^/]+/[^/]+/pulls/(\d+)$")
+    REVIEW_RE = re.compile(r"^/repos/[^/]+/[^/]+/pulls/(\d+)/reviews$")
+    COMMENTS_RE = re.compile(r"^/repos/[^/]+/[^/]+/pulls/(\d+)/comments$")
+    COMPARE_RE = re.compile(r"^/repos/[^/]+/[^/]+/compare/")
+
+    def rate_headers(self):
+        return {"X-RateLimit-Remaining": "4999", "X-RateLimit-Reset": str(int(time.time()) + 3600)}
+
+    def injected_fault(self):
+        fault = self.fake.behavior.fault()
+        if fault == "rate_limit":
+            self.fake.count("rate_limited")
+            self.respond(403, {"message": "You have exceeded a secondary rate limit."},
+                         headers={"Retry-After": str(self.fake.behavior.retry_after)})
+            return True
+        if fault == "error":
+            self.fake.count("errors")
+            self.respond(502, {"message": "Server Error"})
+            return True
+        return False
+
+    def do_GET(self):
+        self.fake.count("requests")
+        self.fake.behavior.delay()
+        path = self.path.split("?", 1)[0]
+        if self.injected_fault():
+            return
+        if self.COMPARE_RE.match(path):
+            self.respond(404, {"message": "Not Found"}, headers=self.rate_headers())  # Forces full-PR analyses
+            return
+        listing = self.REVIEW_RE.match(path) or self.COMMENTS_RE.match(path)
+        if listing:
+            # Everything posted so far, on one page, so re-runs can dedupe against it
+            kind = "reviews" if self.REVIEW_RE.match(path) else "comments"
+            self.respond(200, self.fake.posted(int(listing.group(1)), kind), headers=self.rate_headers())
+            return
+        match = self.PULL_RE.match(path)
+        if match and "diff" in (self.headers.get("Accept") or ""):
+            diff = self.fake.diff_for(int(match.group(1)))
+            self.fake.count("diff_bytes", len(diff))
+            self.respond(200, diff, content_type="text/plain; charset=utf-8", headers=self.rate_headers())
+            return
+        if match:
+            self.respond(200, {"number": int(match.group(1))}, headers=self.rate_headers())
+            return
+        self.respond(404, {"message": "Not Found"})
+
+    def do_POST(self):
+        self.fake.count("requests")
+        body = self.read_body()
+        self.fake.behavior.delay()
+        path = self.path.split("?", 1)[0]
+        if self.injected_fault():
+            return
+        if self.TOKEN_RE.match(path):
+            self.fake.count("token_exchanges")
+            expires_at = (datetime.now(timezone.utc) + timedelta(hours=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
+            self.respond(201, {"token": f"ghs_fake_{self.TOKEN_RE.match(path).group(1)}", "expires_at": expires_at})
+            return
+        if self.REVIEW_RE.match(path):
+            review = json.loads(body or b"{}")
+            self.fake.count("reviews")
+            self.fake.count("review_comments", len(review.get("comments") or []))
+            self.fake.record_review(int(self.REVIEW_RE.match(path).group(1)), review)
+            self.respond(200, {"id": int(time.time() * 1000)}, headers=self.rate_headers())
+            return
+        self.respond(404, {"message": "Not Found"})
+
+class FakeGitHubServer(_FakeServer):
+    """Serves installation tokens, PR diffs (via diff_source(pr_number)), review creation and listing."""
+    handler_class = _GitHubHandler
+    APP_SLUG = "codeguardian-benchmark"  # Reviews are listed as posted by "<slug>[bot]"
+
+    def __init__(self, behavior=None, diff_source=None):
+        self.diff_source = diff_source or (lambda pr_number: synthetic_diff("small", seed=pr_number))
+        self.diffs = {}
+        self.diffs_lock = threading.Lock()
+        self.reviews = {}  # pr_number -> {"reviews": [...], "comments": [...]}
+        super().__init__(behavior)
+
+    def record_review(self, pr_number, review):
+        with self.diffs_lock:
+            posted = self.reviews.setdefault(pr_number, {"reviews": [], "comments": []})
+            user = {"login": f"{self.APP_SLUG}[bot]", "type": "Bot"}
+            posted["reviews"].append({"id": len(posted["reviews"]) + 1, "body": review.get("body"), "user": user})
+            for comment in review.get("comments") or []:
+                posted["comments"].append(dict(comment, id=len(posted["comments"]) + 1, user=user))
+
+    def posted(self, pr_number, kind):
+        with self.diffs_lock:
+            return list(self.reviews.get(pr_number, {}).get(kind, []))
+
+    def diff_for(self, pr_number):
+        with self.diffs_lock:
+            if pr_number not in self.diffs:
+                self.diffs[pr_number] = self.diff_source(pr_number).encode("utf-8")
+            return self.diffs[pr_number]
+
+# --- OpenAI ---
+
+class _OpenAIHandler(_Handler):
+    FILE_RE = re.compile(r"^\+\+\+ b/(\S+)$", re.MULTILINE)
+    TRIAGE_HUNK_RE = re.compile(r"^Hunk (\d+) \(", re.MULTILINE)
+    RISKY_RE = re.compile(r"os\.system|\.execute\(|pickle\.loads|hashlib\.md5")
+
+    def do_POST(self):
+        self.fake.count("requests")
+        request = json.loads(self.read_body() or b"{}")
+        if self.path.rstrip("/").split("?", 1)[0] not in ("/v1/chat/completions", "/chat/completions"):
+            self.respond(404, {"error": {"message": "Not Found"}})
+            return
+        prompt = "\n".join(message.get("content") or "" for message in request.get("messages", []))
+        prompt_tokens = len(prompt) // 4 + 1
+        self.fake.count("prompt_tokens", prompt_tokens)
+
+        fault = self.fake.behavior.fault()
+        if fault == "rate_limit":
+            self.fake.count("rate_limited")
+            retry_ms = str(int(self.fake.behavior.retry_after * 1000))
+            self.respond(429, {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                         headers={"retry-after-ms": retry_ms, "retry-after": str(self.fake.behavior.retry_after)})
+            return
+        self.fake.behavior.delay()
+        if fault == "error":
+            self.fake.count("errors")
+            self.respond(500, {"error": {"message": "The server had an error", "type": "server_error"}})
+            return
+
+        if self.TRIAGE_HUNK_RE.search(prompt):
+            self.fake.count("triage_requests")
+            content = json.dumps({"flagged": self.flagged_hunks(prompt)})
+        else:
+            content = json.dumps({"findings": self.findings_for(prompt)})
+        completion_tokens = len(content) // 4 + 1
+        self.fake.count("completion_tokens", completion_tokens)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens}
+        model = request.get("model", "gpt-4o")
+        if request.get("stream"):
+            self.stream_completion(content, model, usage)
+        else:
+            self.respond(200, {
+                "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+    def flagged_hunks(self, prompt):
+        """Triage answer: the numbers of the hunks containing a risky line."""
+        sections = self.TRIAGE_HUNK_RE.split(prompt)[1:]
+        return [int(number) for number, text in zip(sections[::2], sections[1::2]) if self.RISKY_RE.search(text)]
+
+    def findings_for(self, prompt):
+        """One finding per risky added line, attributed to the file it appears in."""
+        findings = []
+        current_file, line_number = None, 0
+        for line in prompt.splitlines():
+            file_match = self.FILE_RE.match(line)
+            if file_match:
+                current_file, line_number = file_match.group(1), 0
+            elif line.startswith("@@"):
+                match = re.match(r"^@@ -\d+(?:,\d+)? \+(\d+)", line)
+                line_number = int(match.group(1)) - 1 if match else 0
+            elif line.startswith("+") and current_file:
+                line_number += 1
+                if self.RISKY_RE.search(line):
+                    findings.append({
+                        "file_path": current_file, "line": line_number, "type": "Injection",
+                        "risk": "Untrusted input reaches a dangerous sink.", "suggestion": "Validate or parameterize the input.",
+                    })
+            elif line.startswith(" "):
+                line_number += 1
+        return findings[:20]
+
+    def stream_completion(self, content, model, usage, pieces=8):
+        """Sends the completion as server-sent events, like the real streaming API."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        step = max(1, len(content) // pieces)
+        base = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": model}
+        events = [dict(base, choices=[{"index": 0, "delta": {"role": "assistant", "content": content[i:i + step]},
+                                       "finish_reason": None}]) for i in range(0, len(content), step)]
+        events.append(dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+        events.append(dict(base, choices=[], usage=usage))
+        for event in events:
+            self.write_chunk(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+        self.write_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+class FakeOpenAIServer(_FakeServer):
+    """Answers /v1/chat/completions (streaming or not) with one finding per risky added line."""
+    handler_class = _OpenAIHandler
@@ -0,0 +1,97 @@
+# benchmarks/lambda_cold_start.py
+"""Import-time benchmark for the worker Lambda entry point.
+
+Starts fresh interpreters (as a cold Lambda container would) and measures:
+  * importing worker.lambda_handler, i.e. what every cold start pays before the handler runs
+  * first-invocation setup (get_pipeline(): the analysis pipeline without secrets)
+and lists the slowest imports reported by `python -X importtime`. Modules that must
+stay out of the cold path (Celery, dotenv, the OpenAI SDK, boto3 without secrets) are
+checked as well.
+
+Exits non-zero when a budget is exceeded or a forbidden module is imported, so it can
+run in CI:
+    python benchmarks/lambda_cold_start.py --runs 10 --max-import-ms 30 --max-init-ms 250
+"""
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Never imported by the handler module or the first invocation (without secrets)
+FORBIDDEN_MODULES = ("celery", "kombu", "dotenv", "openai", "boto3", "requests", "httpx", "asyncio")
+
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import worker.lambda_handler as handler
+imported = time.perf_counter()
+handler.get_pipeline()
+initialized = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "init_ms": (initialized - imported) * 1000,
+    "modules": sorted({name.split(".")[0] for name in sys.modules}),
+}))
+"""
+
+def run_probe(extra_args=()):
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    env.pop("SECRETS_MANAGER_SECRET_NAME", None)
+    env.pop("OPENAI_API_KEY", None)
+    completed = subprocess.run(
+        [sys.executable, *extra_args, "-c", PROBE], env=env, cwd=REPO_ROOT,
+        capture_output=True, text=True, check=True,
+    )
+    return json.loads(completed.stdout.strip().splitlines()[-1]), completed.stderr
+
+def slowest_imports(stderr, top):
+    """Parses -X importtime output into the top (cumulative microseconds, module) entries."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = (part.strip() for part in line[len("import time:"):].split("|"))
+        rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--top", type=int, default=10, help="Slowest imports to list")
+    parser.add_argument("--max-import-ms", type=float, default=None, help="Fail if the median handler import exceeds this")
+    parser.add_argument("--max-init-ms", type=float, default=None, help="Fail if the median first-invocation setup exceeds this")
+    args = parser.parse_args()
+
+    run_probe()  # Warm the bytecode cache; Lambda packages ship compiled .pyc files too
+    samples = [run_probe()[0] for _ in range(args.runs)]
+    import_ms = statistics.median(sample["import_ms"] for sample in samples)
+    init_ms = statistics.median(sample["init_ms"] for sample in samples)
+    print(f"handler import: median {import_ms:.1f} ms over {args.runs} cold interpreter(s)")
+    print(f"first-invocation setup: median {init_ms:.1f} ms")
+
+    _, importtime = run_probe(("-X", "importtime"))
+    print("\nslowest imports (cumulative):")
+    for microseconds, name in slowest_imports(importtime, args.top):
+        print(f"  {microseconds / 1000:8.1f} ms  {name}")
+
+    failures = []
+    loaded = set(samples[-1]["modules"])
+    forbidden = sorted(loaded.intersection(FORBIDDEN_MODULES))
+    if forbidden:
+        failures.append(f"cold path imports {', '.join(forbidden)}")
+    if args.max_import_ms is not None and import_ms > args.max_import_ms:
+        failures.append(f"handler import {import_ms:.1f} ms > budget {args.max_import_ms} ms")
+    if args.max_init_ms is not None and init_ms > args.max_init_ms:
+        failures.append(f"first-invocation setup {init_ms:.1f} ms > budget {args.max_init_ms} ms")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,302 @@
+# benchmarks/pipeline_e2e.py
+"""End-to-end load benchmark: signed webhooks in, PR reviews out, against local stand-ins.
+
+Starts the fake GitHub and OpenAI servers (benchmarks/fake_services.py), points the
+worker at them, replays signed pull_request deliveries through the FastAPI app over
+ASGI at a fixed arrival rate, and runs the real analysis pipeline (run_pr_analysis) on
+worker threads fed by an in-process queue that stands in for the Celery broker
+(retries included). Pull requests get synthetic diffs drawn from a size mix, from a
+20-line fix to a 300k-line vendoring PR.
+
+Reports webhook response latency, queue wait, per-stage and end-to-end latency
+(p50/p99), throughput in PRs/min and the fake services' request, fault and token
+counters. Needs no network access, credentials or Redis; run it on a plain Linux box
+with backend/ and worker/ requirements installed:
+    python benchmarks/pipeline_e2e.py --prs 200 --rate 5 --workers 8 \\
+        --mix small:60,medium:30,large:9,huge:1 --llm-latency 1.5 --llm-rate-limit 0.05
+
+Worker settings (LLM_CHUNK_TOKEN_BUDGET, PRESCAN_*, LLM_TRIAGE_*, LLM_STREAMING, ...) are read from
+the environment as usual, so configurations can be compared run against run.
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from fake_services import FakeGitHubServer, FakeOpenAIServer, ServiceBehavior, synthetic_diff, PR_SIZES  # noqa: E402
+from webhook_latency import send_webhook, percentile  # noqa: E402  (also sets GITHUB_WEBHOOK_SECRET)
+
+# Pipeline functions timed as stages, looked up on worker.analysis at call time
+STAGES = (
+    ("get_github_installation_token", "token"),
+    ("fetch_pr_diff", "fetch"),
+    ("fetch_commit_range_diff", "fetch"),
+    ("read_file_diffs", "parse"),
+    ("prescan_diff", "prescan"),
+    ("compact_diff", "compact"),
+    ("chunk_diff", "chunk"),
+    ("triage_chunk", "triage"),
+    ("call_llm_api", "llm call"),
+    ("analyze_diff_chunks", "llm (all chunks)"),
+    ("post_findings_review", "post"),
+)
+
+def parse_mix(mix):
+    """"small:60,huge:1" -> [("small", 60), ("huge", 1)]"""
+    weights = []
+    for part in mix.split(","):
+        size, _, weight = part.partition(":")
+        if size not in PR_SIZES:
+            raise argparse.ArgumentTypeError(f"unknown PR size {size!r} (expected one of {', '.join(PR_SIZES)})")
+        weights.append((size, float(weight or 1)))
+    return weights
+
+class Timings:
+    """Thread-safe latency samples per metric name."""
+
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.samples.setdefault(name, []).append(seconds)
+
+    def instrument(self, target, attribute, name):
+        original = getattr(target, attribute)
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.record(name, time.perf_counter() - started)
+
+        setattr(target, attribute, timed)
+
+class InProcessQueue:
+    """Stands in for the broker and Celery workers: a FIFO queue drained by worker threads.
+
+    Retries mirror analyze_pull_request: LLMCapacityUnavailable and GitHubRateLimited come
+    back after their retry_after, other errors after retry_delay, up to max_retries.
+    """
+
+    def __init__(self, run, workers, timings, max_retries=3, retry_delay=1.0):
+        self.run = run
+        self.timings = timings
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.queue = queue.Queue()
+        self.outcomes = {}  # delivery id -> status
+        self.finished_at = {}
+        self.retries = 0
+        self.pending = 0
+        self.condition = threading.Condition()
+        self.threads = [threading.Thread(target=self._work, name=f"bench-worker-{i}", daemon=True) for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, task_data, attempt=0):
+        with self.condition:
+            if attempt == 0:
+                self.pending += 1
+        self.queue.put((task_data, attempt, time.perf_counter()))
+
+    def _work(self):
+        from worker.coalescing import AnalysisSuperseded
+        from worker.llm_rate_limiter import LLMCapacityUnavailable
+        from worker.github_client import GitHubRateLimited
+
+        while True:
+            task_data, attempt, enqueued_at = self.queue.get()
+            if attempt == 0:
+                self.timings.record("queue wait", time.perf_counter() - enqueued_at)
+            status, retry_in = "success", None
+            try:
+                status = self.run(task_data).get("status", "success")
+            except AnalysisSuperseded:
+                status = "superseded"
+            except (LLMCapacityUnavailable, GitHubRateLimited) as e:
+                status, retry_in = "failed", e.retry_after
+            except Exception as e:
+                logging.getLogger(__name__).debug(f"Analysis failed: {e}", exc_info=True)
+                status, retry_in = "failed", self.retry_delay
+            if retry_in is not None and attempt < self.max_retries:
+                with self.condition:
+                    self.retries += 1
+                threading.Timer(retry_in, self.submit, (task_data, attempt + 1)).start()
+                continue
+            with self.condition:
+                self.outcomes[task_data["delivery_id"]] = status
+                self.finished_at[task_data["delivery_id"]] = time.perf_counter()
+                self.pending -= 1
+                self.condition.notify_all()
+
+    def wait(self, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.pending and time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+            return self.pending == 0
+
+def make_delivery(pr_number, installation_id):
+    payload = {
+        "action": "opened",
+        "number": pr_number,
+        "pull_request": {
+            "number": pr_number,
+            "head": {"sha": uuid.uuid4().hex + uuid.uuid4().hex[:8], "ref": f"feature-{pr_number}"},
+            "base": {"sha": "fedcba9876543210fedcba9876543210fedcba98", "ref": "main"},
+            "body": "Benchmark pull request",
+        },
+        "repository": {"full_name": "octo-org/octo-repo", "id": 1},
+        "installation": {"id": installation_id},
+    }
+    return json.dumps(payload).encode("utf-8")
+
+async def replay_deliveries(app, total, rate, installations, sent_at):
+    """Sends total signed deliveries at a fixed arrival rate (open loop); returns response latencies."""
+    latencies = []
+
+    async def one(index):
+        body = make_delivery(index + 1, 1000 + index % installations)
+        sent_at[f"bench-{index}"] = time.perf_counter()
+        latencies.append(await send_webhook(app, "pull_request", body, index))
+
+    tasks = []
+    for index in range(total):
+        tasks.append(asyncio.ensure_future(one(index)))
+        await asyncio.sleep(1.0 / rate)
+    await asyncio.gather(*tasks)
+    return latencies
+
+def configure_environment(github, openai_server, workdir):
+    """Points the worker at the fake services; must run before worker modules are imported."""
+    os.environ["GITHUB_API_BASE_URL"] = github.url
+    os.environ["OPENAI_BASE_URL"] = f"{openai_server.url}/v1"
+    os.environ["OPENAI_API_KEY"] = "sk-benchmark"
+    # Any App ID and key will do: the fake GitHub does not verify the App JWT (see main())
+    os.environ["GITHUB_APP_ID"] = "1"
+    os.environ["GITHUB_PRIVATE_KEY"] = "benchmark"
+    os.environ["GITHUB_APP_SLUG"] = FakeGitHubServer.APP_SLUG
+    os.environ["LLM_CACHE_ENABLED"] = "false"  # Every PR is new; a warm cache would hide the LLM stage
+    os.environ["PR_STATE_SQLITE_PATH"] = os.path.join(workdir, "pr_state.sqlite3")
+    os.environ.setdefault("LLM_TOKENS_PER_MINUTE", "10000000")
+    os.environ.setdefault("LLM_REQUESTS_PER_MINUTE", "100000")
+    os.environ.setdefault("GITHUB_EARLY_REVIEW_LINGER_SECONDS", "0.5")
+
+def summarize(name, samples, unit="ms"):
+    scale = 1000 if unit == "ms" else 1
+    values = [sample * scale for sample in samples]
+    return (
+        f"{name:<22} {len(values):>7} {percentile(values, 50):>10.1f} {percentile(values, 99):>10.1f} "
+        f"{max(values):>10.1f}  {unit}"
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--prs", type=int, default=100, help="Pull request deliveries to replay")
+    parser.add_argument("--rate", type=float, default=5.0, help="Deliveries per second")
+    parser.add_argument("--workers", type=int, default=4, help="Concurrent analyses (Celery worker concurrency)")
+    parser.add_argument("--installations", type=int, default=5)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("small:60,medium:30,large:9,huge:1"),
+                        help="PR size weights, from " + ", ".join(f"{k} ({f}x{n} lines)" for k, (f, n) in PR_SIZES.items()))
+    parser.add_argument("--github-latency", type=float, default=0.05, help="Seconds per GitHub request")
+    parser.add_argument("--github-error-rate", type=float, default=0.0)
+    parser.add_argument("--github-rate-limit", type=float, default=0.0, help="Share of GitHub requests answered 403 + Retry-After")
+    parser.add_argument("--llm-latency", type=float, default=1.0, help="Seconds per completion")
+    parser.add_argument("--llm-jitter", type=float, default=0.5)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--llm-rate-limit", type=float, default=0.0, help="Share of completions answered 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After of injected rate limits (seconds)")
+    parser.add_argument("--retry-delay", type=float, default=1.0, help="Task retry delay (Celery's is 60s)")
+    parser.add_argument("--timeout", type=float, default=600.0, help="Give up waiting for analyses after this long")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger("worker").setLevel(logging.ERROR)  # Injected faults would flood the output
+
+    rng = random.Random(args.seed)
+    sizes, weights = zip(*args.mix)
+    pr_sizes = {}
+
+    def diff_source(pr_number):
+        size = pr_sizes.setdefault(pr_number, rng.choices(sizes, weights)[0])
+        return synthetic_diff(size, seed=pr_number)
+
+    github = FakeGitHubServer(
+        ServiceBehavior(args.github_latency, args.github_latency / 2, args.github_error_rate,
+                        args.github_rate_limit, args.retry_after, seed=args.seed),
+        diff_source=diff_source,
+    )
+    openai_server = FakeOpenAIServer(
+        ServiceBehavior(args.llm_latency, args.llm_jitter, args.llm_error_rate,
+                        args.llm_rate_limit, args.retry_after, seed=args.seed + 1),
+    )
+    workdir = tempfile.mkdtemp(prefix="codeguardian-bench-")
+    configure_environment(github, openai_server, workdir)
+
+    import main as backend_main
+    from worker import analysis, github_auth, github_review
+
+    github_auth.get_app_jwt = lambda: "benchmark-app-jwt"
+    timings = Timings()
+    for attribute, name in STAGES:
+        timings.instrument(analysis, attribute, name)
+    timings.instrument(github_review, "post_findings_review", "post")  # Early reviews call it directly
+    timings.instrument(analysis.EarlyReviewPoster, "finish", "post (early + final)")
+
+    worker_queue = InProcessQueue(analysis.run_pr_analysis, args.workers, timings, retry_delay=args.retry_delay)
+    backend_main.schedule_coalesced_analysis = lambda task, task_data: worker_queue.submit(task_data)
+
+    sent_at = {}
+    started = time.perf_counter()
+    webhook_latencies = asyncio.run(replay_deliveries(backend_main.app, args.prs, args.rate, args.installations, sent_at))
+    drained = worker_queue.wait(args.timeout)
+    elapsed = time.perf_counter() - started
+
+    end_to_end = {}
+    for delivery_id, finished in worker_queue.finished_at.items():
+        if worker_queue.outcomes[delivery_id] == "success":
+            size = pr_sizes.get(int(delivery_id.rsplit("-", 1)[1]) + 1, "?")
+            end_to_end.setdefault(size, []).append(finished - sent_at[delivery_id])
+
+    outcomes = list(worker_queue.outcomes.values())
+    completed = outcomes.count("success")
+    print(f"{args.prs} PRs at {args.rate}/s, {args.workers} worker(s), mix {dict(args.mix)}")
+    print(f"\n{'metric':<22} {'samples':>7} {'p50':>10} {'p99':>10} {'max':>10}")
+    print(summarize("webhook response", webhook_latencies))
+    for name in ["queue wait"] + sorted({name for _, name in STAGES} | {"post", "post (early + final)"}):
+        if timings.samples.get(name):
+            print(summarize(name, timings.samples[name]))
+    for size in PR_SIZES:
+        if end_to_end.get(size):
+            print(summarize(f"end-to-end ({size})", end_to_end[size], unit="s"))
+
+    print(
+        f"\ncompleted {completed}/{args.prs}, failed {outcomes.count('failed')}, "
+        f"superseded {outcomes.count('superseded')}, task retries {worker_queue.retries}"
+        + ("" if drained else f", {worker_queue.pending} still running after {args.timeout:.0f}s")
+    )
+    print(f"throughput: {completed / elapsed * 60:.1f} PRs/min over {elapsed:.1f}s")
+    print(f"fake GitHub: {github.stats}")
+    print(f"fake OpenAI: {openai_server.stats}")
+    github.close()
+    openai_server.close()
+    return 0 if drained and completed == args.prs else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
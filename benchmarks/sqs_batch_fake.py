@@ -0,0 +1,136 @@
+# benchmarks/sqs_batch_fake.py
+"""In-memory FIFO SQS stand-in for exercising worker.sqs_batch without AWS.
+
+FakeFifoQueue mimics what matters to the Lambda event source: batches of up to 10
+messages, a message group is never handed out again while one of its messages is in
+flight, failed messages become visible again (keeping their place in the group) and
+are dead-lettered after max_receive_count receives.
+
+The driver pushes several messages per PR group through process_sqs_batch() with
+random failures and latency, checks that every group was processed in order, and
+compares wall time against one-message-at-a-time consumption:
+    python benchmarks/sqs_batch_fake.py --groups 20 --messages 5 --failure-rate 0.1
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from collections import OrderedDict
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from worker.sqs_batch import process_sqs_batch  # noqa: E402
+
+class FakeFifoQueue:
+    def __init__(self, max_receive_count=3):
+        self.max_receive_count = max_receive_count
+        self.groups = OrderedDict()  # group id -> list of messages, in send order
+        self.in_flight = {}          # message id -> group id
+        self.dead_letters = []
+        self.next_id = 0
+
+    def send(self, body, group_id):
+        self.next_id += 1
+        message = {"messageId": f"m-{self.next_id}", "body": json.dumps(body), "receive_count": 0, "group": group_id}
+        self.groups.setdefault(group_id, []).append(message)
+
+    def receive(self, max_messages=10):
+        """Returns Lambda-style records, taking messages only from groups with nothing in flight."""
+        busy = set(self.in_flight.values())
+        records = []
+        for group_id, messages in self.groups.items():
+            if group_id in busy:
+                continue
+            for message in messages:
+                if len(records) >= max_messages:
+                    break
+                message["receive_count"] += 1
+                self.in_flight[message["messageId"]] = group_id
+                records.append({
+                    "messageId": message["messageId"],
+                    "body": message["body"],
+                    "attributes": {"MessageGroupId": group_id, "ApproximateReceiveCount": str(message["receive_count"])},
+                })
+        return records
+
+    def complete(self, records, response):
+        """Applies a partial batch response: deletes successes, releases (or dead-letters) failures."""
+        failed = {item["itemIdentifier"] for item in response["batchItemFailures"]}
+        for record in records:
+            group_id = self.in_flight.pop(record["messageId"])
+            messages = self.groups[group_id]
+            message = next(m for m in messages if m["messageId"] == record["messageId"])
+            if record["messageId"] not in failed:
+                messages.remove(message)
+            elif message["receive_count"] >= self.max_receive_count:
+                messages.remove(message)
+                self.dead_letters.append(message)
+            if not messages:
+                del self.groups[group_id]
+
+    def __len__(self):
+        return sum(len(messages) for messages in self.groups.values())
+
+def drain(queue, process_record, batch_size, max_concurrency):
+    batches = 0
+    while len(queue):
+        records = queue.receive(batch_size)
+        if not records:
+            break
+        response = process_sqs_batch(records, process_record, max_concurrency=max_concurrency)
+        queue.complete(records, response)
+        batches += 1
+    return batches
+
+def run(groups, messages, failure_rate, latency, batch_size, max_concurrency, seed):
+    rng = random.Random(seed)
+    queue = FakeFifoQueue()
+    for sequence in range(messages):
+        for group in range(groups):
+            queue.send({"repo_full_name": "octo-org/octo-repo", "pr_number": group, "sequence": sequence}, f"pr-{group}")
+
+    processed = {}
+    lock = threading.Lock()
+
+    def process_record(record):
+        body = json.loads(record["body"])
+        time.sleep(latency)
+        if rng.random() < failure_rate:
+            raise RuntimeError("injected failure")
+        with lock:
+            processed.setdefault(body["pr_number"], []).append(body["sequence"])
+
+    start = time.perf_counter()
+    batches = drain(queue, process_record, batch_size, max_concurrency)
+    elapsed = time.perf_counter() - start
+    in_order = all(sequence == sorted(sequence) for sequence in processed.values())
+    done = sum(len(sequence) for sequence in processed.values())
+    return {"elapsed": elapsed, "batches": batches, "processed": done, "dead_lettered": len(queue.dead_letters), "in_order": in_order}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--groups", type=int, default=20, help="Distinct PRs (FIFO message groups)")
+    parser.add_argument("--messages", type=int, default=5, help="Messages per group")
+    parser.add_argument("--failure-rate", type=float, default=0.1)
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds per processed record")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    ok = True
+    for label, batch_size, concurrency in (("batch=1 (sequential)", 1, 1), (f"batch=10, {args.concurrency} groups at once", 10, args.concurrency)):
+        result = run(args.groups, args.messages, args.failure_rate, args.latency, batch_size, concurrency, args.seed)
+        ok &= result["in_order"]
+        print(
+            f"{label:32s} {result['elapsed']:6.2f}s  batches={result['batches']:4d}  processed={result['processed']}"
+            f"  dead-lettered={result['dead_lettered']}  per-group order kept={result['in_order']}"
+        )
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+# benchmarks/webhook_latency.py
+"""Micro-benchmark for the GitHub webhook ingest path.
+
+Drives the FastAPI app directly over ASGI (no network, no broker) with signed
+deliveries and reports response latency percentiles per scenario. Latency is
+measured until the final response body is sent, so work deferred to background
+tasks (enqueueing) is excluded, as it is for GitHub.
+
+Usage (from the repository root, with backend/requirements.txt installed):
+    python benchmarks/webhook_latency.py --requests 2000 --concurrency 50
+"""
+
+import os
+import sys
+import json
+import hmac
+import time
+import asyncio
+import hashlib
+import argparse
+import statistics
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, "backend"))
+
+WEBHOOK_SECRET = "benchmark-secret"
+os.environ["GITHUB_WEBHOOK_SECRET"] = WEBHOOK_SECRET
+
+def make_pull_request_payload(action, size_kb):
+    """Builds a pull_request payload padded to roughly size_kb, shaped like GitHub's."""
+    filler = "x" * 1024
+    return {
+        "action": action,
+        "number": 42,
+        "pull_request": {
+            "number": 42,
+            "head": {"sha": "0123456789abcdef0123456789abcdef01234567", "ref": "feature"},
+            "base": {"sha": "fedcba9876543210fedcba9876543210fedcba98", "ref": "main"},
+            "body": filler * size_kb,
+            "labels": [{"name": f"label-{i}"} for i in range(20)],
+        },
+        "repository": {"full_name": "octo-org/octo-repo", "id": 1},
+        "installation": {"id": 123},
+    }
+
+def sign(body):
+    return "sha256=" + hmac.new(WEBHOOK_SECRET.encode("utf-8"), body, hashlib.sha256).hexdigest()
+
+def build_scenarios(size_kb):
+    scenarios = {}
+    for name, event, payload in (
+        ("pull_request.opened", "pull_request", make_pull_request_payload("opened", size_kb)),
+        ("pull_request.labeled", "pull_request", make_pull_request_payload("labeled", size_kb)),
+        ("push (unhandled event)", "push", {"ref": "refs/heads/main", "commits": ["x" * 1024] * size_kb}),
+    ):
+        body = json.dumps(payload).encode("utf-8")
+        scenarios[name] = (event, body)
+    return scenarios
+
+async def send_webhook(app, event, body, index):
+    headers = [
+        (b"content-type", b"application/json"),
+        (b"x-github-event", event.encode("ascii")),
+        (b"x-github-delivery", f"bench-{index}".encode("ascii")),
+        (b"x-hub-signature-256", sign(body).encode("ascii")),
+    ]
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": "/webhook/github", "raw_path": b"/webhook/github", "query_string": b"",
+        "root_path": "", "headers": headers, "client": ("127.0.0.1", 12345), "server": ("testserver", 80),
+    }
+    received = False
+
+    async def receive():
+        nonlocal received
+        if not received:
+            received = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await asyncio.sleep(3600)
+
+    started = time.perf_counter()
+    finished = None
+
+    async def send(message):
+        nonlocal finished
+        if message["type"] == "http.response.body" and not message.get("more_body") and finished is None:
+            finished = time.perf_counter()
+
+    await app(scope, receive, send)
+    return (finished or time.perf_counter()) - started
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+async def run_scenario(app, event, body, total, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(index):
+        async with semaphore:
+            latencies.append(await send_webhook(app, event, body, index))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    elapsed = time.perf_counter() - started
+    return latencies, total / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--payload-kb", type=int, default=300)
+    args = parser.parse_args()
+
+    import logging
+    logging.disable(logging.CRITICAL)  # Per-request log lines would dominate the measurement
+
+    import main as backend_main
+
+    class CountingTask:
+        calls = 0
+
+        def delay(self, *args, **kwargs):
+            CountingTask.calls += 1
+
+    backend_main.analyze_pull_request = CountingTask()
+
+    print(f"{'scenario':<26} {'bytes':>9} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8} {'req/s':>9}")
+    for name, (event, body) in build_scenarios(args.payload_kb).items():
+        latencies, throughput = asyncio.run(run_scenario(backend_main.app, event, body, args.requests, args.concurrency))
+        latencies_ms = [latency * 1000 for latency in latencies]
+        print(
+            f"{name:<26} {len(body):>9} {statistics.median(latencies_ms):>8.2f} "
+            f"{percentile(latencies_ms, 99):>8.2f} {max(latencies_ms):>8.2f} {throughput:>9.0f}"
+        )
+    print(f"enqueued tasks: {CountingTask.calls}")
+
+if __name__ == "__main__":
+    main()
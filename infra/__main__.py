@@ -56,6 +56,19 @@ app_secrets = aws.secretsmanager.Secret(f"{app_name}-secrets-{stage}",
     })
 )
 
+# The worker Lambda reads its secrets once per container at the first invocation
+app_secrets_read_policy = aws.iam.RolePolicy(f"{app_name}-secrets-read-policy-{stage}",
+    role=app_execution_role.id,
+    policy=app_secrets.arn.apply(lambda arn: json.dumps({
+        "Version": "2012-10-17",
+        "Statement": [{
+            "Effect": "Allow",
+            "Action": ["secretsmanager:GetSecretValue"],
+            "Resource": [arn]
+        }]
+    }))
+)
+
 # --- SQS Queue ---
 # Queue for decoupling webhook receiver from the AI analysis worker
 analysis_queue = aws.sqs.Queue(f"{app_name}-analysis-queue-{stage}",
@@ -186,10 +199,10 @@ lambda_permission = aws.lambda_.Permission(f"{app_name}-api-lambda-permission-{s
 worker_lambda = aws.lambda_.Function(f"{app_name}-worker-lambda-{stage}",
     name=f"{app_name}-worker-lambda-{stage}",
     runtime="python3.11", # Match worker Python version
-    handler="tasks.celery_handler", # Needs a handler suitable for SQS events
+    handler="worker.lambda_handler.handler", # SQS handler with lazy imports (no Celery)
     role=app_execution_role.arn,
     code=pulumi.AssetArchive({
-        ".": pulumi.FileArchive("../worker") # Adjust path as needed
+        "worker": pulumi.FileArchive("../worker") # Packaged as a package: the worker uses relative imports
     }),
     timeout=300, # Longer timeout for analysis tasks
     memory_size=1024, # More memory might be needed for analysis
@@ -198,6 +211,7 @@ worker_lambda = aws.lambda_.Function(f"{app_name}-worker-lambda-{stage}",
             "SECRETS_MANAGER_SECRET_NAME": app_secrets.name,
             "GITHUB_API_BASE_URL": "https://api.github.com",
             "LLM_MODEL_NAME": "gpt-4o",
+            "SQS_BATCH_MAX_CONCURRENCY": "4",
             "AWS_REGION": aws_region,
         }
     }
@@ -208,7 +222,8 @@ worker_lambda = aws.lambda_.Function(f"{app_name}-worker-lambda-{stage}",
 sqs_event_mapping = aws.lambda_.EventSourceMapping(f"{app_name}-sqs-mapping-{stage}",
     event_source_arn=analysis_queue.arn,
     function_name=worker_lambda.name,
-    batch_size=1 # Process one message at a time
+    batch_size=10, # FIFO maximum; message groups (one per PR) are processed concurrently
+    function_response_types=["ReportBatchItemFailures"] # Redeliver only the failed messages
 )
 
 # Option 2: ECS Fargate Worker (more complex setup, better for long-running tasks)
@@ -0,0 +1,51 @@
+import json
+
+import pytest
+
+from worker import analysis
+from worker.github_client import GitHubResponse
+
+BASE_SHA, HEAD_SHA = "a" * 40, "b" * 40
+
+class FakeGitHubClient:
+    def __init__(self, status, status_code=200):
+        self.status = status
+        self.status_code = status_code
+        self.streamed = []
+
+    def get(self, path, token):
+        return GitHubResponse(self.status_code, {}, json.dumps({"status": self.status}).encode(), path)
+
+    def stream(self, path, token, accept):
+        self.streamed.append(path)
+        yield b"diff --git a/app.py b/app.py\n"
+
+@pytest.mark.parametrize("status, status_code, incremental", [
+    ("ahead", 200, True),
+    ("diverged", 200, False),  # Rebased onto an updated base branch
+    ("behind", 200, False),
+    (None, 404, False),  # Old head garbage collected after a force-push
+])
+def test_commit_range_diff_only_for_fast_forwards(monkeypatch, status, status_code, incremental):
+    client = FakeGitHubClient(status, status_code)
+    monkeypatch.setattr(analysis, "get_github_client", lambda: client)
+
+    spool = analysis.fetch_commit_range_diff("ghs_token", "octo/repo", BASE_SHA, HEAD_SHA)
+
+    assert (spool is not None) == incremental
+    assert bool(client.streamed) == incremental
+
+@pytest.mark.parametrize("previous_state, commit_id, plan", [
+    (None, HEAD_SHA, "full"),
+    ({"head_sha": BASE_SHA}, None, "full"),
+    ({"head_sha": HEAD_SHA}, HEAD_SHA, "unchanged"),
+    ({"head_sha": BASE_SHA}, HEAD_SHA, "incremental"),
+])
+def test_plan_diff_fetch(previous_state, commit_id, plan):
+    assert analysis.plan_diff_fetch(previous_state, commit_id, "test:") == plan
+
+def test_analysis_result_leaves_out_what_a_run_did_not_measure():
+    assert analysis.analysis_result("unchanged") == {"status": "success", "findings_count": 0, "mode": "unchanged"}
+    assert analysis.analysis_result("full", 2, 30, {"hunks": 4}) == {
+        "status": "success", "findings_count": 2, "mode": "full", "prompt_tokens_saved": 30, "triage": {"hunks": 4},
+    }
@@ -0,0 +1,36 @@
+from worker.diff_stream import MINIFIED_LINE_CHARS, spool_diff, read_file_diffs
+
+def _new_file_diff(path, added_lines):
+    body = "".join(f"+{line}\n" for line in added_lines)
+    return (
+        f"diff --git a/{path} b/{path}\n"
+        "new file mode 100644\n"
+        "--- /dev/null\n"
+        f"+++ b/{path}\n"
+        f"@@ -0,0 +1,{len(added_lines)} @@\n"
+        f"{body}"
+    )
+
+def _read(diff):
+    with spool_diff([diff]) as spool:
+        return read_file_diffs(spool)
+
+def test_python_file_with_a_long_line_is_still_reviewed():
+    long_line = f"BLOB = '{'A' * (MINIFIED_LINE_CHARS + 200)}'"
+    file_diffs, stats = _read(_new_file_diff("app/run.py", ["import os", long_line, "os.system(user_input)"]))
+
+    assert stats["files"] == 1 and "minified" not in stats["skipped"]
+    lines = file_diffs[0].hunks[0].lines
+    assert "+os.system(user_input)" in lines
+    assert all(len(line) <= MINIFIED_LINE_CHARS for line in lines)
+
+def test_minified_javascript_is_still_skipped():
+    file_diffs, stats = _read(_new_file_diff("static/app.js", ["var a=1;" * MINIFIED_LINE_CHARS]))
+
+    assert file_diffs == []
+    assert stats["skipped"] == {"minified": 1}
+
+def test_generated_marker_does_not_hide_python():
+    file_diffs, stats = _read(_new_file_diff("app/auth.py", ["# Code generated by hand. DO NOT EDIT.", "x = 1"]))
+
+    assert stats["files"] == 1 and stats["skipped"] == {}
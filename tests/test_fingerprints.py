@@ -0,0 +1,39 @@
+from worker.fingerprints import FINGERPRINT_MARKER, RESOLVED_MARKER, entries_from_comments
+
+BOT_LOGIN = "codeguardian[bot]"
+FINGERPRINT = "0123456789abcdef"
+
+def _comment(user, body, path="app/views.py", comment_id=1):
+    return {"id": comment_id, "path": path, "body": body, "user": user}
+
+def test_markers_from_the_app_are_indexed():
+    bot = {"login": BOT_LOGIN, "type": "Bot"}
+    entries = entries_from_comments([_comment(bot, FINGERPRINT_MARKER.format(FINGERPRINT))], BOT_LOGIN)
+
+    assert entries == {FINGERPRINT: {"comment_id": 1, "path": "app/views.py", "resolved": False}}
+
+def test_markers_from_a_human_commenter_are_ignored():
+    author = {"login": "pr-author", "type": "User"}
+    body = f"Already reported {FINGERPRINT_MARKER.format(FINGERPRINT)} {RESOLVED_MARKER.format(FINGERPRINT)}"
+
+    assert entries_from_comments([_comment(author, body), _comment(author, body, path=None)], BOT_LOGIN) == {}
+
+def test_markers_from_another_bot_are_ignored():
+    other_bot = {"login": "someone-elses-app[bot]", "type": "Bot"}
+    impostor = {"login": BOT_LOGIN, "type": "User"}
+    comments = [
+        _comment(other_bot, FINGERPRINT_MARKER.format(FINGERPRINT)),
+        _comment(impostor, FINGERPRINT_MARKER.format(FINGERPRINT)),
+    ]
+
+    assert entries_from_comments(comments, BOT_LOGIN) == {}
+
+def test_a_human_cannot_resolve_the_apps_finding():
+    bot = {"login": BOT_LOGIN, "type": "Bot"}
+    author = {"login": "pr-author", "type": "User"}
+    comments = [
+        _comment(bot, FINGERPRINT_MARKER.format(FINGERPRINT)),
+        _comment(author, RESOLVED_MARKER.format(FINGERPRINT), comment_id=2),
+    ]
+
+    assert entries_from_comments(comments, BOT_LOGIN)[FINGERPRINT]["resolved"] is False
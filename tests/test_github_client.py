@@ -0,0 +1,22 @@
+import time
+
+import pytest
+
+from worker.github_client import GitHubRateLimiter, GitHubRateLimited, GitHubResponse
+
+def _response(status_code, **headers):
+    return GitHubResponse(status_code, headers, b"", "https://api.github.com/repos/o/r")
+
+def test_short_rate_limit_waits_in_process():
+    limiter = GitHubRateLimiter(max_wait=5)
+    limiter.update(_response(429, **{"Retry-After": "2"}))
+
+    assert 0 < limiter.delay() <= 2
+
+def test_exhausted_quota_raises_with_the_time_until_reset():
+    limiter = GitHubRateLimiter(reserve=10, max_wait=5)
+    limiter.update(_response(200, **{"X-RateLimit-Remaining": "3", "X-RateLimit-Reset": str(time.time() + 3000)}))
+
+    with pytest.raises(GitHubRateLimited) as raised:
+        limiter.delay()
+    assert 2990 < raised.value.retry_after <= 3000
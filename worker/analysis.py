@@ -0,0 +1,738 @@
+# worker/analysis.py
+"""The PR analysis pipeline, independent of how it is triggered (Celery task or Lambda handler).
+
+Keep module-level imports light: heavy SDKs are imported on first use so that cold
+starts only pay for what an invocation actually needs.
+"""
+
+import os
+import time
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from .diff_chunker import chunk_diff, estimate_tokens
+from .diff_stream import spool_diff, read_file_diffs
+from .llm_cache import get_llm_cache
+from .prescan import prescan_diff, PRESCAN_ENABLED
+from .prompt_compaction import compact_diff, fit_prompt, PROMPT_COMPACTION_ENABLED
+from .triage import (
+    LLM_TRIAGE_ENABLED, LLM_TRIAGE_MODEL_NAME, LLM_TRIAGE_TIMEOUT_SECONDS, LOCAL_TRIAGE_MODEL, TRIAGE_SYSTEM_PROMPT,
+    CascadeStats, chunk_hunks, create_triage_prompt, triage_max_output_tokens, parse_triage_response,
+    local_triage, reduce_chunk,
+)
+from .pr_state import get_pr_state_store, carry_forward_findings
+from .findings_store import record_scan_result
+from .github_review import post_findings_review, finding_key, EarlyReviewPoster
+from .fingerprints import (
+    FINDING_DEDUPE_ENABLED, GITHUB_RESOLVE_STALE_FINDINGS, assign_fingerprints, load_posted_findings,
+    resolve_stale_findings,
+)
+from .github_client import get_github_client, GitHubAPIError, PLACEHOLDER_GITHUB_TOKEN, DIFF_ACCEPT
+from .github_auth import get_installation_token
+from .coalescing import ensure_not_superseded, is_superseded
+from .llm_rate_limiter import get_llm_rate_limiter, retry_after_seconds, LLMCapacityUnavailable
+from .llm_stream import FindingsStreamParser, iter_findings
+from .llm_resilience import (
+    LLMCircuitOpen, LLMDeadlineExceeded, bind_time_budget, call_timeout, get_circuit_breaker, get_latency_tracker,
+    hedge_allowed, hedge_delay, run_hedged,
+)
+from .metrics import (
+    stage_timer, bind_installation, record_llm_usage, record_cache_lookup, record_retry, record_prompt_tokens_removed,
+    record_triage, record_llm_hedge, record_llm_failure,
+)
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# In production, use dependency injection or a config object
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+LLM_MODEL_NAME = os.getenv("LLM_MODEL_NAME", "gpt-4o") # Or your preferred model
+# Large diffs are split into chunks of at most this many (estimated) prompt tokens
+LLM_CHUNK_TOKEN_BUDGET = int(os.getenv("LLM_CHUNK_TOKEN_BUDGET", "6000"))
+# Upper bound on concurrent LLM requests made by a single task
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+LLM_MAX_OUTPUT_TOKENS = int(os.getenv("LLM_MAX_OUTPUT_TOKENS", "1024"))
+# Per-request timeout of the full-review tier (the triage tier has LLM_TRIAGE_TIMEOUT_SECONDS)
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "120"))
+# In-call retries after a 429 (each honoring Retry-After) before the task itself is retried
+LLM_RATE_LIMIT_RETRIES = int(os.getenv("LLM_RATE_LIMIT_RETRIES", "2"))
+# Stream completions and parse findings as they arrive (also salvages truncated outputs)
+LLM_STREAMING = os.getenv("LLM_STREAMING", "true").lower() in ("1", "true", "yes")
+# Post the first streamed findings in an early review instead of waiting for every chunk
+EARLY_REVIEW_ENABLED = os.getenv("GITHUB_EARLY_REVIEW_ENABLED", "true").lower() in ("1", "true", "yes")
+
+_openai_client = None
+_openai_client_lock = threading.Lock()
+
+def get_openai_client():
+    """Returns the process-wide OpenAI client, created on first use (None without an API key)."""
+    global _openai_client
+    if _openai_client is None and OPENAI_API_KEY:
+        with _openai_client_lock:
+            if _openai_client is None:
+                from openai import OpenAI
+                # The SDK's own 429 retries would bypass the shared rate limiter, so retries are handled there instead
+                _openai_client = OpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+    return _openai_client
+
+if not OPENAI_API_KEY:
+    logger.warning("OPENAI_API_KEY not found in environment. LLM calls will fail.")
+
+# --- Helper Functions (Placeholders/Simplified) ---
+
+def get_github_installation_token(installation_id):
+    """Returns a short-lived installation token, served from the shared token cache when still fresh."""
+    # Falls back to a placeholder token (and simulated GitHub calls) when the App credentials are missing
+    return get_installation_token(installation_id)
+
+# Sample Python diff returned when GitHub calls are simulated (no GitHub App configured)
+SIMULATED_PR_DIFF = """diff --git a/vulnerable.py b/vulnerable.py
+index e69de29..d1f2e7a 100644
+--- a/vulnerable.py
++++ b/vulnerable.py
+@@ -0,0 +1,5 @@
++import os
++
++def execute_command(user_input):
++    # Potential command injection vulnerability
++    os.system(f"echo User input: {user_input}")
+"""
+
+def fetch_pr_diff(token, repo_full_name, pr_number):
+    """Streams the diff of a Pull Request into a DiffSpool (spilled to disk when large)."""
+    if token == PLACEHOLDER_GITHUB_TOKEN:
+        logger.info(f"Simulating fetching diff for {repo_full_name}# {pr_number}")
+        return spool_diff([SIMULATED_PR_DIFF])
+    # Raises GitHubAPIError for bad status codes
+    return spool_diff(get_github_client().stream(f"/repos/{repo_full_name}/pulls/{pr_number}", token, accept=DIFF_ACCEPT))
+
+def fetch_commit_range_diff(token, repo_full_name, base_sha, head_sha):
+    """Streams the diff between two commits of a PR branch into a DiffSpool.
+
+    Returns None (analyze the full PR instead) when the range is unavailable or head_sha
+    does not descend from base_sha, e.g. after a rebase onto an updated base branch.
+    """
+    if token == PLACEHOLDER_GITHUB_TOKEN:
+        logger.info(f"Simulating fetching diff for {repo_full_name} {base_sha[:7]}...{head_sha[:7]}")
+        return None # Simulated runs always fall back to a full PR analysis
+    path = compare_path(repo_full_name, base_sha, head_sha)
+    client = get_github_client()
+    try:
+        compare = client.get(f"{path}?per_page=1", token)
+        compare.raise_for_status()
+        if not is_fast_forward(compare.json(), base_sha, head_sha):
+            return None
+        return spool_diff(client.stream(path, token, accept=DIFF_ACCEPT))
+    except GitHubAPIError as e:
+        if e.status_code == 404: # e.g. the old head was garbage collected after a force-push
+            return None
+        raise
+
+def compare_path(repo_full_name, base_sha, head_sha):
+    return f"/repos/{repo_full_name}/compare/{base_sha}...{head_sha}"
+
+def is_fast_forward(compare, base_sha, head_sha):
+    """Whether a compare response says head_sha only adds commits on top of base_sha.
+
+    The three-dot diff starts at the merge base, so after a rebase or force-push it would
+    also contain base-branch commits that are not part of the PR.
+    """
+    status = compare.get("status")
+    if status == "ahead":
+        return True
+    logger.info(f"Head {head_sha[:7]} is {status} of {base_sha[:7]}, not a fast-forward; analyzing the full PR.")
+    return False
+
+# Bump whenever the prompt or response handling changes so cached LLM results are invalidated
+PROMPT_VERSION = "4"
+
+def create_security_analysis_prompt(diff_content, hints=None):
+    """Creates the prompt for the LLM to analyze the diff for security issues."""
+    # This prompt needs significant refinement and testing
+    hints_section = ""
+    if hints:
+        hints_section = (
+            "\nA static pre-scan flagged the following locations. Verify each one and report only real issues; "
+            "also report issues the pre-scan missed:\n" + "\n".join(f"- {hint}" for hint in hints) + "\n"
+        )
+    prompt = f"""
+Analyze the following code diff for potential security vulnerabilities in Python. Focus specifically on identifying issues like command injection, SQL injection, cross-site scripting (XSS), insecure deserialization, improper access control, and use of weak cryptographic algorithms. For each vulnerability found, provide:
+1. The file path (if available in the diff).
+2. The line number where the vulnerability occurs in the new version of the file (use the "@@ -a,b +c,d @@" hunk headers to compute it).
+3. A brief description of the vulnerability type.
+4. A clear explanation of the potential security risk.
+5. A specific suggestion for how to fix the vulnerability.
+
+Format the output as a JSON object with a single key "findings" holding a list of findings. Each finding should be an object with keys: "file_path", "line", "type", "risk", "suggestion". If no vulnerabilities are found, return an empty list.
+
+{hints_section}
+Code Diff:
+```diff
+{diff_content}
+```
+
+JSON Findings:
+"""
+    return prompt
+
+SYSTEM_PROMPT = "You are an expert security code reviewer specializing in Python."
+
+def call_llm_api(prompt, on_delta=None, model=None, system_prompt=SYSTEM_PROMPT,
+                 max_output_tokens=LLM_MAX_OUTPUT_TOKENS, timeout=LLM_TIMEOUT_SECONDS):
+    """Calls the configured LLM API (OpenAI), reserving shared rate limit capacity first.
+
+    With on_delta (and LLM_STREAMING), the completion is streamed and on_delta(text) is
+    called for every piece as it arrives; the full content is still returned at the end.
+    The defaults are the full-review tier; the triage tier passes its own model and limits.
+    Each call is bounded by timeout and the analysis time budget, hedged past the model's
+    p95 latency, and refused fast while the model's circuit is open (see llm_resilience).
+    """
+    openai_client = get_openai_client()
+    if not openai_client:
+        raise ValueError("OpenAI client not initialized. Check API key.")
+
+    model = model or LLM_MODEL_NAME
+    limiter = get_llm_rate_limiter(model)
+    breaker = get_circuit_breaker(model)
+    streaming = LLM_STREAMING and on_delta is not None
+    latency = get_latency_tracker(model, streaming)
+    estimated_tokens = estimate_llm_tokens(prompt, system_prompt, max_output_tokens)
+
+    def attempt(emit, cancelled):
+        started = time.monotonic()
+        response = openai_client.chat.completions.create(
+            **llm_request(prompt, model, system_prompt, max_output_tokens, call_seconds, streaming)
+        )
+        if streaming:
+            # Time to first token is what hedging cares about for streams
+            return _consume_llm_stream(
+                response, emit, limiter, estimated_tokens, model, cancelled,
+                on_first_delta=lambda: latency.observe(time.monotonic() - started),
+            )
+        latency.observe(time.monotonic() - started)
+        return llm_response_content(response, limiter, estimated_tokens, model)
+
+    retries = 0
+    while True:
+        call_seconds = call_timeout(timeout) # Raises LLMDeadlineExceeded once the analysis budget is spent
+        limiter.acquire(estimated_tokens) # Raises LLMCapacityUnavailable rather than waiting too long
+        # Entered last, so nothing can raise between taking the half-open probe and settling it;
+        # a probe that ends without success()/failure() (e.g. rate limited) counts as a failure
+        with breaker.call() as breaker_call: # Raises LLMCircuitOpen (a LLMCapacityUnavailable) while the provider is failing
+            logger.info(f"Sending prompt to LLM model: {model}")
+            try:
+                content, winner = run_hedged(
+                    attempt, call_seconds, hedge_delay(latency), on_delta if streaming else None,
+                    may_hedge=lambda: hedge_allowed(latency, limiter, estimated_tokens, model),
+                )
+                llm_call_succeeded(breaker_call, latency, model, winner)
+                return content
+            except Exception as e:
+                llm_call_failed(e, retries, breaker_call, limiter, model, call_seconds, timeout) # Re-raises unless retryable
+                retries += 1
+
+def _consume_llm_stream(stream, on_delta, limiter, estimated_tokens, model, cancelled=None, on_first_delta=None):
+    """Feeds streamed content to on_delta and returns the accumulated text (None once cancelled)."""
+    accumulated = LLMStream(on_delta, on_first_delta)
+    for event in stream:
+        if cancelled is not None and cancelled.is_set():
+            stream.close()  # Lost the race against a hedged request
+            return None
+        accumulated.feed(event)
+    return accumulated.finish(limiter, estimated_tokens, model)
+
+# --- LLM Call Steps ---
+# The parts of a call that do no I/O, shared by call_llm_api() and its async counterpart
+
+def estimate_llm_tokens(prompt, system_prompt, max_output_tokens):
+    # The provider counts max_tokens against tokens/min up front, so reserve for it too
+    return estimate_tokens(system_prompt) + estimate_tokens(prompt) + max_output_tokens
+
+def llm_request(prompt, model, system_prompt, max_output_tokens, call_seconds, streaming):
+    """The chat.completions.create() arguments of one attempt."""
+    return dict(
+        model=model,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.2, # Lower temperature for more deterministic results
+        max_tokens=max_output_tokens,
+        response_format={"type": "json_object"}, # Request JSON output if model supports it
+        timeout=call_seconds,
+        **({"stream": True, "stream_options": {"include_usage": True}} if streaming else {})
+    )
+
+def llm_response_content(response, limiter, estimated_tokens, model):
+    """Records the token usage of a non-streamed completion and returns its content."""
+    logger.info("Received LLM response.")
+    usage = getattr(response, "usage", None)
+    limiter.record_usage(estimated_tokens, usage.total_tokens if usage else None)
+    record_llm_usage(model, usage)
+    return response.choices[0].message.content
+
+class LLMStream:
+    """Accumulates a streamed completion fed one event at a time, passing each piece of text to on_delta."""
+
+    def __init__(self, on_delta, on_first_delta=None):
+        self.on_delta = on_delta
+        self.on_first_delta = on_first_delta
+        self.parts = []
+        self.usage = None
+        self.finish_reason = None
+
+    def feed(self, event):
+        if getattr(event, "usage", None):
+            self.usage = event.usage  # Sent in a final event without choices
+        if not event.choices:
+            return
+        choice = event.choices[0]
+        self.finish_reason = choice.finish_reason or self.finish_reason
+        text = choice.delta.content if choice.delta else None
+        if text:
+            if not self.parts and self.on_first_delta is not None:
+                self.on_first_delta()
+            self.parts.append(text)
+            self.on_delta(text)
+
+    def finish(self, limiter, estimated_tokens, model):
+        """Records the stream's token usage and returns the accumulated text."""
+        logger.info(f"Received streamed LLM response (finish reason: {self.finish_reason}).")
+        if self.finish_reason == "length":
+            logger.warning("LLM output hit max_tokens; keeping the findings completed before the cut-off.")
+        limiter.record_usage(estimated_tokens, self.usage.total_tokens if self.usage else None)
+        record_llm_usage(model, self.usage)
+        return "".join(self.parts)
+
+def llm_call_succeeded(breaker_call, latency, model, winner):
+    breaker_call.success()
+    latency.record_call(hedged=winner > 0)
+    if winner > 0:
+        record_llm_hedge(model, "won")
+
+def llm_call_failed(error, retries, breaker_call, limiter, model, call_seconds, timeout):
+    """Decides what a failed attempt means: returns when a 429 may be retried in-call, otherwise raises.
+
+    Only provider-side failures (connection errors, 5xx, full-length timeouts) count
+    against the circuit breaker.
+    """
+    from openai import RateLimitError, APIError, APITimeoutError, APIConnectionError, InternalServerError
+    if isinstance(error, RateLimitError):
+        # Pause every worker for as long as the provider asked, then try again
+        retry_after = retry_after_seconds(error, default=min(2 ** retries, 30))
+        limiter.block_for(retry_after)
+        if retries >= LLM_RATE_LIMIT_RETRIES:
+            logger.warning(f"LLM rate limit exceeded: {error}. Retrying task.")
+            raise LLMCapacityUnavailable(retry_after) from error
+        record_retry("llm_rate_limit")
+        return
+    if isinstance(error, (LLMDeadlineExceeded, APITimeoutError)):
+        # A call cut short by the analysis budget says nothing about the provider's health
+        if call_seconds >= timeout:
+            breaker_call.failure()
+        record_llm_failure(model, "deadline" if call_seconds < timeout else "timeout")
+        logger.error(f"LLM call timed out after {call_seconds:.1f}s: {error}")
+    elif isinstance(error, (APIConnectionError, InternalServerError)):
+        breaker_call.failure()
+        record_llm_failure(model, "error")
+        logger.error(f"LLM API error: {error}")
+    elif isinstance(error, APIError):
+        logger.error(f"LLM API error: {error}")
+    else:
+        logger.error(f"Unexpected error calling LLM: {error}", exc_info=error)
+    raise error # Re-raise to trigger Celery retry
+
+def parse_llm_response(response_content):
+    """Parses the JSON response from the LLM."""
+    import json
+    try:
+        # Assuming the LLM returns a JSON string within the content
+        findings_data = json.loads(response_content)
+        # Basic validation
+        if isinstance(findings_data, dict) and "findings" in findings_data and isinstance(findings_data["findings"], list):
+             return findings_data["findings"]
+        elif isinstance(findings_data, list):
+             # If the response is directly the list
+             return findings_data
+        else:
+             logger.warning(f"LLM response JSON structure unexpected: {response_content}")
+             return []
+    except json.JSONDecodeError as e:
+        # Usually a response truncated at max_tokens; keep the findings that were complete
+        findings = iter_findings(response_content)
+        log = logger.warning if findings else logger.error
+        log(f"Failed to parse LLM JSON response ({e}); recovered {len(findings)} complete finding(s).")
+        return findings
+    except Exception as e:
+        logger.error(f"Error processing LLM response: {e}", exc_info=True)
+        return []
+
+def normalize_finding(finding, file_paths):
+    """Validates one parsed finding and fills in what the chunk implies; None if unusable."""
+    if not isinstance(finding, dict) or not (finding.get("type") or finding.get("risk")):
+        return None
+    # A chunk covering a single file lets us fill in a path the LLM left out
+    if not finding.get("file_path") and len(file_paths) == 1:
+        finding["file_path"] = file_paths[0]
+    line = finding.get("line")
+    if isinstance(line, str) and line.strip().isdigit():
+        finding["line"] = int(line)
+    return finding
+
+def cascade_model_key():
+    """Identifies the models behind a result (for the cache): triage decides which hunks get reviewed."""
+    return f"{LLM_MODEL_NAME}+triage:{LLM_TRIAGE_MODEL_NAME}" if LLM_TRIAGE_ENABLED else LLM_MODEL_NAME
+
+def triage_chunk(chunk, cascade_stats=None):
+    """Tier 1 of the cascade: returns the chunk reduced to the hunks worth a full review (None if none).
+
+    Triage fails open: if the triage model times out, errors or answers garbage, every
+    hunk is escalated, as it is while the triage model's circuit is open. Running out of
+    rate limit capacity still retries the task.
+    """
+    hunks = chunk_hunks(chunk)
+    verdicts = None
+    if LLM_TRIAGE_MODEL_NAME == LOCAL_TRIAGE_MODEL:
+        verdicts = local_triage(hunks)
+    else:
+        try:
+            verdicts = parse_triage_response(call_llm_api(**triage_llm_request(hunks)), len(hunks))
+        except Exception as e:
+            triage_failed(chunk, e)
+    return settle_triage(chunk, hunks, verdicts, cascade_stats)
+
+# --- Chunk Steps ---
+# The parts of triaging and reviewing a chunk that do no I/O, shared with async_analysis
+
+def triage_llm_request(hunks):
+    """The call_llm_api() arguments of a chunk's triage request."""
+    return dict(
+        prompt=create_triage_prompt(hunks), model=LLM_TRIAGE_MODEL_NAME, system_prompt=TRIAGE_SYSTEM_PROMPT,
+        max_output_tokens=triage_max_output_tokens(len(hunks)), timeout=LLM_TRIAGE_TIMEOUT_SECONDS,
+    )
+
+def triage_failed(chunk, error):
+    """Logs a triage request that failed open; re-raises running out of rate limit capacity."""
+    if isinstance(error, LLMCapacityUnavailable) and not isinstance(error, LLMCircuitOpen):
+        raise error
+    outcome = "skipped" if isinstance(error, LLMCircuitOpen) else "failed"
+    logger.warning(f"Triage of chunk {chunk.index} {outcome} ({error}); escalating all of its hunks.")
+
+def settle_triage(chunk, hunks, verdicts, cascade_stats=None):
+    """Escalates every hunk when triage produced no verdicts, records them and reduces the chunk."""
+    failed_open = verdicts is None
+    if failed_open:
+        verdicts = [True] * len(hunks)
+    record_triage(verdicts, failed_open)
+    if cascade_stats is not None:
+        cascade_stats.add(verdicts, failed_open)
+    logger.info(f"Triage escalated {sum(verdicts)}/{len(verdicts)} hunk(s) of chunk {chunk.index}.")
+    return reduce_chunk(chunk, hunks, verdicts)
+
+def replay_cached_findings(chunk, cached_findings, on_finding=None):
+    """Records an LLM cache lookup; on a hit, replays the findings to on_finding and returns True."""
+    record_cache_lookup(cached_findings is not None)
+    if cached_findings is None:
+        return False
+    logger.info(f"LLM cache hit for chunk {chunk.index} ({', '.join(chunk.file_paths)}).")
+    for finding in cached_findings if on_finding else ():
+        on_finding(finding)
+    return True
+
+class ChunkReview:
+    """Builds a (triaged) chunk's review prompt and turns the LLM's answer into normalized findings.
+
+    Pass on_delta to the LLM call: streamed findings reach on_finding as they complete.
+    """
+
+    def __init__(self, chunk, on_finding=None):
+        self.chunk = chunk
+        self.on_finding = on_finding
+        self.streamed = []
+        self.parser = FindingsStreamParser()
+
+    def prompt(self):
+        with stage_timer("prompt_build"):
+            prompt, tokens_cut = fit_prompt(create_security_analysis_prompt, self.chunk.text(), self.chunk.hints)
+        record_prompt_tokens_removed("overflow", tokens_cut)
+        return prompt
+
+    def on_delta(self, text):
+        for finding in self.parser.feed(text):
+            finding = normalize_finding(finding, self.chunk.file_paths)
+            if finding is not None:
+                self.streamed.append(finding)
+                if self.on_finding:
+                    self.on_finding(finding)
+
+    def findings(self, content):
+        """The chunk's findings once the LLM call returned content."""
+        if not content:
+            raise ValueError(f"Received empty response from LLM for chunk {self.chunk.index}")
+        if LLM_STREAMING:
+            return self.streamed
+        with stage_timer("response_parse"):
+            findings = [normalize_finding(finding, self.chunk.file_paths) for finding in parse_llm_response(content)]
+            findings = [finding for finding in findings if finding is not None]
+        for finding in findings if self.on_finding else ():
+            self.on_finding(finding)
+        return findings
+
+def analyze_diff_chunk(chunk, on_finding=None, cascade_stats=None):
+    """Runs the prompt -> LLM -> parse pipeline for a single diff chunk, consulting the result cache first.
+
+    on_finding(finding) is called for each finding as soon as it is known - while the
+    response is still streaming - so it can be queued for posting early. With the triage
+    cascade enabled, only the hunks the triage tier flags are sent to LLM_MODEL_NAME.
+    """
+    cache = get_llm_cache()
+    model_key = cascade_model_key()
+    if cache:
+        cached_findings = cache.get(chunk, model_key, PROMPT_VERSION)
+        if replay_cached_findings(chunk, cached_findings, on_finding):
+            return cached_findings
+
+    reviewed = chunk
+    if LLM_TRIAGE_ENABLED:
+        with stage_timer("triage"):
+            reviewed = triage_chunk(chunk, cascade_stats)
+        if reviewed is None:
+            if cache:
+                cache.set(chunk, model_key, PROMPT_VERSION, [])
+            return []
+
+    review = ChunkReview(reviewed, on_finding)
+    prompt = review.prompt()
+    with stage_timer("llm_call"):
+        findings = review.findings(call_llm_api(prompt, on_delta=review.on_delta))
+
+    if cache:
+        cache.set(chunk, model_key, PROMPT_VERSION, findings)
+    return findings
+
+def analyze_diff_chunks(chunks, on_finding=None, cascade_stats=None):
+    """Analyzes diff chunks concurrently and merges their findings into a single list.
+
+    Requests run on a bounded thread pool, so wall time tracks the slowest chunk rather
+    than the total diff size. Any chunk failure is re-raised so the task can retry.
+    """
+    if not chunks:
+        return []
+    max_workers = max(1, min(LLM_MAX_CONCURRENCY, len(chunks)))
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm-chunk") as executor:
+        # map() preserves chunk order, keeping the merged findings deterministic; each chunk
+        # runs in a copy of the caller's context so its token usage is attributed to the PR
+        results = list(executor.map(
+            lambda chunk, context: context.run(analyze_diff_chunk, chunk, on_finding, cascade_stats),
+            chunks, [contextvars.copy_context() for _ in chunks],
+        ))
+    return merge_findings(results)
+
+def prepare_llm_chunks(file_diffs, log_prefix):
+    """Pre-scans, compacts and chunks a parsed diff; returns (chunks, prompt tokens saved by compaction)."""
+    llm_file_diffs = file_diffs
+    if PRESCAN_ENABLED:
+        with stage_timer("prescan"):
+            llm_file_diffs, prescan_stats = prescan_diff(file_diffs)
+        logger.info(f"{log_prefix} Pre-scan kept {prescan_stats['hunks_kept']}/{prescan_stats['hunks']} hunk(s).")
+    # Drop what cannot introduce a vulnerability (distant context, deletion-only hunks,
+    # whitespace churn, oversized literals) before packing, so fewer and smaller prompts result
+    tokens_saved = 0
+    if PROMPT_COMPACTION_ENABLED:
+        with stage_timer("compact"):
+            llm_file_diffs, compaction_stats = compact_diff(llm_file_diffs)
+        tokens_saved = compaction_stats["tokens_saved"]
+        record_prompt_tokens_removed("compaction", tokens_saved)
+        logger.info(
+            f"{log_prefix} Prompt compaction saved ~{tokens_saved} of {compaction_stats.get('tokens_before', 0)} "
+            f"token(s): {compaction_stats}"
+        )
+    with stage_timer("chunk"):
+        chunks = chunk_diff(llm_file_diffs, LLM_CHUNK_TOKEN_BUDGET)
+    logger.info(f"{log_prefix} Split diff into {len(chunks)} chunk(s).")
+    return chunks, tokens_saved
+
+def merge_findings(results):
+    """Merges per-chunk finding lists in chunk order, dropping findings reported twice."""
+    merged, seen = [], set()
+    for findings in results:
+        for finding in findings:
+            key = finding_key(finding)
+            if key in seen:
+                continue
+            seen.add(key)
+            merged.append(finding)
+    return merged
+
+# --- Pipeline Steps ---
+# The decisions of a PR analysis and its blocking steps, shared by run_pr_analysis(), the async
+# pipeline (which runs the blocking ones on threads) and the staged Celery stages
+
+def plan_diff_fetch(previous_state, commit_id, log_prefix):
+    """What to fetch for this head: "unchanged" (already analyzed), "incremental" (the delta
+    since the previously analyzed head, falling back to full) or "full"."""
+    if not previous_state or not commit_id:
+        return "full"
+    if previous_state.get("head_sha") == commit_id:
+        logger.info(f"{log_prefix} Head {commit_id} was already analyzed; skipping.")
+        return "unchanged"
+    return "incremental"
+
+def ingest_diff(diff_spool, log_prefix):
+    """Parses (and closes) a fetched diff spool into filtered FileDiff records."""
+    # Parse straight from the spool, dropping generated/vendored/minified/binary files as they stream by
+    with diff_spool, stage_timer("diff_parse"):
+        file_diffs, ingest_stats = read_file_diffs(diff_spool)
+    logger.info(f"{log_prefix} Ingested diff: {ingest_stats}")
+    return file_diffs
+
+def carried_findings_for(mode, previous_state, file_diffs, commit_id, log_prefix):
+    """Previous findings still valid at this head: on lines an incremental delta did not touch."""
+    if mode != "incremental":
+        return []
+    carried_findings = carry_forward_findings(previous_state.get("findings", []), file_diffs)
+    logger.info(
+        f"{log_prefix} Analyzing delta {previous_state['head_sha'][:7]}...{commit_id[:7]}, "
+        f"carrying forward {len(carried_findings)} finding(s)."
+    )
+    return carried_findings
+
+def early_review_poster(github_token, pr_data, file_diffs, posted_findings):
+    """An EarlyReviewPoster for streamed findings, or None when early reviews are off."""
+    if not (EARLY_REVIEW_ENABLED and LLM_STREAMING):
+        return None
+    return EarlyReviewPoster(
+        github_token, pr_data.get("repo_full_name"), pr_data.get("pr_number"), pr_data.get("pr_head_sha"), file_diffs,
+        should_post=lambda: not is_superseded(pr_data), posted=posted_findings,
+    )
+
+def post_findings(github_token, pr_data, findings, carried_findings, file_diffs, posted_findings, early_poster=None):
+    """Posts the findings as PR review(s), fingerprints them and resolves comments whose finding went away."""
+    repo_full_name = pr_data.get("repo_full_name")
+    pr_number = pr_data.get("pr_number")
+    commit_id = pr_data.get("pr_head_sha")
+    log_prefix = f"PR Analysis - {repo_full_name}# {pr_number}:"
+    if findings:
+        logger.info(f"{log_prefix} Posting {len(findings)} findings to PR...")
+        if early_poster:
+            reviews_posted = early_poster.finish(findings)
+        else:
+            reviews_posted = post_findings_review(
+                github_token, repo_full_name, pr_number, commit_id, findings, file_diffs, posted_findings,
+            )
+        logger.info(f"{log_prefix} Finished posting findings in {reviews_posted} review(s).")
+    else:
+        logger.info(f"{log_prefix} No findings to report.")
+        # Optionally post a "no issues found" comment or status check
+    assign_fingerprints(findings, file_diffs)  # Saved with the state, so carried findings keep them
+    if posted_findings is not None and GITHUB_RESOLVE_STALE_FINDINGS:
+        resolve_stale_findings(
+            github_token, repo_full_name, pr_number, commit_id, posted_findings, carried_findings + findings, file_diffs,
+        )
+
+def analysis_result(mode, findings_count=0, prompt_tokens_saved=None, triage=None):
+    """The task result dict of a finished analysis."""
+    result = {"status": "success", "findings_count": findings_count, "mode": mode}
+    if prompt_tokens_saved is not None:
+        result["prompt_tokens_saved"] = prompt_tokens_saved
+    if triage:
+        result["triage"] = triage
+    return result
+
+def finish_analysis(pr_data, result, open_findings):
+    """Remembers the analyzed head (so the next push only pays for its delta) and records the scan.
+
+    open_findings is every finding open at the head, carried-forward ones included. Returns result.
+    """
+    commit_id = pr_data.get("pr_head_sha")
+    if commit_id:
+        get_pr_state_store().save(pr_data.get("repo_full_name"), pr_data.get("pr_number"), commit_id, open_findings)
+    # Scan history: every finding open at this head, for the dashboard and history queries
+    record_scan_result(pr_data, result, open_findings)
+    return result
+
+# --- Pipeline ---
+
+def run_pr_analysis(pr_data):
+    """Analyzes one PR head end to end and returns the task result dict.
+
+    Raises AnalysisSuperseded once a newer head is pushed; any other exception is left
+    to the caller's retry policy (the Celery task or the Lambda handler).
+    """
+    repo_full_name = pr_data.get("repo_full_name")
+    pr_number = pr_data.get("pr_number")
+    installation_id = pr_data.get("installation_id")
+    commit_id = pr_data.get("pr_head_sha") # Use head SHA for comments
+
+    log_prefix = f"PR Analysis - {repo_full_name}# {pr_number}:"
+    bind_installation(installation_id)
+    bind_time_budget()  # Caps every LLM call of this attempt; a retry starts a fresh budget
+
+    if not installation_id:
+        raise ValueError("Missing installation_id")
+    if not get_openai_client():
+        raise ValueError("OpenAI client not configured.")
+    # A newer push may have arrived while this task sat in the debounce window
+    ensure_not_superseded(repo_full_name, pr_number, commit_id)
+
+    # 1. Get GitHub Token (cached per installation)
+    with stage_timer("token"):
+        github_token = get_github_installation_token(installation_id)
+    if not github_token:
+         raise ValueError("Failed to get GitHub token")
+
+    # 2. Fetch PR Diff - only the delta since the last analyzed head when we have one
+    previous_state = get_pr_state_store().load(repo_full_name, pr_number)
+    plan = plan_diff_fetch(previous_state, commit_id, log_prefix)
+    if plan == "unchanged":
+        return analysis_result("unchanged")
+    diff_spool = None
+    if plan == "incremental":
+        with stage_timer("diff_fetch"):
+            diff_spool = fetch_commit_range_diff(github_token, repo_full_name, previous_state["head_sha"], commit_id)
+    mode = "full" if diff_spool is None else "incremental"
+    if mode == "full":
+        with stage_timer("diff_fetch"):
+            diff_spool = fetch_pr_diff(github_token, repo_full_name, pr_number)
+    file_diffs = ingest_diff(diff_spool, log_prefix)
+    carried_findings = carried_findings_for(mode, previous_state, file_diffs, commit_id, log_prefix)
+    if not file_diffs:
+        logger.info(f"{log_prefix} No analyzable diff content found or fetched.")
+        return finish_analysis(pr_data, analysis_result(mode), carried_findings)
+    logger.info(f"{log_prefix} Fetched PR diff ({mode}).")
+
+    ensure_not_superseded(repo_full_name, pr_number, commit_id)
+
+    # 3. Triage hunks locally so only risky ones reach the LLM, then pack them into
+    #    per-file/per-hunk chunks that fit the prompt budget
+    chunks, tokens_saved = prepare_llm_chunks(file_diffs, log_prefix)
+
+    # 4. Call the LLM for every chunk concurrently and merge the parsed findings; the first
+    #    ones are posted early while later chunks are still streaming
+    # Fingerprints already on the PR (one paginated listing, then cached), so re-runs post only new findings
+    posted_findings = None
+    if FINDING_DEDUPE_ENABLED:
+        posted_findings = load_posted_findings(github_token, repo_full_name, pr_number)
+    early_poster = early_review_poster(github_token, pr_data, file_diffs, posted_findings)
+    cascade_stats = CascadeStats() if LLM_TRIAGE_ENABLED else None
+    findings = analyze_diff_chunks(
+        chunks, on_finding=early_poster.add if early_poster else None, cascade_stats=cascade_stats,
+    )
+    logger.info(f"{log_prefix} Parsed {len(findings)} findings from LLM responses.")
+    if cascade_stats:
+        logger.info(f"{log_prefix} Triage cascade: {cascade_stats.as_dict()}")
+    cache = get_llm_cache()
+    if cache:
+        logger.info(f"{log_prefix} LLM cache stats: {cache.stats}")
+
+    # Don't post findings for a head that is no longer current
+    ensure_not_superseded(repo_full_name, pr_number, commit_id)
+
+    # 5. Post all findings as a single PR review (split only past GitHub's per-review limits)
+    post_findings(github_token, pr_data, findings, carried_findings, file_diffs, posted_findings, early_poster)
+
+    # 6. Remember what was analyzed and record the scan
+    logger.info(f"{log_prefix} Successfully completed analysis.")
+    result = analysis_result(mode, len(findings), tokens_saved, cascade_stats.as_dict() if cascade_stats else None)
+    return finish_analysis(pr_data, result, carried_findings + findings)
@@ -0,0 +1,196 @@
+# worker/artifacts.py
+"""Intermediate results of staged analyses (see staged_analysis.py).
+
+Stages exchange only a run id through Celery; the diff, the chunks and the findings
+live here as zlib-compressed JSON, in Redis (shared by every worker pool) or, without
+Redis, in a local directory (single-host development). Artifacts expire after
+ARTIFACT_TTL_SECONDS, so runs abandoned mid-way clean up after themselves.
+"""
+
+import os
+import json
+import zlib
+import time
+import shutil
+import logging
+import threading
+
+from .diff_chunker import DiffChunk, DiffHunk, FileDiff
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+ARTIFACT_TTL_SECONDS = int(os.getenv("ARTIFACT_TTL_SECONDS", str(24 * 3600)))
+ARTIFACT_DIR = os.getenv("ARTIFACT_DIR", "/tmp/codeguardian_artifacts")
+
+KEY_PREFIX = "codeguardian:artifact:"
+
+class ArtifactMissing(KeyError):
+    """The artifact expired or its run was cleaned up (failed, superseded or finished)."""
+
+# --- Diff Records ---
+
+def hunk_to_dict(hunk):
+    return {
+        "file_path": hunk.file_path, "old_start": hunk.old_start, "old_length": hunk.old_length,
+        "new_start": hunk.new_start, "new_length": hunk.new_length, "section": hunk.section,
+        "lines": hunk.lines, "hints": hunk.hints,
+    }
+
+def hunk_from_dict(data):
+    return DiffHunk(**data)
+
+def file_diff_to_dict(file_diff, hunks=None):
+    hunks = file_diff.hunks if hunks is None else hunks
+    return {
+        "path": file_diff.path, "old_path": file_diff.old_path, "header_lines": file_diff.header_lines,
+        "is_binary": file_diff.is_binary, "hunks": [hunk_to_dict(hunk) for hunk in hunks],
+    }
+
+def file_diff_from_dict(data):
+    data = dict(data)
+    hunks = [hunk_from_dict(hunk) for hunk in data.pop("hunks")]
+    return FileDiff(hunks=hunks, **data)
+
+def chunk_to_dict(chunk):
+    """A chunk with only its own hunks (its FileDiffs would otherwise drag every hunk of the file along)."""
+    return {
+        "index": chunk.index, "token_estimate": chunk.token_estimate,
+        "parts": [file_diff_to_dict(file_diff, hunks) for file_diff, hunks in chunk.parts],
+    }
+
+def chunk_from_dict(data):
+    chunk = DiffChunk(index=data["index"], token_estimate=data["token_estimate"])
+    for part in data["parts"]:
+        file_diff = file_diff_from_dict(part)
+        chunk.parts.append((file_diff, file_diff.hunks))
+    return chunk
+
+# --- Backends ---
+
+class RedisArtifactBackend:
+    name = "redis"
+
+    def __init__(self, redis_url):
+        import redis
+        self.client = redis.Redis.from_url(redis_url, socket_timeout=5, socket_connect_timeout=2)
+        self.client.ping()
+
+    def put(self, run_id, name, blob, ttl):
+        pipe = self.client.pipeline()
+        pipe.set(f"{KEY_PREFIX}{run_id}:{name}", blob, ex=ttl)
+        pipe.sadd(f"{KEY_PREFIX}{run_id}", name)
+        pipe.expire(f"{KEY_PREFIX}{run_id}", ttl)
+        pipe.execute()
+
+    def get(self, run_id, name):
+        return self.client.get(f"{KEY_PREFIX}{run_id}:{name}")
+
+    def delete(self, run_id, name):
+        pipe = self.client.pipeline()
+        pipe.delete(f"{KEY_PREFIX}{run_id}:{name}")
+        pipe.srem(f"{KEY_PREFIX}{run_id}", name)
+        pipe.execute()
+
+    def delete_run(self, run_id):
+        names = self.client.smembers(f"{KEY_PREFIX}{run_id}")
+        keys = [f"{KEY_PREFIX}{run_id}:{name.decode('utf-8')}" for name in names]
+        self.client.delete(f"{KEY_PREFIX}{run_id}", *keys)
+
+class LocalArtifactBackend:
+    """One directory per run; expired runs are swept when a new one is written."""
+
+    name = "local"
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, run_id, name):
+        return os.path.join(self.root, run_id, name)
+
+    def put(self, run_id, name, blob, ttl):
+        path = self._path(run_id, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            self._sweep(ttl)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+        with open(temp_path, "wb") as f:
+            f.write(blob)
+        os.replace(temp_path, path)  # Readers never see a partial artifact
+
+    def _sweep(self, ttl):
+        cutoff = time.time() - ttl
+        for entry in os.scandir(self.root):
+            try:
+                if entry.is_dir() and entry.stat().st_mtime < cutoff:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            except OSError:
+                pass
+
+    def get(self, run_id, name):
+        try:
+            with open(self._path(run_id, name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, run_id, name):
+        try:
+            os.remove(self._path(run_id, name))
+        except FileNotFoundError:
+            pass
+
+    def delete_run(self, run_id):
+        shutil.rmtree(os.path.join(self.root, run_id), ignore_errors=True)
+
+# --- Store ---
+
+class ArtifactStore:
+    """Stores JSON-serializable values per (run, name), compressed."""
+
+    def __init__(self, backend, ttl=ARTIFACT_TTL_SECONDS):
+        self.backend = backend
+        self.ttl = ttl
+
+    def put(self, run_id, name, value):
+        blob = zlib.compress(json.dumps(value, separators=(",", ":")).encode("utf-8"), 6)
+        self.backend.put(run_id, name, blob, self.ttl)
+        return len(blob)
+
+    def get(self, run_id, name):
+        """Returns the stored value; raises ArtifactMissing if there is none."""
+        blob = self.backend.get(run_id, name)
+        if blob is None:
+            raise ArtifactMissing(f"{run_id}/{name}")
+        return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+    def exists(self, run_id, name):
+        return self.backend.get(run_id, name) is not None
+
+    def delete(self, run_id, name):
+        self.backend.delete(run_id, name)
+
+    def delete_run(self, run_id):
+        try:
+            self.backend.delete_run(run_id)
+        except Exception as e:
+            # Expiry removes them eventually
+            logger.warning(f"Failed to delete artifacts of run {run_id} ({self.backend.name}): {e}")
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_artifact_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                try:
+                    backend = RedisArtifactBackend(REDIS_URL)
+                except Exception as e:
+                    logger.warning(f"Redis unavailable for analysis artifacts ({e}); storing them under {ARTIFACT_DIR}.")
+                    backend = LocalArtifactBackend(ARTIFACT_DIR)
+                _store = ArtifactStore(backend)
+    return _store
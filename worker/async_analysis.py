@@ -0,0 +1,312 @@
+# worker/async_analysis.py
+
+import os
+import asyncio
+import logging
+import threading
+
+from openai import AsyncOpenAI
+
+from . import analysis
+from .diff_stream import DiffSpool, spool_diff
+from .llm_cache import get_llm_cache
+from .triage import (
+    LLM_TRIAGE_ENABLED, LLM_TRIAGE_MODEL_NAME, LOCAL_TRIAGE_MODEL, CascadeStats, chunk_hunks, parse_triage_response,
+    local_triage,
+)
+from .pr_state import get_pr_state_store
+from .fingerprints import FINDING_DEDUPE_ENABLED, load_posted_findings
+from .github_client import get_async_github_client, GitHubAPIError, PLACEHOLDER_GITHUB_TOKEN, DIFF_ACCEPT
+from .coalescing import ensure_not_superseded
+from .llm_rate_limiter import get_llm_rate_limiter
+from .llm_resilience import (
+    bind_time_budget, call_timeout, get_circuit_breaker, get_latency_tracker, hedge_allowed, hedge_delay,
+    run_hedged_async,
+)
+from .metrics import stage_timer, bind_installation
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# Per-process limits shared by every PR the event loop is driving
+ASYNC_GITHUB_CONCURRENCY = int(os.getenv("ASYNC_GITHUB_CONCURRENCY", "20"))
+ASYNC_LLM_CONCURRENCY = int(os.getenv("ASYNC_LLM_CONCURRENCY", "16"))
+# Parsing, pre-scanning and chunking are CPU-bound and run on threads; keep them from starving the loop
+ASYNC_CPU_CONCURRENCY = int(os.getenv("ASYNC_CPU_CONCURRENCY", "2"))
+
+# --- Event Loop ---
+
+_loop = None
+_loop_pid = None
+_loop_lock = threading.Lock()
+
+def get_event_loop():
+    """Returns this process's analysis event loop, running on a daemon thread (re-created after fork)."""
+    global _loop, _loop_pid
+    if _loop is None or _loop_pid != os.getpid():
+        with _loop_lock:
+            if _loop is None or _loop_pid != os.getpid():
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="analysis-loop", daemon=True).start()
+                _loop, _loop_pid = loop, os.getpid()
+    return _loop
+
+def run_on_event_loop(coro):
+    """Runs a coroutine on the shared loop and blocks the calling (Celery) thread for its result."""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+class _Stages:
+    """Bounded semaphores per stage, created inside the loop they belong to."""
+
+    def __init__(self):
+        self.github = asyncio.Semaphore(ASYNC_GITHUB_CONCURRENCY)
+        self.llm = asyncio.Semaphore(ASYNC_LLM_CONCURRENCY)
+        self.cpu = asyncio.Semaphore(ASYNC_CPU_CONCURRENCY)
+
+_stages = {}
+_openai_clients = {}
+
+def get_stages():
+    loop = asyncio.get_running_loop()
+    if loop not in _stages:
+        _stages[loop] = _Stages()
+    return _stages[loop]
+
+def get_async_openai_client():
+    """Returns the AsyncOpenAI client for the running loop (None without an API key)."""
+    if not analysis.OPENAI_API_KEY:
+        return None
+    loop = asyncio.get_running_loop()
+    if loop not in _openai_clients:
+        # As in the sync path, 429s are retried through the shared rate limiter, not the SDK
+        _openai_clients[loop] = AsyncOpenAI(api_key=analysis.OPENAI_API_KEY, max_retries=0)
+    return _openai_clients[loop]
+
+async def _in_thread(semaphore, func, *args):
+    async with semaphore:
+        return await asyncio.to_thread(func, *args)
+
+# --- GitHub ---
+
+async def _stream_to_spool(path, token):
+    spool = DiffSpool()
+    try:
+        async for chunk in get_async_github_client().stream(path, token, accept=DIFF_ACCEPT):
+            if not spool.write(chunk):
+                logger.warning(f"Diff exceeds {spool.max_bytes} bytes; analyzing only the first {spool.max_bytes}.")
+                break
+    except BaseException:
+        spool.close()
+        raise
+    return spool
+
+async def fetch_pr_diff_async(token, repo_full_name, pr_number):
+    """Async counterpart of analysis.fetch_pr_diff()."""
+    if token == PLACEHOLDER_GITHUB_TOKEN:
+        logger.info(f"Simulating fetching diff for {repo_full_name}# {pr_number}")
+        return spool_diff([analysis.SIMULATED_PR_DIFF])
+    async with get_stages().github:
+        return await _stream_to_spool(f"/repos/{repo_full_name}/pulls/{pr_number}", token)
+
+async def fetch_commit_range_diff_async(token, repo_full_name, base_sha, head_sha):
+    """Async counterpart of analysis.fetch_commit_range_diff()."""
+    if token == PLACEHOLDER_GITHUB_TOKEN:
+        logger.info(f"Simulating fetching diff for {repo_full_name} {base_sha[:7]}...{head_sha[:7]}")
+        return None
+    path = analysis.compare_path(repo_full_name, base_sha, head_sha)
+    try:
+        async with get_stages().github:
+            compare = await get_async_github_client().get(f"{path}?per_page=1", token)
+            compare.raise_for_status()
+            if not analysis.is_fast_forward(compare.json(), base_sha, head_sha):
+                return None
+            return await _stream_to_spool(path, token)
+    except GitHubAPIError as e:
+        if e.status_code == 404:
+            return None
+        raise
+
+# --- LLM ---
+
+async def call_llm_api_async(prompt, on_delta=None, model=None, system_prompt=None, max_output_tokens=None,
+                             timeout=None):
+    """Async counterpart of analysis.call_llm_api(), with the same rate limiting, 429 handling,
+    deadlines, hedging and circuit breaking (the decisions themselves live in analysis)."""
+    client = get_async_openai_client()
+    if not client:
+        raise ValueError("OpenAI client not initialized. Check API key.")
+
+    model = model or analysis.LLM_MODEL_NAME
+    system_prompt = system_prompt or analysis.SYSTEM_PROMPT
+    max_output_tokens = max_output_tokens or analysis.LLM_MAX_OUTPUT_TOKENS
+    timeout = timeout or analysis.LLM_TIMEOUT_SECONDS
+    limiter = get_llm_rate_limiter(model)
+    breaker = get_circuit_breaker(model)
+    estimated_tokens = analysis.estimate_llm_tokens(prompt, system_prompt, max_output_tokens)
+    streaming = analysis.LLM_STREAMING and on_delta is not None
+    latency = get_latency_tracker(model, streaming)
+
+    async def attempt(emit):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        async with get_stages().llm:
+            response = await client.chat.completions.create(
+                **analysis.llm_request(prompt, model, system_prompt, max_output_tokens, call_seconds, streaming)
+            )
+            if not streaming:
+                latency.observe(loop.time() - started)
+                return analysis.llm_response_content(response, limiter, estimated_tokens, model)
+            stream = analysis.LLMStream(emit, on_first_delta=lambda: latency.observe(loop.time() - started))
+            try:
+                async for event in response:
+                    stream.feed(event)
+            finally:
+                await response.close()  # Cancelled when a hedged request won
+        return stream.finish(limiter, estimated_tokens, model)
+
+    retries = 0
+    while True:
+        call_seconds = call_timeout(timeout)
+        # acquire() may sleep while waiting for capacity and breaker.call() reads Redis; keep both off the loop.
+        # The breaker is entered last, so nothing can raise between taking the half-open probe and settling it
+        await asyncio.to_thread(limiter.acquire, estimated_tokens)
+        with await asyncio.to_thread(breaker.call) as breaker_call:
+            try:
+                content, winner = await run_hedged_async(
+                    attempt, call_seconds, hedge_delay(latency), on_delta if streaming else None,
+                    may_hedge=lambda: hedge_allowed(latency, limiter, estimated_tokens, model),
+                )
+                analysis.llm_call_succeeded(breaker_call, latency, model, winner)
+                return content
+            except Exception as e:
+                analysis.llm_call_failed(e, retries, breaker_call, limiter, model, call_seconds, timeout)
+                retries += 1
+
+async def triage_chunk_async(chunk, cascade_stats=None):
+    """Async counterpart of analysis.triage_chunk()."""
+    hunks = chunk_hunks(chunk)
+    verdicts = None
+    if LLM_TRIAGE_MODEL_NAME == LOCAL_TRIAGE_MODEL:
+        verdicts = local_triage(hunks)
+    else:
+        try:
+            verdicts = parse_triage_response(await call_llm_api_async(**analysis.triage_llm_request(hunks)), len(hunks))
+        except Exception as e:
+            analysis.triage_failed(chunk, e)
+    return analysis.settle_triage(chunk, hunks, verdicts, cascade_stats)
+
+async def analyze_diff_chunk_async(chunk, on_finding=None, cascade_stats=None):
+    """Async counterpart of analysis.analyze_diff_chunk()."""
+    cache = get_llm_cache()
+    model_key = analysis.cascade_model_key()
+    if cache:
+        cached_findings = await asyncio.to_thread(cache.get, chunk, model_key, analysis.PROMPT_VERSION)
+        if analysis.replay_cached_findings(chunk, cached_findings, on_finding):
+            return cached_findings
+
+    reviewed = chunk
+    if LLM_TRIAGE_ENABLED:
+        with stage_timer("triage"):
+            reviewed = await triage_chunk_async(chunk, cascade_stats)
+        if reviewed is None:
+            if cache:
+                await asyncio.to_thread(cache.set, chunk, model_key, analysis.PROMPT_VERSION, [])
+            return []
+
+    review = analysis.ChunkReview(reviewed, on_finding)
+    prompt = review.prompt()
+    with stage_timer("llm_call"):
+        findings = review.findings(await call_llm_api_async(prompt, on_delta=review.on_delta))
+
+    if cache:
+        await asyncio.to_thread(cache.set, chunk, model_key, analysis.PROMPT_VERSION, findings)
+    return findings
+
+async def analyze_diff_chunks_async(chunks, on_finding=None, cascade_stats=None):
+    """Analyzes all chunks concurrently (bounded by the shared LLM semaphore) and merges findings."""
+    results = await asyncio.gather(*(analyze_diff_chunk_async(chunk, on_finding, cascade_stats) for chunk in chunks))
+    return analysis.merge_findings(results)
+
+# --- Analysis ---
+
+async def analyze_pull_request_async(pr_data):
+    """The analyze_pull_request pipeline on the event loop; returns the same result dicts and
+    raises the same exceptions, so the Celery task keeps its contract and retry handling.
+
+    The steps and decisions are analysis.run_pr_analysis()'s; only the I/O is awaited here.
+    """
+    repo_full_name = pr_data.get("repo_full_name")
+    pr_number = pr_data.get("pr_number")
+    installation_id = pr_data.get("installation_id")
+    commit_id = pr_data.get("pr_head_sha")
+    log_prefix = f"PR Analysis - {repo_full_name}# {pr_number}:"
+    stages = get_stages()
+    bind_installation(installation_id)  # Chunk tasks and to_thread() calls inherit this context
+    bind_time_budget()
+
+    if not installation_id:
+        raise ValueError("Missing installation_id")
+    if not get_async_openai_client():
+        raise ValueError("OpenAI client not configured.")
+    # Redis- and SQLite-backed helpers are synchronous; run them on threads
+    await asyncio.to_thread(ensure_not_superseded, repo_full_name, pr_number, commit_id)
+
+    # 1. GitHub token (cached per installation)
+    with stage_timer("token"):
+        github_token = await _in_thread(stages.github, analysis.get_github_installation_token, installation_id)
+    if not github_token:
+        raise ValueError("Failed to get GitHub token")
+
+    # 2. Diff - only the delta since the last analyzed head when we have one
+    previous_state = await asyncio.to_thread(get_pr_state_store().load, repo_full_name, pr_number)
+    plan = analysis.plan_diff_fetch(previous_state, commit_id, log_prefix)
+    if plan == "unchanged":
+        return analysis.analysis_result("unchanged")
+    diff_spool = None
+    if plan == "incremental":
+        with stage_timer("diff_fetch"):
+            diff_spool = await fetch_commit_range_diff_async(
+                github_token, repo_full_name, previous_state["head_sha"], commit_id
+            )
+    mode = "full" if diff_spool is None else "incremental"
+    if mode == "full":
+        with stage_timer("diff_fetch"):
+            diff_spool = await fetch_pr_diff_async(github_token, repo_full_name, pr_number)
+    file_diffs = await _in_thread(stages.cpu, analysis.ingest_diff, diff_spool, log_prefix)
+    carried_findings = analysis.carried_findings_for(mode, previous_state, file_diffs, commit_id, log_prefix)
+    if not file_diffs:
+        logger.info(f"{log_prefix} No analyzable diff content found or fetched.")
+        return await asyncio.to_thread(analysis.finish_analysis, pr_data, analysis.analysis_result(mode), carried_findings)
+
+    await asyncio.to_thread(ensure_not_superseded, repo_full_name, pr_number, commit_id)
+
+    # 3. Pre-scan and chunk
+    chunks, tokens_saved = await _in_thread(stages.cpu, analysis.prepare_llm_chunks, file_diffs, log_prefix)
+
+    # 4. LLM
+    posted_findings = None
+    if FINDING_DEDUPE_ENABLED:
+        posted_findings = await _in_thread(
+            stages.github, load_posted_findings, github_token, repo_full_name, pr_number,
+        )
+    early_poster = analysis.early_review_poster(github_token, pr_data, file_diffs, posted_findings)
+    cascade_stats = CascadeStats() if LLM_TRIAGE_ENABLED else None
+    findings = await analyze_diff_chunks_async(
+        chunks, on_finding=early_poster.add if early_poster else None, cascade_stats=cascade_stats,
+    )
+    logger.info(f"{log_prefix} Parsed {len(findings)} findings from LLM responses.")
+    if cascade_stats:
+        logger.info(f"{log_prefix} Triage cascade: {cascade_stats.as_dict()}")
+
+    await asyncio.to_thread(ensure_not_superseded, repo_full_name, pr_number, commit_id)
+
+    # 5. Post
+    await _in_thread(
+        stages.github, analysis.post_findings,
+        github_token, pr_data, findings, carried_findings, file_diffs, posted_findings, early_poster,
+    )
+
+    # 6. State and scan history
+    logger.info(f"{log_prefix} Successfully completed analysis.")
+    result = analysis.analysis_result(mode, len(findings), tokens_saved, cascade_stats.as_dict() if cascade_stats else None)
+    return await asyncio.to_thread(analysis.finish_analysis, pr_data, result, carried_findings + findings)
@@ -0,0 +1,470 @@
+# worker/baseline_scan.py
+"""Full-repository baseline scans, run when the App is installed on a repository.
+
+    prepare (fetch the archive once, shard the Python files by size)
+    -> chord[scan shard ... (one LLM batch each)] -> finalize (record in the findings store)
+
+Every file is presented to the model as a newly added file, so the PR pipeline's
+pre-scan, chunking, prompt and finding parsing apply unchanged. Shards go through an
+asynchronous batch LLM mode (the OpenAI Batch API, or a local static stand-in for
+development and tests) rather than the synchronous API, so a multi-hour scan uses
+none of the rate limit capacity PR analyses reserve. The tasks run on their own queue
+(analysis.baseline) for the same reason.
+
+All progress is checkpointed in the artifact store under a run id derived from the
+repository and head SHA: the shards, each shard's submitted batch id and each shard's
+findings. Re-running the scan for the same head resumes from there: finished shards
+are skipped and submitted batches are polled rather than resubmitted.
+"""
+
+import io
+import os
+import re
+import json
+import time
+import uuid
+import zlib
+import tarfile
+import logging
+import tempfile
+
+from . import analysis
+from .analysis import (
+    get_github_installation_token, create_security_analysis_prompt, parse_llm_response, normalize_finding,
+    merge_findings, SYSTEM_PROMPT,
+)
+from .artifacts import ArtifactStore, ArtifactMissing, get_artifact_store
+from .diff_chunker import DiffHunk, FileDiff, chunk_diff, parse_unified_diff
+from .diff_stream import path_skip_reason
+from .prescan import prescan_diff, scan_hunk, skip_reason as prescan_skip_reason, PRESCAN_ENABLED
+from .prompt_compaction import fit_prompt
+from .fingerprints import assign_fingerprints
+from .findings_store import record_scan_result
+from .github_client import get_github_client, PLACEHOLDER_GITHUB_TOKEN
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# "openai" (Batch API), "local" (static stand-in, no LLM) or "auto" (openai when an API key is configured)
+BASELINE_BATCH_BACKEND = os.getenv("BASELINE_BATCH_BACKEND", "auto").lower()
+BASELINE_MODEL_NAME = os.getenv("BASELINE_MODEL_NAME", analysis.LLM_MODEL_NAME)
+BASELINE_BATCH_COMPLETION_WINDOW = os.getenv("BASELINE_BATCH_COMPLETION_WINDOW", "24h")
+BASELINE_BATCH_POLL_SECONDS = int(os.getenv("BASELINE_BATCH_POLL_SECONDS", "60"))
+# Source bytes per shard (one shard = one task = one LLM batch)
+BASELINE_SHARD_BYTES = int(os.getenv("BASELINE_SHARD_BYTES", str(2 * 1024 * 1024)))
+# Larger Python files are almost always generated
+BASELINE_MAX_FILE_BYTES = int(os.getenv("BASELINE_MAX_FILE_BYTES", str(512 * 1024)))
+BASELINE_MAX_ARCHIVE_BYTES = int(os.getenv("BASELINE_MAX_ARCHIVE_BYTES", str(2 * 1024 * 1024 * 1024)))
+# Checkpoints must outlive the batch completion window plus a resume
+BASELINE_TTL_SECONDS = int(os.getenv("BASELINE_TTL_SECONDS", str(7 * 24 * 3600)))
+
+MANIFEST = "manifest"
+COMPLETED = "completed"
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+# Source returned when GitHub calls are simulated (no GitHub App configured)
+SIMULATED_HEAD_SHA = "0" * 40
+SIMULATED_REPO_FILES = {
+    "app/commands.py": (
+        "import os\n\n"
+        "def execute_command(user_input):\n"
+        "    # Potential command injection vulnerability\n"
+        "    os.system(f\"echo User input: {user_input}\")\n"
+    ),
+}
+
+class BatchFailed(Exception):
+    """The batch failed, expired or was cancelled; its shard is resubmitted."""
+
+def _shard_name(index):
+    return f"shard_{index}"
+
+def _shard_batch_name(index):
+    return f"shard_{index}_batch"
+
+def _shard_findings_name(index):
+    return f"shard_{index}_findings"
+
+def baseline_run_id(repo_full_name, head_sha):
+    """Deterministic, so a repeated trigger for the same head resumes the same run."""
+    return f"baseline-{repo_full_name.replace('/', '--')}-{head_sha[:12]}"
+
+_store = None
+
+def get_baseline_store():
+    """The artifact store with a TTL long enough for batches and resumes."""
+    global _store
+    if _store is None:
+        _store = ArtifactStore(get_artifact_store().backend, ttl=BASELINE_TTL_SECONDS)
+    return _store
+
+# --- Batch Backends ---
+
+def chat_request_body(prompt):
+    """The same request the synchronous full-review call sends."""
+    return {
+        "model": BASELINE_MODEL_NAME,
+        "messages": [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": prompt}],
+        "temperature": 0.2,
+        "max_tokens": analysis.LLM_MAX_OUTPUT_TOKENS,
+        "response_format": {"type": "json_object"},
+    }
+
+class OpenAIBatchBackend:
+    """Submits requests as one OpenAI batch (JSONL input file) and collects its output file."""
+
+    name = "openai"
+
+    def __init__(self, client):
+        self.client = client
+
+    def submit(self, requests, metadata):
+        lines = [
+            json.dumps({"custom_id": request["custom_id"], "method": "POST", "url": BATCH_ENDPOINT, "body": request["body"]})
+            for request in requests
+        ]
+        input_file = self.client.files.create(
+            file=("baseline.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch",
+        )
+        batch = self.client.batches.create(
+            input_file_id=input_file.id, endpoint=BATCH_ENDPOINT,
+            completion_window=BASELINE_BATCH_COMPLETION_WINDOW, metadata=metadata,
+        )
+        return batch.id
+
+    def poll(self, batch_id):
+        """None while the batch runs; {custom_id: content or None} once it completed."""
+        batch = self.client.batches.retrieve(batch_id)
+        if batch.status in ("failed", "expired", "cancelling", "cancelled"):
+            raise BatchFailed(f"Batch {batch_id} {batch.status}")
+        if batch.status != "completed":
+            return None
+        results = {}
+        if batch.output_file_id:
+            for line in self.client.files.content(batch.output_file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                response = record.get("response") or {}
+                content = None
+                if response.get("status_code") == 200:
+                    content = response["body"]["choices"][0]["message"]["content"]
+                results[record["custom_id"]] = content
+        return results
+
+# A pre-scan hint of a single line, e.g. "line 12: command execution (os.system/os.popen)"
+HINT_RE = re.compile(r"^line (\d+): (.+)$")
+
+def static_review(body):
+    """Answers a review request from the static pre-scan alone: one finding per flagged line."""
+    prompt = body["messages"][-1]["content"]
+    diff_text = prompt.split("```diff\n", 1)[-1].rsplit("\n```", 1)[0]
+    findings = []
+    for file_diff in parse_unified_diff(diff_text):
+        for hunk in file_diff.hunks:
+            for hint in scan_hunk(hunk).hints:
+                match = HINT_RE.match(hint)
+                if match:
+                    findings.append({
+                        "file_path": file_diff.path, "line": int(match.group(1)), "type": match.group(2),
+                        "risk": "Flagged by the static pre-scan.",
+                        "suggestion": "Review this call and make sure untrusted input cannot reach it.",
+                    })
+    return json.dumps({"findings": findings})
+
+class LocalBatchBackend:
+    """Stand-in for development and tests: batches complete on their first poll, answered by static_review."""
+
+    name = "local"
+
+    def __init__(self, store, responder=static_review):
+        self.store = store
+        self.responder = responder
+
+    def submit(self, requests, metadata):
+        batch_id = f"local-{uuid.uuid4().hex}"
+        self.store.put("baseline-batches", batch_id, requests)
+        return batch_id
+
+    def poll(self, batch_id):
+        try:
+            requests = self.store.get("baseline-batches", batch_id)
+        except ArtifactMissing:
+            raise BatchFailed(f"Batch {batch_id} expired")
+        results = {request["custom_id"]: self.responder(request["body"]) for request in requests}
+        self.store.delete("baseline-batches", batch_id)
+        return results
+
+def get_batch_backend():
+    use_openai = BASELINE_BATCH_BACKEND == "openai" or (BASELINE_BATCH_BACKEND == "auto" and analysis.OPENAI_API_KEY)
+    if use_openai:
+        client = analysis.get_openai_client()
+        if not client:
+            raise ValueError("OpenAI client not configured.")
+        return OpenAIBatchBackend(client)
+    return LocalBatchBackend(get_baseline_store())
+
+# --- Repository Archive ---
+
+def resolve_head(token, repo_full_name):
+    """Returns the SHA at the head of the repository's default branch."""
+    if token == PLACEHOLDER_GITHUB_TOKEN:
+        return SIMULATED_HEAD_SHA
+    client = get_github_client()
+    response = client.get(f"/repos/{repo_full_name}", token)
+    response.raise_for_status()
+    branch = response.json()["default_branch"]
+    response = client.get(f"/repos/{repo_full_name}/commits/{branch}", token)
+    response.raise_for_status()
+    return response.json()["sha"]
+
+def _simulated_archive(repo_full_name):
+    buffer = io.BytesIO()
+    top = f"{repo_full_name.replace('/', '-')}-{SIMULATED_HEAD_SHA[:7]}"
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for path, source in SIMULATED_REPO_FILES.items():
+            data = source.encode("utf-8")
+            info = tarfile.TarInfo(f"{top}/{path}")
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return [buffer.getvalue()]
+
+def download_archive(token, repo_full_name, head_sha, max_bytes=BASELINE_MAX_ARCHIVE_BYTES, stats=None):
+    """Downloads the tarball of head_sha once into an anonymous temporary file (at most max_bytes).
+
+    Sets stats["truncated"] when the archive was cut at max_bytes.
+    """
+    stats = stats if stats is not None else {}
+    if token == PLACEHOLDER_GITHUB_TOKEN:
+        logger.info(f"Simulating fetching the archive of {repo_full_name}")
+        chunks = _simulated_archive(repo_full_name)
+    else:
+        chunks = get_github_client().stream(f"/repos/{repo_full_name}/tarball/{head_sha}", token)
+    archive = tempfile.TemporaryFile()
+    written = 0
+    try:
+        for chunk in chunks:
+            if written + len(chunk) > max_bytes:
+                logger.warning(f"Archive of {repo_full_name} exceeds {max_bytes} bytes; scanning only the first {max_bytes}.")
+                archive.write(chunk[:max_bytes - written])
+                stats["truncated"] = True
+                break
+            archive.write(chunk)
+            written += len(chunk)
+    except BaseException:
+        archive.close()
+        raise
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+    archive.seek(0)
+    return archive
+
+def iter_python_files(archive, max_file_bytes=BASELINE_MAX_FILE_BYTES, stats=None):
+    """Yields (path, source) for the analyzable Python files of a tarball, streaming through it once."""
+    stats = stats if stats is not None else {}
+    try:
+        with tarfile.open(fileobj=archive, mode="r|gz") as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                # GitHub tarballs put everything under one "<owner>-<repo>-<sha>/" directory
+                path = member.name.split("/", 1)[1] if "/" in member.name else member.name
+                if path_skip_reason(path) or prescan_skip_reason(path):
+                    continue
+                if member.size > max_file_bytes:
+                    stats["files_too_large"] = stats.get("files_too_large", 0) + 1
+                    continue
+                source = tar.extractfile(member).read().decode("utf-8", errors="replace")
+                if source.strip():
+                    yield path, source
+    except (tarfile.ReadError, EOFError, zlib.error) as e:
+        # A truncated download still yields every file before the cut
+        logger.warning(f"Stopped reading a truncated archive: {e}")
+        stats["truncated"] = True
+
+def source_file_diff(path, source):
+    """The whole file as an added-file diff, so new-side line numbers are file line numbers."""
+    lines = source.splitlines()
+    hunk = DiffHunk(
+        file_path=path, old_start=0, old_length=0, new_start=1, new_length=len(lines),
+        lines=[f"+{line}" for line in lines],
+    )
+    return FileDiff(
+        path=path, old_path=None, hunks=[hunk],
+        header_lines=[f"diff --git a/{path} b/{path}", "new file mode 100644", "--- /dev/null", f"+++ b/{path}"],
+    )
+
+# --- Stage 1: Prepare ---
+
+def prepare_stage(installation_id, repo_full_name):
+    """Fetches and shards the repository unless its current head was already prepared.
+
+    Returns (run_id, manifest, completed): completed is True when this head's baseline
+    already finished, in which case there is nothing to launch.
+    """
+    if not installation_id:
+        raise ValueError("Missing installation_id")
+    github_token = get_github_installation_token(installation_id)
+    if not github_token:
+        raise ValueError("Failed to get GitHub token")
+    head_sha = resolve_head(github_token, repo_full_name)
+    run_id = baseline_run_id(repo_full_name, head_sha)
+    store = get_baseline_store()
+    if store.exists(run_id, COMPLETED):
+        return run_id, store.get(run_id, COMPLETED), True
+    try:
+        manifest = store.get(run_id, MANIFEST)
+        logger.info(f"Baseline {run_id}: resuming ({manifest['shard_count']} shard(s)).")
+        return run_id, manifest, False
+    except ArtifactMissing:
+        pass
+
+    # Files are packed into shards in archive order (keeping packages together), each shard closed
+    # once it holds BASELINE_SHARD_BYTES, so only one shard is ever held in memory
+    stats = {"files": 0, "source_bytes": 0, "truncated": False}
+    shard, shard_bytes, shard_count = [], 0, 0
+    with download_archive(github_token, repo_full_name, head_sha, stats=stats) as archive:
+        for path, source in iter_python_files(archive, stats=stats):
+            stats["files"] += 1
+            stats["source_bytes"] += len(source)
+            shard.append({"path": path, "source": source})
+            shard_bytes += len(source)
+            if shard_bytes >= BASELINE_SHARD_BYTES:
+                store.put(run_id, _shard_name(shard_count), {"files": shard})
+                shard, shard_bytes, shard_count = [], 0, shard_count + 1
+    if shard:
+        store.put(run_id, _shard_name(shard_count), {"files": shard})
+        shard_count += 1
+
+    # The manifest last: a run with a manifest is completely prepared
+    manifest = {
+        "installation_id": installation_id, "repo_full_name": repo_full_name, "head_sha": head_sha,
+        "shard_count": shard_count, "prepared_at": time.time(), **stats,
+    }
+    store.put(run_id, MANIFEST, manifest)
+    logger.info(
+        f"Baseline {run_id}: sharded {stats['files']} Python file(s) ({stats['source_bytes']} bytes) "
+        f"into {shard_count} shard(s)."
+    )
+    return run_id, manifest, False
+
+# --- Stage 2: Scan Shards ---
+
+def scan_shard_stage(run_id, index):
+    """Advances one shard by a step: submit its batch, or poll it and store the findings.
+
+    Returns a dict whose status is "pending" while the batch runs (the task polls again
+    later) and "success" once the shard's findings are checkpointed.
+    """
+    store = get_baseline_store()
+    if store.exists(run_id, _shard_findings_name(index)):
+        return {"status": "success", "shard": index, "cached": True}
+    store.get(run_id, MANIFEST)  # Raises ArtifactMissing once the run is gone
+    backend = get_batch_backend()
+    file_diffs = [source_file_diff(file["path"], file["source"]) for file in store.get(run_id, _shard_name(index))["files"]]
+
+    try:
+        submitted = store.get(run_id, _shard_batch_name(index))
+    except ArtifactMissing:
+        submitted = None
+    if submitted is not None and submitted["backend"] != backend.name:
+        submitted = None  # BASELINE_BATCH_BACKEND changed between attempts
+
+    if submitted is None:
+        llm_file_diffs = prescan_diff(file_diffs)[0] if PRESCAN_ENABLED else file_diffs
+        chunks = chunk_diff(llm_file_diffs, analysis.LLM_CHUNK_TOKEN_BUDGET)
+        if not chunks:
+            store.put(run_id, _shard_findings_name(index), {"findings": [], "failed_requests": 0})
+            return {"status": "success", "shard": index, "findings_count": 0}
+        requests, chunk_files = [], {}
+        for chunk in chunks:
+            custom_id = f"{index}-{chunk.index}"
+            prompt, _ = fit_prompt(create_security_analysis_prompt, chunk.text(), chunk.hints)
+            requests.append({"custom_id": custom_id, "body": chat_request_body(prompt)})
+            chunk_files[custom_id] = chunk.file_paths
+        batch_id = backend.submit(requests, {"run_id": run_id, "shard": str(index)})
+        store.put(run_id, _shard_batch_name(index), {
+            "batch_id": batch_id, "backend": backend.name, "chunk_files": chunk_files, "submitted_at": time.time(),
+        })
+        logger.info(f"Baseline {run_id}: submitted shard {index} as {backend.name} batch {batch_id} ({len(requests)} request(s)).")
+        return {"status": "pending", "shard": index, "batch_id": batch_id}
+
+    try:
+        results = backend.poll(submitted["batch_id"])
+    except BatchFailed as e:
+        logger.warning(f"Baseline {run_id}: {e}; resubmitting shard {index}.")
+        store.delete(run_id, _shard_batch_name(index))
+        return {"status": "pending", "shard": index, "batch_id": None}
+    if results is None:
+        return {"status": "pending", "shard": index, "batch_id": submitted["batch_id"]}
+
+    findings, failed = [], 0
+    for custom_id, file_paths in submitted["chunk_files"].items():
+        content = results.get(custom_id)
+        if not content:
+            failed += 1
+            continue
+        for finding in parse_llm_response(content):
+            finding = normalize_finding(finding, file_paths)
+            if finding is not None:
+                findings.append(finding)
+    if failed:
+        logger.warning(f"Baseline {run_id}: {failed} request(s) of shard {index} returned no result.")
+    assign_fingerprints(findings, file_diffs)
+    store.put(run_id, _shard_findings_name(index), {"findings": findings, "failed_requests": failed})
+    return {"status": "success", "shard": index, "findings_count": len(findings)}
+
+# --- Stage 3: Finalize ---
+
+def finalize_stage(run_id):
+    """Records the baseline in the findings store once every shard is done.
+
+    A shard that gave up leaves the run in place (status "partial"), so triggering the
+    scan again for the same head rescans only that shard. A truncated archive records its
+    findings as a "partial" scan but is never marked completed, so the next trigger
+    downloads and scans the head again.
+    """
+    store = get_baseline_store()
+    if store.exists(run_id, COMPLETED):
+        return dict(store.get(run_id, COMPLETED), status="success", cached=True)
+    manifest = store.get(run_id, MANIFEST)
+    results, missing, failed_requests = [], [], 0
+    for index in range(manifest["shard_count"]):
+        try:
+            stored = store.get(run_id, _shard_findings_name(index))
+        except ArtifactMissing:
+            missing.append(index)
+            continue
+        results.append(stored["findings"])
+        failed_requests += stored["failed_requests"]
+    if missing:
+        logger.error(f"Baseline {run_id}: shard(s) {missing} did not finish; keeping the run for a resume.")
+        return {"status": "partial", "missing_shards": missing}
+
+    findings = merge_findings(results)
+    truncated = manifest.get("truncated", False)
+    status = "partial" if truncated else "success"
+    scan = {
+        "installation_id": manifest["installation_id"], "repo_full_name": manifest["repo_full_name"],
+        "pr_number": None, "pr_head_sha": manifest["head_sha"],
+    }
+    result = {"status": status, "findings_count": len(findings), "mode": "baseline", "truncated": truncated}
+    record_scan_result(scan, result, findings)
+    summary = {
+        "head_sha": manifest["head_sha"], "files": manifest["files"], "shards": manifest["shard_count"],
+        "findings_count": len(findings), "failed_requests": failed_requests, "truncated": truncated,
+        "completed_at": time.time(),
+    }
+    store.delete_run(run_id)
+    if truncated:
+        # The shards only cover the archive up to the cut; a resume has to start from a fresh download
+        logger.warning(
+            f"Baseline {run_id}: archive was truncated; recorded {len(findings)} finding(s) from "
+            f"{manifest['files']} file(s) as partial."
+        )
+        return dict(summary, status="partial", mode="baseline")
+    store.put(run_id, COMPLETED, summary)
+    logger.info(f"Baseline {run_id}: recorded {len(findings)} finding(s) from {manifest['files']} file(s).")
+    return dict(summary, status="success", mode="baseline")
@@ -2,6 +2,7 @@
 
 import os
 from celery import Celery
+from kombu import Queue
 from dotenv import load_dotenv
 
 # Load environment variables from .env file for local development
@@ -19,17 +20,54 @@ app = Celery(
     include=["worker.tasks"]  # List of modules to import when the worker starts
 )
 
+# Priority lanes; names match worker/scheduling.py (not imported here to keep this module light)
+ANALYSIS_QUEUES = ("analysis.high", "analysis.default", "analysis.low")
+# Staged pipeline (ANALYSIS_MODE=staged): the fetch stage runs on the lanes above, later stages on their
+# own queues so each gets its own worker pool, e.g. for the I/O-bound LLM stage:
+# celery -A worker.celery_app worker -Q analysis.llm -P threads -c 32
+# and one small pool for the rest: celery -A worker.celery_app worker -Q analysis.aggregate,analysis.post -c 4
+LLM_STAGE_QUEUE = "analysis.llm"
+AGGREGATE_STAGE_QUEUE = "analysis.aggregate"
+POST_STAGE_QUEUE = "analysis.post"
+STAGE_QUEUES = (LLM_STAGE_QUEUE, AGGREGATE_STAGE_QUEUE, POST_STAGE_QUEUE)
+# Repository baseline scans (baseline_scan.py) run on their own small pool, so they never hold a PR worker:
+# celery -A worker.celery_app worker -Q analysis.baseline -c 2
+BASELINE_QUEUE = "analysis.baseline"
+
 app.conf.update(
     task_serializer="json",
     accept_content=["json"],  # Ignore other content
     result_serializer="json",
     timezone="UTC",
     enable_utc=True,
+    task_queues=[Queue(name) for name in ANALYSIS_QUEUES + STAGE_QUEUES + (BASELINE_QUEUE,)],
+    task_default_queue="analysis.default",
+    task_routes={
+        "worker.tasks.analyze_chunk": {"queue": LLM_STAGE_QUEUE},
+        "worker.tasks.aggregate_findings": {"queue": AGGREGATE_STAGE_QUEUE},
+        "worker.tasks.post_findings": {"queue": POST_STAGE_QUEUE},
+        "worker.tasks.scan_repository_baseline": {"queue": BASELINE_QUEUE},
+        "worker.tasks.scan_baseline_shard": {"queue": BASELINE_QUEUE},
+        "worker.tasks.finalize_baseline": {"queue": BASELINE_QUEUE},
+    },
+    # Drain lanes strictly in the order the worker lists them (-Q analysis.high,analysis.default,analysis.low)
+    broker_transport_options={"queue_order_strategy": "priority"},
+    # Reserve one task at a time so priorities and per-installation caps apply to what runs next
+    worker_prefetch_multiplier=1,
+    # Fair-share dispatcher: moves debounced, per-installation queued work into the lanes
+    # Command: celery -A worker.celery_app beat --loglevel=info
+    beat_schedule={
+        "dispatch-pending-analyses": {
+            "task": "worker.tasks.dispatch_pending_analyses",
+            "schedule": float(os.getenv("DISPATCH_INTERVAL_SECONDS", "2")),
+            "options": {"queue": "analysis.high", "expires": 10},
+        },
+    },
     # Add other Celery configurations as needed
 )
 
 if __name__ == "__main__":
     # This allows running the worker directly for development
-    # Command: celery -A worker.celery_app worker --loglevel=info
+    # Command: celery -A worker.celery_app worker -Q analysis.high,analysis.default,analysis.low --loglevel=info
     app.start()
 
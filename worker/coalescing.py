@@ -0,0 +1,133 @@
+# worker/coalescing.py
+
+import os
+import time
+import uuid
+import logging
+import threading
+
+from .scheduling import submit_analysis
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Analyses start this many seconds after the webhook; newer pushes inside the window replace older ones
+COALESCE_WINDOW_SECONDS = int(os.getenv("COALESCE_WINDOW_SECONDS", "10"))
+# GitHub redelivers with the same X-GitHub-Delivery ID; remember IDs for this long
+DELIVERY_DEDUPE_TTL_SECONDS = int(os.getenv("DELIVERY_DEDUPE_TTL_SECONDS", str(24 * 3600)))
+LATEST_HEAD_TTL_SECONDS = int(os.getenv("LATEST_HEAD_TTL_SECONDS", str(24 * 3600)))
+# After a failed connection attempt, wait this long before trying Redis again
+REDIS_RETRY_SECONDS = 30
+
+DELIVERY_KEY_PREFIX = "codeguardian:delivery:"
+LATEST_HEAD_KEY_PREFIX = "codeguardian:pr_latest_head:"
+LATEST_TASK_KEY_PREFIX = "codeguardian:pr_latest_task:"
+
+class AnalysisSuperseded(Exception):
+    """Raised between stages when a newer head SHA has been pushed for the same PR."""
+
+_redis = None
+_redis_retry_at = 0.0
+_redis_lock = threading.Lock()
+
+def get_redis():
+    """Returns a shared Redis client, or None if Redis is unreachable (coalescing is then skipped)."""
+    global _redis, _redis_retry_at
+    if _redis is None and time.time() >= _redis_retry_at:
+        with _redis_lock:
+            if _redis is None and time.time() >= _redis_retry_at:
+                try:
+                    import redis
+                    client = redis.Redis.from_url(REDIS_URL, socket_timeout=2, socket_connect_timeout=2)
+                    client.ping()
+                    _redis = client
+                except Exception as e:
+                    logger.warning(f"Redis unavailable for webhook coalescing: {e}")
+                    _redis_retry_at = time.time() + REDIS_RETRY_SECONDS
+    return _redis
+
+def _pr_key(repo_full_name, pr_number):
+    return f"{repo_full_name}#{pr_number}"
+
+# --- Webhook Side ---
+
+def claim_delivery(delivery_id):
+    """Returns False if this X-GitHub-Delivery ID was already processed (a redelivery)."""
+    client = get_redis()
+    if client is None or not delivery_id:
+        return True
+    try:
+        return bool(client.set(DELIVERY_KEY_PREFIX + delivery_id, 1, nx=True, ex=DELIVERY_DEDUPE_TTL_SECONDS))
+    except Exception as e:
+        logger.warning(f"Failed to record delivery {delivery_id}: {e}")
+        return True
+
+def release_delivery(delivery_id):
+    """Forgets a delivery that could not be enqueued, so a manual redelivery is processed."""
+    client = get_redis()
+    if client is None or not delivery_id:
+        return
+    try:
+        client.delete(DELIVERY_KEY_PREFIX + delivery_id)
+    except Exception as e:
+        logger.warning(f"Failed to release delivery {delivery_id}: {e}")
+
+def schedule_coalesced_analysis(task, task_data):
+    """Enqueues the analysis after the debounce window, replacing any pending analysis of an older head.
+
+    The newest head SHA and its task ID are swapped in atomically; the previous task is
+    revoked (and dropped by the dispatcher if it has not started) and, if already running,
+    notices the newer head at its next stage boundary and stops.
+    """
+    client = get_redis()
+    task_id = str(uuid.uuid4())
+    if client is None:
+        return submit_analysis(task, task_data, task_id)
+
+    pr_key = _pr_key(task_data["repo_full_name"], task_data["pr_number"])
+    try:
+        pipe = client.pipeline(transaction=True)
+        pipe.set(LATEST_HEAD_KEY_PREFIX + pr_key, task_data["pr_head_sha"], ex=LATEST_HEAD_TTL_SECONDS)
+        pipe.getset(LATEST_TASK_KEY_PREFIX + pr_key, task_id)
+        pipe.expire(LATEST_TASK_KEY_PREFIX + pr_key, LATEST_HEAD_TTL_SECONDS)
+        _, previous_task_id, _ = pipe.execute()
+    except Exception as e:
+        logger.warning(f"Coalescing unavailable for {pr_key} ({e}); enqueueing immediately.")
+        return submit_analysis(task, task_data, task_id)
+
+    # The fair scheduler hands the task to Celery once the debounce window has passed
+    result = submit_analysis(task, task_data, task_id, countdown=COALESCE_WINDOW_SECONDS)
+    if previous_task_id:
+        previous_task_id = previous_task_id.decode("utf-8")
+        logger.info(f"Superseding analysis task {previous_task_id} for {pr_key} with {task_id}.")
+        try:
+            task.app.control.revoke(previous_task_id)
+        except Exception as e:
+            # Not fatal: the old task also stops itself once it sees the newer head
+            logger.warning(f"Failed to revoke superseded task {previous_task_id}: {e}")
+    return result
+
+# --- Worker Side ---
+
+def latest_head_sha(repo_full_name, pr_number):
+    client = get_redis()
+    if client is None:
+        return None
+    try:
+        value = client.get(LATEST_HEAD_KEY_PREFIX + _pr_key(repo_full_name, pr_number))
+    except Exception as e:
+        logger.warning(f"Failed to read latest head for {repo_full_name}# {pr_number}: {e}")
+        return None
+    return value.decode("utf-8") if value else None
+
+def is_superseded(task_data):
+    latest = latest_head_sha(task_data.get("repo_full_name"), task_data.get("pr_number"))
+    head_sha = task_data.get("pr_head_sha")
+    return bool(latest and head_sha and latest != head_sha)
+
+def ensure_not_superseded(repo_full_name, pr_number, head_sha):
+    """Raises AnalysisSuperseded if a newer head SHA was registered for the PR."""
+    latest = latest_head_sha(repo_full_name, pr_number)
+    if latest and head_sha and latest != head_sha:
+        raise AnalysisSuperseded(f"head {head_sha[:7]} superseded by {latest[:7]}")
@@ -0,0 +1,259 @@
+# worker/diff_chunker.py
+
+import re
+import logging
+from dataclasses import dataclass, field
+
+logger = logging.getLogger(__name__)
+
+# Matches "@@ -12,7 +12,9 @@ optional section heading"
+HUNK_HEADER_RE = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@(.*)$")
+
+# Rough heuristic used by OpenAI for English text and code: ~4 characters per token.
+CHARS_PER_TOKEN = 4
+
+# --- Diff Records ---
+
+@dataclass
+class DiffHunk:
+    """A single "@@" hunk of a unified diff."""
+    file_path: str
+    old_start: int
+    old_length: int
+    new_start: int
+    new_length: int
+    section: str = ""
+    lines: list = field(default_factory=list)
+    hints: list = field(default_factory=list)  # Static pre-scan findings passed to the LLM
+
+    @property
+    def header(self):
+        return f"@@ -{self.old_start},{self.old_length} +{self.new_start},{self.new_length} @@{self.section}"
+
+    def text(self):
+        return "\n".join([self.header, *self.lines])
+
+@dataclass
+class FileDiff:
+    """All hunks touching one file, plus the git header lines that introduce it."""
+    path: str
+    old_path: str = None  # None for newly added files
+    header_lines: list = field(default_factory=list)
+    hunks: list = field(default_factory=list)
+    is_binary: bool = False
+
+    def header_text(self):
+        return "\n".join(self.header_lines)
+
+@dataclass
+class DiffChunk:
+    """A group of hunks packed together so they fit into one LLM prompt."""
+    index: int
+    parts: list = field(default_factory=list)  # list of (FileDiff, [DiffHunk, ...])
+    token_estimate: int = 0
+
+    @property
+    def file_paths(self):
+        return [file_diff.path for file_diff, _ in self.parts]
+
+    @property
+    def hints(self):
+        return [f"{hunk.file_path} {hint}" for _, hunks in self.parts for hunk in hunks for hint in hunk.hints]
+
+    def text(self):
+        sections = []
+        for file_diff, hunks in self.parts:
+            sections.append(file_diff.header_text())
+            sections.extend(hunk.text() for hunk in hunks)
+        return "\n".join(sections) + "\n"
+
+# --- Parsing ---
+
+def estimate_tokens(text):
+    """Cheap local token estimate, good enough for packing prompts under a budget."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def _path_from_header(line, prefix):
+    path = line[len(prefix):].strip()
+    if path == "/dev/null":
+        return None
+    # Strip the a/ or b/ prefix git adds to paths
+    if path[:2] in ("a/", "b/"):
+        path = path[2:]
+    return path
+
+def iter_file_diffs(lines, skip_reason=None):
+    """Parses unified diff lines into FileDiff records, yielding each file as soon as it is complete.
+
+    skip_reason(file_diff, line) lets streaming callers drop files without holding their
+    hunks: it is called with line=None once the file header is complete, then with every
+    hunk line, and the file is discarded (never yielded) as soon as it returns a reason.
+    """
+    current_file = None
+    current_hunk = None
+    skipping = False
+
+    for raw_line in lines:
+        line = raw_line.rstrip("\n").rstrip("\r")
+
+        if line.startswith("diff --git "):
+            if current_file is not None and not skipping:
+                yield current_file
+            skipping = False
+            # "diff --git a/foo.py b/foo.py" - refined by the ---/+++ lines below
+            parts = line[len("diff --git "):].split(" b/", 1)
+            old_path = parts[0][2:] if parts[0].startswith("a/") else parts[0]
+            path = parts[1] if len(parts) == 2 else old_path
+            current_file = FileDiff(path=path, old_path=old_path, header_lines=[line])
+            current_hunk = None
+            continue
+
+        if current_file is None or skipping:
+            # Preamble before the first "diff --git" (e.g. mail headers), or a dropped file - ignore
+            continue
+
+        match = HUNK_HEADER_RE.match(line)
+        if match:
+            if current_hunk is None and skip_reason is not None and skip_reason(current_file, None):
+                skipping = True
+                continue
+            old_start, old_length, new_start, new_length, section = match.groups()
+            current_hunk = DiffHunk(
+                file_path=current_file.path,
+                old_start=int(old_start),
+                old_length=int(old_length) if old_length is not None else 1,
+                new_start=int(new_start),
+                new_length=int(new_length) if new_length is not None else 1,
+                section=section,
+            )
+            current_file.hunks.append(current_hunk)
+            continue
+
+        if current_hunk is None:
+            # Still inside the file header (index, mode, ---/+++ lines)
+            if current_file.is_binary:
+                continue  # Don't keep "GIT binary patch" payload lines
+            current_file.header_lines.append(line)
+            if line.startswith("+++ "):
+                path = _path_from_header(line, "+++ ")
+                if path:
+                    current_file.path = path
+            elif line.startswith("--- "):
+                current_file.old_path = _path_from_header(line, "--- ")
+            elif line.startswith("rename from "):
+                current_file.old_path = line[len("rename from "):]
+            elif line.startswith("rename to "):
+                current_file.path = line[len("rename to "):]
+            elif line.startswith("Binary files ") or line == "GIT binary patch":
+                current_file.is_binary = True
+            continue
+
+        if skip_reason is not None and skip_reason(current_file, line):
+            skipping = True
+            current_file.hunks = []  # Release what was already kept
+            continue
+        current_hunk.lines.append(line)
+
+    if current_file is not None and not skipping:
+        yield current_file
+
+def parse_unified_diff(diff_content):
+    """Parses a unified diff string into a list of FileDiff records."""
+    return list(iter_file_diffs(diff_content.splitlines()))
+
+# --- Chunking ---
+
+def _split_hunk(hunk, token_budget):
+    """Splits an oversized hunk into smaller hunks with recomputed headers."""
+    pieces = []
+    old_line, new_line = hunk.old_start, hunk.new_start
+    piece_lines, piece_tokens = [], 0
+    piece_old_start, piece_new_start = old_line, new_line
+    old_count = new_count = 0
+
+    def flush():
+        pieces.append(DiffHunk(
+            file_path=hunk.file_path,
+            old_start=piece_old_start,
+            old_length=old_count,
+            new_start=piece_new_start,
+            new_length=new_count,
+            section=hunk.section,
+            lines=piece_lines,
+            hints=hunk.hints,
+        ))
+
+    for line in hunk.lines:
+        line_tokens = estimate_tokens(line)
+        if piece_lines and piece_tokens + line_tokens > token_budget:
+            flush()
+            piece_lines, piece_tokens = [], 0
+            piece_old_start, piece_new_start = old_line, new_line
+            old_count = new_count = 0
+
+        piece_lines.append(line)
+        piece_tokens += line_tokens
+        if line.startswith("+"):
+            new_line += 1
+            new_count += 1
+        elif line.startswith("-"):
+            old_line += 1
+            old_count += 1
+        elif not line.startswith("\\"):  # "\ No newline at end of file" counts for neither side
+            old_line += 1
+            new_line += 1
+            old_count += 1
+            new_count += 1
+
+    if piece_lines:
+        flush()
+    return pieces
+
+def chunk_diff(file_diffs, token_budget):
+    """Packs hunks into chunks whose estimated size stays under token_budget.
+
+    Hunks from the same file stay together (under a single file header) whenever they fit,
+    and a hunk that is larger than the budget on its own is split into smaller hunks.
+    """
+    chunks = []
+    current = DiffChunk(index=0)
+
+    def start_new_chunk():
+        nonlocal current
+        if current.parts:
+            chunks.append(current)
+        current = DiffChunk(index=len(chunks))
+
+    for file_diff in file_diffs:
+        if file_diff.is_binary or not file_diff.hunks:
+            continue
+
+        header_tokens = estimate_tokens(file_diff.header_text())
+        hunk_budget = max(token_budget - header_tokens, 1)
+        current_hunks = None
+
+        for original_hunk in file_diff.hunks:
+            if estimate_tokens(original_hunk.text()) > hunk_budget:
+                hunks = _split_hunk(original_hunk, hunk_budget)
+            else:
+                hunks = [original_hunk]
+
+            for hunk in hunks:
+                hunk_tokens = estimate_tokens(hunk.text())
+                needs_header = current_hunks is None
+                cost = hunk_tokens + (header_tokens if needs_header else 0)
+
+                if current.parts and current.token_estimate + cost > token_budget:
+                    start_new_chunk()
+                    current_hunks = None
+                    cost = hunk_tokens + header_tokens
+
+                if current_hunks is None:
+                    current_hunks = []
+                    current.parts.append((file_diff, current_hunks))
+                current_hunks.append(hunk)
+                current.token_estimate += cost
+
+    start_new_chunk()
+    logger.info(f"Packed diff into {len(chunks)} chunk(s) with a budget of {token_budget} tokens each.")
+    return chunks
@@ -0,0 +1,205 @@
+# worker/diff_stream.py
+
+import io
+import os
+import re
+import mmap
+import logging
+import tempfile
+
+from .diff_chunker import iter_file_diffs
+from .prompt_compaction import shorten_line
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# Diffs larger than this are spilled from memory to a temp file (read back through mmap)
+DIFF_SPILL_THRESHOLD_BYTES = int(os.getenv("DIFF_SPILL_THRESHOLD_BYTES", str(4 * 1024 * 1024)))
+# Stop downloading past this size; the analysis covers the files received so far
+DIFF_MAX_DOWNLOAD_BYTES = int(os.getenv("DIFF_MAX_DOWNLOAD_BYTES", str(256 * 1024 * 1024)))
+# Per-task ceiling on diff text kept in memory after filtering; later files are dropped
+DIFF_MEMORY_LIMIT_BYTES = int(os.getenv("DIFF_MEMORY_LIMIT_BYTES", str(32 * 1024 * 1024)))
+# Any diff line longer than this marks the file as minified (reviewed sources get it shortened instead)
+MINIFIED_LINE_CHARS = int(os.getenv("DIFF_MINIFIED_LINE_CHARS", "1000"))
+# "Generated" markers are only looked for in the first few lines of newly added files
+GENERATED_MARKER_LINES = 10
+# Sources we review are never dropped on their content alone: anyone can write "DO NOT EDIT" or
+# one very long line next to a change, so generated Python is only recognized by its path (e.g. *_pb2.py)
+REVIEWED_SOURCE_SUFFIXES = (".py", ".pyi")
+
+VENDORED_PATH_RE = re.compile(
+    r"(^|/)(vendor|vendored|third_party|third-party|node_modules|site-packages|\.venv|venv|bower_components)/"
+)
+GENERATED_PATH_RE = re.compile(
+    r"(_pb2(_grpc)?\.pyi?|\.min\.(js|css)|\.bundle\.js|\.map|\.lock|-lock\.json|\.snap)$"
+    r"|(^|/)(dist|__generated__|generated)/"
+)
+GENERATED_MARKER_RE = re.compile(r"(?i)@generated|auto-?generated|generated by|do not edit")
+
+# --- Spooling ---
+
+class DiffSpool:
+    """Raw diff bytes, kept in memory while small and spilled to an unlinked temp file once large."""
+
+    def __init__(self, spill_threshold=DIFF_SPILL_THRESHOLD_BYTES, max_bytes=DIFF_MAX_DOWNLOAD_BYTES):
+        self.spill_threshold = spill_threshold
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.truncated = False
+        self._buffer = bytearray()
+        self._file = None
+
+    @property
+    def spilled(self):
+        return self._file is not None
+
+    def write(self, data):
+        """Appends data; returns False once max_bytes is reached and the rest should not be fetched."""
+        if self.size + len(data) > self.max_bytes:
+            data = data[:self.max_bytes - self.size]
+            self.truncated = True
+        self.size += len(data)
+        if self._file is None and len(self._buffer) + len(data) > self.spill_threshold:
+            self._file = tempfile.TemporaryFile(prefix="codeguardian-diff-")
+            self._file.write(self._buffer)
+            self._buffer = bytearray()
+        if self._file is not None:
+            self._file.write(data)
+        else:
+            self._buffer += data
+        return not self.truncated
+
+    def iter_lines(self):
+        """Yields decoded lines without ever materializing the whole diff as one string."""
+        if self._file is None:
+            source = io.BytesIO(self._buffer)
+            for raw in source:
+                yield raw.decode("utf-8", errors="replace")
+            return
+        self._file.flush()
+        if self.size == 0:
+            return
+        with mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            # Pages are read lazily and can be evicted, so RSS stays flat however large the diff is
+            for raw in iter(mapped.readline, b""):
+                yield raw.decode("utf-8", errors="replace")
+
+    def close(self):
+        self._buffer = bytearray()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def spool_diff(chunks, spill_threshold=DIFF_SPILL_THRESHOLD_BYTES, max_bytes=DIFF_MAX_DOWNLOAD_BYTES):
+    """Drains an iterable of byte (or str) chunks into a DiffSpool."""
+    spool = DiffSpool(spill_threshold, max_bytes)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            if not spool.write(chunk):
+                logger.warning(f"Diff exceeds {max_bytes} bytes; analyzing only the first {max_bytes}.")
+                break
+    except BaseException:
+        spool.close()
+        raise
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()  # Ends a streamed HTTP response early instead of draining it
+    return spool
+
+# --- Filtering ---
+
+def path_skip_reason(path):
+    """Returns why a file is excluded from analysis based on its path alone, or None."""
+    if VENDORED_PATH_RE.search(path):
+        return "vendored"
+    if GENERATED_PATH_RE.search(path):
+        return "generated"
+    return None
+
+class DiffFileFilter:
+    """skip_reason callback for iter_file_diffs: drops generated, vendored, minified and binary
+    files while streaming and enforces the per-task memory ceiling on what is kept."""
+
+    def __init__(self, memory_limit=DIFF_MEMORY_LIMIT_BYTES):
+        self.memory_limit = memory_limit
+        self.retained_bytes = 0
+        self.skipped = {}  # reason -> number of files
+        self._file_bytes = 0
+        self._added_seen = 0
+        self._source = False
+        self._check_marker = False
+
+    def skip(self, reason):
+        self.skipped[reason] = self.skipped.get(reason, 0) + 1
+        self.retained_bytes -= self._file_bytes
+        return reason
+
+    def __call__(self, file_diff, line):
+        if line is None:
+            self._file_bytes, self._added_seen = 0, 0
+            self._source = file_diff.path.endswith(REVIEWED_SOURCE_SUFFIXES)
+            # Only a new file's leading lines are its own header; in an existing file a marker is just an edit
+            self._check_marker = not self._source and (
+                file_diff.old_path is None or any(header.startswith("new file mode") for header in file_diff.header_lines)
+            )
+            if self.retained_bytes >= self.memory_limit:
+                return self.skip("memory limit")
+            reason = path_skip_reason(file_diff.path)
+            return self.skip(reason) if reason else None
+
+        if len(line) > MINIFIED_LINE_CHARS and not self._source:
+            return self.skip("minified")
+        if self._check_marker and line.startswith("+") and self._added_seen < GENERATED_MARKER_LINES:
+            self._added_seen += 1
+            if GENERATED_MARKER_RE.search(line):
+                return self.skip("generated")
+        self._file_bytes += len(line) + 1
+        self.retained_bytes += len(line) + 1
+        if self.retained_bytes > self.memory_limit:
+            return self.skip("memory limit")
+        return None
+
+def iter_diff_records(lines, file_filter=None):
+    """Streams FileDiff records from diff lines, dropping files the filter rejects.
+
+    Over-long lines of reviewed sources are cut down (as prompt compaction would) rather
+    than dropping the file.
+    """
+    file_filter = file_filter if file_filter is not None else DiffFileFilter()
+    for file_diff in iter_file_diffs(lines, skip_reason=file_filter):
+        if file_diff.is_binary:
+            file_filter.skipped["binary"] = file_filter.skipped.get("binary", 0) + 1
+            continue
+        if file_diff.path.endswith(REVIEWED_SOURCE_SUFFIXES):
+            for hunk in file_diff.hunks:
+                if any(len(line) > MINIFIED_LINE_CHARS for line in hunk.lines):
+                    hunk.lines = [shorten_line(line) if len(line) > MINIFIED_LINE_CHARS else line for line in hunk.lines]
+        yield file_diff
+
+def read_file_diffs(spool, memory_limit=DIFF_MEMORY_LIMIT_BYTES):
+    """Parses a spooled diff into filtered FileDiff records. Returns (file_diffs, stats)."""
+    file_filter = DiffFileFilter(memory_limit)
+    file_diffs = list(iter_diff_records(spool.iter_lines(), file_filter))
+    stats = {
+        "diff_bytes": spool.size,
+        "spilled": spool.spilled,
+        "download_truncated": spool.truncated,
+        "retained_bytes": file_filter.retained_bytes,
+        "files": len(file_diffs),
+        "skipped": dict(file_filter.skipped),
+    }
+    if file_filter.skipped.get("memory limit"):
+        logger.warning(
+            f"Diff memory ceiling ({memory_limit} bytes) reached; "
+            f"{file_filter.skipped['memory limit']} file(s) were not analyzed."
+        )
+    return file_diffs, stats
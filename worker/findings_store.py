@@ -0,0 +1,243 @@
+# worker/findings_store.py
+"""Scan history and findings, kept in a SQL database for dashboards and history queries.
+
+Every completed analysis records one scan row and, in the same transaction, one batched
+insert of all the findings at that head (carried-forward ones included). Lookups by
+installation, repo/PR, head SHA and fingerprint are served from indexes and paginated
+by keyset (newest first, `cursor` = the last id of the previous page), so a page costs
+the same however deep the history is.
+
+DATABASE_URL selects PostgreSQL (the RDS instance in infra/); without it the store is
+a SQLite file at FINDINGS_SQLITE_PATH, which is also what local development and the
+benchmarks use. Recording never fails an analysis: errors are logged and dropped.
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+FINDINGS_STORE_ENABLED = os.getenv("FINDINGS_STORE_ENABLED", "true").lower() in ("1", "true", "yes")
+DATABASE_URL = os.getenv("DATABASE_URL", "")
+FINDINGS_SQLITE_PATH = os.getenv("FINDINGS_SQLITE_PATH", "/tmp/codeguardian_findings.sqlite3")
+FINDINGS_PAGE_MAX = int(os.getenv("FINDINGS_PAGE_MAX", "200"))
+FINDINGS_DB_POOL_SIZE = int(os.getenv("FINDINGS_DB_POOL_SIZE", "4"))
+FINDINGS_DB_TIMEOUT_SECONDS = float(os.getenv("FINDINGS_DB_TIMEOUT_SECONDS", "5"))
+
+SCAN_COLUMNS = (
+    "id", "installation_id", "repo_full_name", "pr_number", "head_sha", "mode", "status",
+    "findings_count", "prompt_tokens_saved", "created_at",
+)
+FINDING_COLUMNS = (
+    "id", "scan_id", "installation_id", "repo_full_name", "pr_number", "head_sha", "fingerprint",
+    "file_path", "line", "type", "risk", "suggestion", "created_at",
+)
+SCAN_FILTERS = ("installation_id", "repo_full_name", "pr_number", "head_sha")
+FINDING_FILTERS = SCAN_FILTERS + ("scan_id", "fingerprint")
+
+# Every index ends in id so the filtered, newest-first page is one index range scan
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS scans (
+        id {id_type} PRIMARY KEY,
+        installation_id BIGINT,
+        repo_full_name TEXT NOT NULL,
+        pr_number INTEGER,
+        head_sha TEXT,
+        mode TEXT,
+        status TEXT NOT NULL,
+        findings_count INTEGER NOT NULL,
+        prompt_tokens_saved INTEGER NOT NULL DEFAULT 0,
+        created_at DOUBLE PRECISION NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS findings (
+        id {id_type} PRIMARY KEY,
+        scan_id BIGINT NOT NULL REFERENCES scans (id) ON DELETE CASCADE,
+        installation_id BIGINT,
+        repo_full_name TEXT NOT NULL,
+        pr_number INTEGER,
+        head_sha TEXT,
+        fingerprint TEXT,
+        file_path TEXT,
+        line INTEGER,
+        type TEXT,
+        risk TEXT,
+        suggestion TEXT,
+        created_at DOUBLE PRECISION NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS scans_installation_idx ON scans (installation_id, id)",
+    "CREATE INDEX IF NOT EXISTS scans_repo_pr_idx ON scans (repo_full_name, pr_number, id)",
+    "CREATE INDEX IF NOT EXISTS scans_head_sha_idx ON scans (head_sha, id)",
+    "CREATE INDEX IF NOT EXISTS findings_scan_idx ON findings (scan_id, id)",
+    "CREATE INDEX IF NOT EXISTS findings_installation_idx ON findings (installation_id, id)",
+    "CREATE INDEX IF NOT EXISTS findings_repo_pr_idx ON findings (repo_full_name, pr_number, id)",
+    "CREATE INDEX IF NOT EXISTS findings_head_sha_idx ON findings (head_sha, id)",
+    "CREATE INDEX IF NOT EXISTS findings_fingerprint_idx ON findings (fingerprint, id)",
+)
+
+# --- Database ---
+
+class FindingsStore:
+    """Pooled PostgreSQL connections, or one SQLite connection per thread.
+
+    Connections are checked out per operation, so readers never wait behind a writer
+    and a connection dropped by the server (restart, RDS failover) is replaced on the
+    next checkout instead of failing every later call.
+    """
+
+    def __init__(self, database_url=DATABASE_URL, sqlite_path=FINDINGS_SQLITE_PATH):
+        self.pool = None
+        if database_url.startswith("postgres"):
+            from psycopg_pool import ConnectionPool
+            # SQLAlchemy-style URLs (postgresql+asyncpg://) carry a driver suffix psycopg does not accept
+            scheme, rest = database_url.split("://", 1)
+            self.pool = ConnectionPool(
+                f"{scheme.split('+')[0]}://{rest}", min_size=1, max_size=FINDINGS_DB_POOL_SIZE,
+                check=ConnectionPool.check_connection, timeout=FINDINGS_DB_TIMEOUT_SECONDS, open=True,
+            )
+            self.dialect = "postgresql"
+            self.placeholder = "%s"
+            id_type = "BIGINT GENERATED BY DEFAULT AS IDENTITY"
+        else:
+            self.sqlite_path = (
+                database_url.split("sqlite:///", 1)[1] if database_url.startswith("sqlite:///") else sqlite_path
+            )
+            self.local = threading.local()
+            self.dialect = "sqlite"
+            self.placeholder = "?"
+            id_type = "INTEGER"  # An alias of the rowid, so ids ascend with insertion
+        with self._transaction() as conn:
+            for statement in SCHEMA:
+                conn.execute(statement.format(id_type=id_type))
+
+    def _sql(self, statement):
+        return statement.replace("?", self.placeholder)
+
+    def _sqlite_connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.sqlite_path, isolation_level=None, timeout=FINDINGS_DB_TIMEOUT_SECONDS)
+            conn.execute("PRAGMA journal_mode=WAL")  # Readers do not block the writer (or each other)
+            conn.execute("PRAGMA foreign_keys=ON")
+            self.local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """A connection inside one transaction, committed on success and rolled back on error."""
+        if self.pool is not None:
+            # The pool commits or rolls back on exit and discards connections left broken
+            with self.pool.connection() as conn:
+                yield conn
+            return
+        conn = self._sqlite_connection()
+        conn.execute("BEGIN")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    # --- Writes ---
+
+    def record_scan(self, scan, findings):
+        """Inserts a scan and all of its findings (one executemany) atomically; returns the scan id."""
+        now = time.time()
+        scan_row = tuple(scan.get(column) for column in SCAN_COLUMNS[1:-1]) + (now,)
+        insert_scan = self._sql(
+            f"INSERT INTO scans ({', '.join(SCAN_COLUMNS[1:])}) VALUES ({', '.join('?' * (len(SCAN_COLUMNS) - 1))}) "
+            "RETURNING id"
+        )
+        insert_finding = self._sql(
+            f"INSERT INTO findings ({', '.join(FINDING_COLUMNS[1:])}) "
+            f"VALUES ({', '.join('?' * (len(FINDING_COLUMNS) - 1))})"
+        )
+        with self._transaction() as conn:
+            scan_id = conn.execute(insert_scan, scan_row).fetchone()[0]
+            rows = [
+                (
+                    scan_id, scan.get("installation_id"), scan.get("repo_full_name"), scan.get("pr_number"),
+                    scan.get("head_sha"), finding.get("fingerprint"), finding.get("file_path"),
+                    _int_or_none(finding.get("line")), finding.get("type"), finding.get("risk"),
+                    finding.get("suggestion"), now,
+                )
+                for finding in findings
+            ]
+            if rows:
+                conn.cursor().executemany(insert_finding, rows)
+        return scan_id
+
+    # --- Reads ---
+
+    def _page(self, table, columns, allowed_filters, filters, limit, cursor):
+        clauses, params = [], []
+        for name in allowed_filters:
+            value = filters.get(name)
+            if value is not None:
+                clauses.append(f"{name} = ?")
+                params.append(value)
+        if cursor is not None:
+            clauses.append("id < ?")
+            params.append(int(cursor))
+        limit = max(1, min(int(limit), FINDINGS_PAGE_MAX))
+        where = f"WHERE {' AND '.join(clauses)} " if clauses else ""
+        statement = self._sql(f"SELECT {', '.join(columns)} FROM {table} {where}ORDER BY id DESC LIMIT {limit + 1}")
+        with self._transaction() as conn:
+            rows = conn.execute(statement, params).fetchall()
+        items = [dict(zip(columns, row)) for row in rows[:limit]]
+        next_cursor = items[-1]["id"] if len(rows) > limit else None
+        return {"items": items, "next_cursor": next_cursor}
+
+    def list_scans(self, limit=50, cursor=None, **filters):
+        """A page of scans, newest first, filtered by any of SCAN_FILTERS."""
+        return self._page("scans", SCAN_COLUMNS, SCAN_FILTERS, filters, limit, cursor)
+
+    def list_findings(self, limit=50, cursor=None, **filters):
+        """A page of findings, newest first, filtered by any of FINDING_FILTERS."""
+        return self._page("findings", FINDING_COLUMNS, FINDING_FILTERS, filters, limit, cursor)
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_findings_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = FindingsStore()
+    return _store
+
+# --- Recording ---
+
+def record_scan_result(pr_data, result, findings):
+    """Records a finished PR analysis and its findings; a failure is logged, never raised."""
+    if not FINDINGS_STORE_ENABLED:
+        return None
+    scan = {
+        "installation_id": pr_data.get("installation_id"),
+        "repo_full_name": pr_data.get("repo_full_name"),
+        "pr_number": pr_data.get("pr_number"),
+        "head_sha": pr_data.get("pr_head_sha"),
+        "mode": result.get("mode"),
+        "status": result.get("status"),
+        "findings_count": len(findings),
+        "prompt_tokens_saved": result.get("prompt_tokens_saved", 0),
+    }
+    try:
+        return get_findings_store().record_scan(scan, findings)
+    except Exception as e:
+        logger.warning(
+            f"Failed to record scan of {scan['repo_full_name']}# {scan['pr_number']} in the findings store: {e}"
+        )
+        return None
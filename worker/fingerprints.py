@@ -0,0 +1,330 @@
+# worker/fingerprints.py
+"""Stable finding fingerprints and the per-PR index of findings already posted.
+
+A fingerprint hashes the file, the finding type and the whitespace-normalized code
+around the flagged line, so it survives re-runs, line shifts from unrelated edits and
+re-indentation, but changes when the flagged code itself changes. Every posted comment
+carries its fingerprint in a hidden HTML marker; the markers already on a PR are read
+with one paginated listing and cached, and only findings missing from that index are
+posted again.
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+
+from .github_client import get_github_client, GitHubAPIError, PLACEHOLDER_GITHUB_TOKEN
+from .github_auth import get_app_bot_login
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+FINDING_DEDUPE_ENABLED = os.getenv("FINDING_DEDUPE_ENABLED", "true").lower() in ("1", "true", "yes")
+# New-side lines on each side of the flagged line that make up its code window
+FINDING_FINGERPRINT_WINDOW_LINES = int(os.getenv("FINDING_FINGERPRINT_WINDOW_LINES", "1"))
+# How long a PR's posted fingerprints are cached before they are listed from GitHub again
+POSTED_FINDINGS_CACHE_TTL_SECONDS = int(os.getenv("POSTED_FINDINGS_CACHE_TTL_SECONDS", str(24 * 3600)))
+# Reply "resolved" to inline comments whose finding is no longer reported on the code it flagged
+GITHUB_RESOLVE_STALE_FINDINGS = os.getenv("GITHUB_RESOLVE_STALE_FINDINGS", "false").lower() in ("1", "true", "yes")
+
+KEY_PREFIX = "codeguardian:posted_findings:"
+LOADED_FIELD = "_loaded"  # Sentinel so a PR with nothing posted still counts as cached
+
+FINGERPRINT_MARKER = "<!-- codeguardian:fingerprint {} -->"
+RESOLVED_MARKER = "<!-- codeguardian:resolved {} -->"
+FINGERPRINT_RE = re.compile(r"<!-- codeguardian:fingerprint ([0-9a-f]{16,64}) -->")
+RESOLVED_RE = re.compile(r"<!-- codeguardian:resolved ([0-9a-f]{16,64}) -->")
+WHITESPACE_RE = re.compile(r"\s+")
+
+# --- Fingerprints ---
+
+def new_side_lines(file_diff):
+    """Returns {line number: normalized text} for the new-side lines a file's diff shows."""
+    lines = {}
+    for hunk in file_diff.hunks:
+        new_line = hunk.new_start
+        for diff_line in hunk.lines:
+            if diff_line.startswith("-") or diff_line.startswith("\\"):
+                continue
+            lines[new_line] = WHITESPACE_RE.sub("", diff_line[1:])
+            new_line += 1
+    return lines
+
+def code_window(lines, line, radius=FINDING_FINGERPRINT_WINDOW_LINES):
+    """The normalized code around line (blank lines skipped), or "" if the diff does not show it."""
+    if not isinstance(line, int) or line not in lines:
+        return ""
+    window = (lines.get(number, "") for number in range(line - radius, line + radius + 1))
+    return "\n".join(text for text in window if text)
+
+def finding_fingerprint(finding, window):
+    """Hex digest of (file, code window, type); the line number stands in when there is no window."""
+    location = window if window else f"line {finding.get('line')}"
+    digest = hashlib.sha256()
+    for part in (finding.get("file_path") or "", location, (finding.get("type") or "").strip().lower()):
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()[:32]
+
+def assign_fingerprints(findings, file_diffs):
+    """Sets finding["fingerprint"] on findings that have none yet (carried findings keep theirs)."""
+    lines_by_path = {}
+    for finding in findings:
+        if finding.get("fingerprint"):
+            continue
+        path = finding.get("file_path")
+        if path not in lines_by_path:
+            file_diff = next((file_diff for file_diff in file_diffs if file_diff.path == path), None)
+            lines_by_path[path] = new_side_lines(file_diff) if file_diff is not None else {}
+        finding["fingerprint"] = finding_fingerprint(finding, code_window(lines_by_path[path], finding.get("line")))
+    return findings
+
+def fingerprint_marker(finding):
+    fingerprint = finding.get("fingerprint")
+    return "\n" + FINGERPRINT_MARKER.format(fingerprint) if fingerprint else ""
+
+# --- Posted Findings Cache ---
+
+class _LocalPostedCache:
+    """In-process fallback; each worker process then lists a PR's comments once per TTL."""
+
+    def __init__(self):
+        self.entries = {}  # key -> (expires_at, {fingerprint: entry})
+        self.lock = threading.Lock()
+
+    def load(self, key):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None or item[0] < time.time():
+                self.entries.pop(key, None)
+                return None
+            return dict(item[1])
+
+    def store(self, key, entries, ttl):
+        with self.lock:
+            self.entries[key] = (time.time() + ttl, dict(entries))
+
+    def update(self, key, entries, ttl):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is not None:
+                item[1].update(entries)
+
+class _RedisPostedCache:
+    """One Redis hash per PR (fingerprint -> entry), shared by all workers."""
+
+    def __init__(self, redis_url):
+        import redis
+        self.client = redis.Redis.from_url(redis_url, socket_timeout=2, socket_connect_timeout=2)
+        self.client.ping()
+
+    def load(self, key):
+        values = self.client.hgetall(KEY_PREFIX + key)
+        if not values:
+            return None
+        entries = {field.decode("utf-8"): json.loads(value) for field, value in values.items()}
+        entries.pop(LOADED_FIELD, None)
+        return entries
+
+    def store(self, key, entries, ttl):
+        mapping = {fingerprint: json.dumps(entry) for fingerprint, entry in entries.items()}
+        mapping[LOADED_FIELD] = "{}"
+        pipe = self.client.pipeline()
+        pipe.delete(KEY_PREFIX + key)
+        pipe.hset(KEY_PREFIX + key, mapping=mapping)
+        pipe.expire(KEY_PREFIX + key, ttl)
+        pipe.execute()
+
+    def update(self, key, entries, ttl):
+        if entries and self.client.exists(KEY_PREFIX + key):
+            self.client.hset(KEY_PREFIX + key, mapping={fp: json.dumps(entry) for fp, entry in entries.items()})
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_posted_findings_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                try:
+                    _cache = _RedisPostedCache(REDIS_URL)
+                except Exception as e:
+                    logger.warning(f"Redis unavailable for posted findings ({e}); caching them per process.")
+                    _cache = _LocalPostedCache()
+    return _cache
+
+# --- Posted Findings Index ---
+
+class PostedFindings:
+    """The fingerprints already posted on one PR: {fingerprint: {"comment_id", "path", "resolved"}}."""
+
+    def __init__(self, repo_full_name, pr_number, entries=None, cache=None):
+        self.key = f"{repo_full_name}#{pr_number}"
+        self.entries = dict(entries or {})
+        self.cache = cache
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def is_posted(self, fingerprint):
+        entry = self.entries.get(fingerprint)
+        return entry is not None and not entry.get("resolved")
+
+    def new_findings(self, findings):
+        """The findings (fingerprinted by assign_fingerprints) not posted yet, deduped among themselves."""
+        new, seen = [], set()
+        with self.lock:
+            for finding in findings:
+                fingerprint = finding.get("fingerprint")
+                if fingerprint and (fingerprint in seen or self.is_posted(fingerprint)):
+                    continue
+                seen.add(fingerprint)
+                new.append(finding)
+        return new
+
+    def record(self, findings):
+        """Adds just-posted findings to the index (the comment ids are learned on the next listing)."""
+        added = {
+            finding["fingerprint"]: {"comment_id": None, "path": finding.get("file_path"), "resolved": False}
+            for finding in findings if finding.get("fingerprint")
+        }
+        self._update(added)
+
+    def mark_resolved(self, fingerprints):
+        with self.lock:
+            resolved = {fp: dict(self.entries[fp], resolved=True) for fp in fingerprints if fp in self.entries}
+        self._update(resolved)
+
+    def _update(self, entries):
+        if not entries:
+            return
+        with self.lock:
+            self.entries.update(entries)
+        if self.cache is not None:
+            try:
+                self.cache.update(self.key, entries, POSTED_FINDINGS_CACHE_TTL_SECONDS)
+            except Exception as e:
+                logger.warning(f"Failed to update posted findings for {self.key}: {e}")
+
+def entries_from_comments(comments, bot_login):
+    """Builds index entries from PR review comments (or reviews) carrying fingerprint markers.
+
+    Only the App's own comments count: anyone who can comment on the PR could otherwise
+    paste markers and have real findings skipped as already posted.
+    """
+    entries, resolved = {}, set()
+    for comment in comments:
+        user = comment.get("user") or {}
+        if user.get("type") != "Bot" or user.get("login") != bot_login:
+            continue
+        body = comment.get("body") or ""
+        resolved.update(RESOLVED_RE.findall(body))
+        # Inline comments carry one marker; review bodies one per unanchored finding
+        inline = comment.get("path") is not None
+        for fingerprint in FINGERPRINT_RE.findall(body):
+            entries[fingerprint] = {
+                "comment_id": comment.get("id") if inline else None,
+                "path": comment.get("path"),
+                "resolved": False,
+            }
+    for fingerprint in resolved & entries.keys():
+        entries[fingerprint]["resolved"] = True
+    return entries
+
+def fetch_posted_entries(token, repo_full_name, pr_number):
+    """Lists the PR's review comments and reviews (paginated) and indexes their markers."""
+    bot_login = get_app_bot_login()
+    client = get_github_client()
+    comments = list(client.paginate(f"/repos/{repo_full_name}/pulls/{pr_number}/comments", token))
+    reviews = list(client.paginate(f"/repos/{repo_full_name}/pulls/{pr_number}/reviews", token))
+    # Inline entries win over a review body that listed the same finding before it could be anchored
+    entries = entries_from_comments(reviews, bot_login)
+    entries.update(entries_from_comments(comments, bot_login))
+    return entries
+
+def load_posted_findings(token, repo_full_name, pr_number, refresh=False):
+    """Returns the PR's PostedFindings, listed from GitHub only when the cache has none.
+
+    A failed listing yields an empty index, so findings are posted rather than lost.
+    """
+    cache = get_posted_findings_cache()
+    key = f"{repo_full_name}#{pr_number}"
+    if token == PLACEHOLDER_GITHUB_TOKEN:
+        return PostedFindings(repo_full_name, pr_number, cache=None)
+    if not refresh:
+        try:
+            entries = cache.load(key)
+        except Exception as e:
+            logger.warning(f"Failed to load cached posted findings for {key}: {e}")
+            entries = None
+        if entries is not None:
+            return PostedFindings(repo_full_name, pr_number, entries, cache)
+    try:
+        entries = fetch_posted_entries(token, repo_full_name, pr_number)
+    except GitHubAPIError as e:
+        logger.warning(f"Failed to list posted findings for {key} (status {e.status_code}); not deduplicating.")
+        return PostedFindings(repo_full_name, pr_number, cache=None)
+    try:
+        cache.store(key, entries, POSTED_FINDINGS_CACHE_TTL_SECONDS)
+    except Exception as e:
+        logger.warning(f"Failed to cache posted findings for {key}: {e}")
+    logger.info(f"Indexed {len(entries)} posted finding(s) on {key}.")
+    return PostedFindings(repo_full_name, pr_number, entries, cache)
+
+# --- Stale Findings ---
+
+def stale_fingerprints(posted, current_findings, analyzed_paths):
+    """Posted, unresolved fingerprints on analyzed files that the current findings no longer contain.
+
+    Files with a current finding that has no fingerprint (state from before fingerprints)
+    are skipped, since its comment cannot be told apart from a stale one.
+    """
+    current = {finding.get("fingerprint") for finding in current_findings}
+    unknown_paths = {finding.get("file_path") for finding in current_findings if not finding.get("fingerprint")}
+    return [
+        fingerprint for fingerprint, entry in posted.entries.items()
+        if not entry.get("resolved") and fingerprint not in current
+        and entry.get("path") in analyzed_paths and entry.get("path") not in unknown_paths
+    ]
+
+def resolve_stale_findings(token, repo_full_name, pr_number, commit_id, posted, current_findings, file_diffs):
+    """Replies to each stale inline comment that its finding is resolved. Returns how many were resolved."""
+    if token == PLACEHOLDER_GITHUB_TOKEN:
+        return 0
+    analyzed_paths = {file_diff.path for file_diff in file_diffs}
+    stale = stale_fingerprints(posted, current_findings, analyzed_paths)
+    if any(posted.entries[fingerprint].get("comment_id") is None for fingerprint in stale):
+        # Comments this worker posted are cached without ids; list them once to learn the ids
+        posted = load_posted_findings(token, repo_full_name, pr_number, refresh=True)
+        stale = stale_fingerprints(posted, current_findings, analyzed_paths)
+
+    client = get_github_client()
+    resolved = []
+    for fingerprint in stale:
+        comment_id = posted.entries[fingerprint].get("comment_id")
+        if comment_id is None:
+            continue
+        body = (
+            f"Resolved: CodeGuardian AI no longer reports this finding as of {(commit_id or '')[:7]}.\n"
+            + RESOLVED_MARKER.format(fingerprint)
+        )
+        try:
+            response = client.post(
+                f"/repos/{repo_full_name}/pulls/{pr_number}/comments/{comment_id}/replies", token, json={"body": body},
+            )
+            response.raise_for_status()
+        except GitHubAPIError as e:
+            logger.warning(f"Failed to resolve finding comment {comment_id} on {posted.key} (status {e.status_code}).")
+            continue
+        resolved.append(fingerprint)
+    posted.mark_resolved(resolved)
+    if resolved:
+        logger.info(f"Resolved {len(resolved)} stale finding(s) on {posted.key}.")
+    return len(resolved)
@@ -0,0 +1,228 @@
+# worker/github_auth.py
+
+import os
+import time
+import logging
+import threading
+from datetime import datetime
+from functools import lru_cache
+
+from .github_client import get_github_client, register_installation_token, PLACEHOLDER_GITHUB_TOKEN
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+GITHUB_APP_ID = os.getenv("GITHUB_APP_ID")
+GITHUB_PRIVATE_KEY = os.getenv("GITHUB_PRIVATE_KEY")
+# The App's URL name; looked up with GET /app when not set
+GITHUB_APP_SLUG = os.getenv("GITHUB_APP_SLUG")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Refresh installation tokens (valid for 1 hour) this long before they expire
+TOKEN_REFRESH_MARGIN_SECONDS = int(os.getenv("GITHUB_TOKEN_REFRESH_MARGIN_SECONDS", "300"))
+# App JWTs may live at most 10 minutes; GitHub recommends backdating iat to allow for clock drift
+APP_JWT_LIFETIME_SECONDS = 540
+APP_JWT_CLOCK_DRIFT_SECONDS = 60
+# How long another process may hold the exchange lock before we stop waiting for it
+EXCHANGE_LOCK_TIMEOUT_SECONDS = 15
+
+TOKEN_KEY_PREFIX = "codeguardian:gh_installation_token:"
+LOCK_KEY_PREFIX = "codeguardian:gh_installation_token_lock:"
+
+# --- App JWT ---
+
+@lru_cache(maxsize=1)
+def _load_private_key(pem):
+    """Parses the PEM once per process; signing with the parsed key object avoids re-parsing it per JWT."""
+    from cryptography.hazmat.primitives.serialization import load_pem_private_key
+    # .env files often store the PEM on one line with literal "\n" separators
+    return load_pem_private_key(pem.replace("\\n", "\n").encode("utf-8"), password=None)
+
+_app_jwt = None
+_app_jwt_expires_at = 0.0
+_app_jwt_lock = threading.Lock()
+
+def get_app_jwt():
+    """Returns a cached GitHub App JWT, minting a new one shortly before the old one expires."""
+    global _app_jwt, _app_jwt_expires_at
+    with _app_jwt_lock:
+        now = time.time()
+        if _app_jwt is None or now >= _app_jwt_expires_at - APP_JWT_CLOCK_DRIFT_SECONDS:
+            import jwt  # PyJWT
+            issued_at = int(now) - APP_JWT_CLOCK_DRIFT_SECONDS
+            expires_at = int(now) + APP_JWT_LIFETIME_SECONDS
+            payload = {"iat": issued_at, "exp": expires_at, "iss": GITHUB_APP_ID}
+            _app_jwt = jwt.encode(payload, _load_private_key(GITHUB_PRIVATE_KEY), algorithm="RS256")
+            _app_jwt_expires_at = expires_at
+        return _app_jwt
+
+_app_slug = GITHUB_APP_SLUG
+_app_slug_lock = threading.Lock()
+
+def get_app_bot_login():
+    """The login the App posts comments as: "<slug>[bot]" (GET /app once when GITHUB_APP_SLUG is unset)."""
+    global _app_slug
+    if _app_slug is None:
+        with _app_slug_lock:
+            if _app_slug is None:
+                response = get_github_client().get("/app", get_app_jwt())
+                response.raise_for_status()
+                _app_slug = response.json()["slug"]
+    return f"{_app_slug}[bot]"
+
+# --- Installation Tokens ---
+
+def _parse_expiry(expires_at):
+    # GitHub returns e.g. "2024-01-01T12:00:00Z"
+    return datetime.fromisoformat(expires_at.replace("Z", "+00:00")).timestamp()
+
+def exchange_installation_token(installation_id):
+    """Exchanges the App JWT for an installation token. Returns (token, expires_at_epoch)."""
+    response = get_github_client().post(f"/app/installations/{installation_id}/access_tokens", get_app_jwt())
+    response.raise_for_status()
+    data = response.json()
+    logger.info(f"Exchanged new installation token for installation {installation_id}.")
+    return data["token"], _parse_expiry(data["expires_at"])
+
+class InstallationTokenCache:
+    """In-process + Redis-shared cache of installation tokens with single-flight refresh.
+
+    Within a process, a per-installation lock ensures one exchange at a time; across
+    processes, a short-lived Redis lock lets one worker exchange while the others wait
+    for the token to appear in Redis.
+    """
+
+    def __init__(self, exchange=exchange_installation_token, refresh_margin=TOKEN_REFRESH_MARGIN_SECONDS):
+        self.exchange = exchange
+        self.refresh_margin = refresh_margin
+        self.tokens = {}  # installation_id -> (token, expires_at)
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+        self._redis = None
+        self._redis_checked = False
+
+    @property
+    def redis(self):
+        if not self._redis_checked:
+            self._redis_checked = True
+            try:
+                import redis
+                client = redis.Redis.from_url(REDIS_URL, socket_timeout=2, socket_connect_timeout=2)
+                client.ping()
+                self._redis = client
+            except Exception as e:
+                logger.warning(f"Redis unavailable for the installation token cache ({e}); using in-process cache only.")
+        return self._redis
+
+    def _lock_for(self, installation_id):
+        with self.locks_lock:
+            return self.locks.setdefault(installation_id, threading.Lock())
+
+    def _fresh(self, entry):
+        return entry is not None and entry[1] - self.refresh_margin > time.time()
+
+    def _load_shared(self, installation_id):
+        if self.redis is None:
+            return None
+        try:
+            value = self.redis.get(TOKEN_KEY_PREFIX + str(installation_id))
+        except Exception as e:
+            logger.warning(f"Failed to read shared installation token: {e}")
+            return None
+        if not value:
+            return None
+        token, expires_at = value.decode("utf-8").rsplit(" ", 1)
+        return token, float(expires_at)
+
+    def _store_shared(self, installation_id, entry):
+        if self.redis is None:
+            return
+        token, expires_at = entry
+        ttl = int(expires_at - self.refresh_margin - time.time())
+        if ttl > 0:
+            try:
+                self.redis.set(TOKEN_KEY_PREFIX + str(installation_id), f"{token} {expires_at}", ex=ttl)
+            except Exception as e:
+                logger.warning(f"Failed to share installation token: {e}")
+
+    def _exchange_single_flight(self, installation_id):
+        """Exchanges a token, letting only one process across the fleet do so at a time."""
+        if self.redis is None:
+            return self.exchange(installation_id)
+
+        lock = self.redis.lock(LOCK_KEY_PREFIX + str(installation_id), timeout=EXCHANGE_LOCK_TIMEOUT_SECONDS)
+        deadline = time.time() + EXCHANGE_LOCK_TIMEOUT_SECONDS
+        while time.time() < deadline:
+            try:
+                acquired = lock.acquire(blocking=False)
+            except Exception as e:
+                logger.warning(f"Failed to acquire token exchange lock: {e}")
+                return self.exchange(installation_id)
+            if acquired:
+                try:
+                    # Another process may have finished its exchange just before we got the lock
+                    entry = self._load_shared(installation_id)
+                    if not self._fresh(entry):
+                        entry = self.exchange(installation_id)
+                        self._store_shared(installation_id, entry)
+                    return entry
+                finally:
+                    try:
+                        lock.release()
+                    except Exception:
+                        pass  # Lock expired while exchanging; nothing left to release
+            entry = self._load_shared(installation_id)
+            if self._fresh(entry):
+                return entry
+            time.sleep(0.1)
+        logger.warning(f"Timed out waiting for another worker to exchange a token for installation {installation_id}.")
+        return self.exchange(installation_id)
+
+    def get(self, installation_id):
+        entry = self.tokens.get(installation_id)
+        if self._fresh(entry):
+            return entry[0]
+        with self._lock_for(installation_id):
+            entry = self.tokens.get(installation_id)
+            if self._fresh(entry):
+                return entry[0]
+            entry = self._load_shared(installation_id)
+            if not self._fresh(entry):
+                entry = self._exchange_single_flight(installation_id)
+            self.tokens[installation_id] = entry
+            return entry[0]
+
+    def invalidate(self, installation_id, token=None):
+        """Drops a token GitHub rejected (e.g. revoked on uninstall).
+
+        Given the rejected token, drops it only while it is still the cached one, so callers
+        that hit a 401 together do not throw away the replacement one of them already fetched.
+        """
+        with self._lock_for(installation_id):
+            entry = self.tokens.get(installation_id)
+            if token is None or (entry is not None and entry[0] == token):
+                self.tokens.pop(installation_id, None)
+        if self.redis is None:
+            return
+        if token is not None:
+            shared = self._load_shared(installation_id)
+            if shared is None or shared[0] != token:
+                return
+        try:
+            self.redis.delete(TOKEN_KEY_PREFIX + str(installation_id))
+        except Exception as e:
+            logger.warning(f"Failed to invalidate shared installation token: {e}")
+
+_token_cache = InstallationTokenCache()
+
+def get_installation_token(installation_id):
+    """Returns a valid installation token, or the placeholder token when the GitHub App is not configured."""
+    if not GITHUB_APP_ID or not GITHUB_PRIVATE_KEY:
+        logger.warning("GITHUB_APP_ID/GITHUB_PRIVATE_KEY not configured; using placeholder GitHub token.")
+        return PLACEHOLDER_GITHUB_TOKEN
+    token = _token_cache.get(installation_id)
+    register_installation_token(token, installation_id)  # GitHub clients rate limit per installation
+    return token
+
+def invalidate_installation_token(installation_id, token=None):
+    """Forgets an installation's token (or only `token`, if still cached) so the next call exchanges a new one."""
+    _token_cache.invalidate(installation_id, token)
@@ -0,0 +1,462 @@
+# worker/github_client.py
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from .metrics import record_retry
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+GITHUB_API_BASE_URL = os.getenv("GITHUB_API_BASE_URL", "https://api.github.com")
+# Token returned when the GitHub App is not configured; requests made with it are only simulated
+PLACEHOLDER_GITHUB_TOKEN = "ghs_placeholder_token"
+GITHUB_POOL_SIZE = int(os.getenv("GITHUB_POOL_SIZE", "20"))
+GITHUB_TIMEOUT_SECONDS = float(os.getenv("GITHUB_TIMEOUT_SECONDS", "30"))
+GITHUB_ETAG_CACHE_SIZE = int(os.getenv("GITHUB_ETAG_CACHE_SIZE", "1024"))
+# Rate limiters (one per installation) and token -> installation entries kept per process
+GITHUB_RATE_LIMITERS_MAX = int(os.getenv("GITHUB_RATE_LIMITERS_MAX", "1024"))
+# Stop writing and wait for the reset once fewer than this many requests remain in the window
+RATE_LIMIT_RESERVE = int(os.getenv("GITHUB_RATE_LIMIT_RESERVE", "10"))
+# Longest a request waits in-process for the rate limit; longer waits raise GitHubRateLimited so the task is retried later
+RATE_LIMIT_MAX_WAIT_SECONDS = float(os.getenv("GITHUB_RATE_LIMIT_MAX_WAIT_SECONDS", "5"))
+MAX_RATE_LIMIT_RETRIES = 3
+
+DEFAULT_ACCEPT = "application/vnd.github+json"
+DIFF_ACCEPT = "application/vnd.github.v3.diff"
+USER_AGENT = "codeguardian-ai"
+
+# --- Responses & Errors ---
+
+class GitHubResponse:
+    """Transport-independent response shared by the sync and async clients."""
+
+    def __init__(self, status_code, headers, content, url, from_cache=False):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.url = url
+        self.from_cache = from_cache
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise GitHubAPIError(self)
+
+class GitHubAPIError(Exception):
+    def __init__(self, response):
+        self.response = response
+        self.status_code = response.status_code
+        super().__init__(f"GitHub API returned {response.status_code} for {response.url}: {response.text[:500]}")
+
+class GitHubRateLimited(Exception):
+    """The GitHub rate limit blocks requests for longer than the in-process wait; retry_after says when to try again."""
+
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        super().__init__(f"GitHub rate limited for another {retry_after:.1f}s")
+
+# --- Token Attribution ---
+# GitHub meters quota per installation, but requests only carry a token that rotates hourly.
+# github_auth registers every token it hands out so limiters can be keyed by installation;
+# tokens are only ever held as digests here.
+
+def token_digest(token):
+    return hashlib.sha256((token or "").encode("utf-8")).hexdigest()[:16]
+
+_token_installations = OrderedDict()  # token digest -> installation id
+_token_installations_lock = threading.Lock()
+
+def register_installation_token(token, installation_id):
+    digest = token_digest(token)
+    with _token_installations_lock:
+        _token_installations[digest] = installation_id
+        _token_installations.move_to_end(digest)
+        while len(_token_installations) > GITHUB_RATE_LIMITERS_MAX:
+            _token_installations.popitem(last=False)
+
+def installation_for_token(token):
+    """The installation a token was issued for, or None (App JWTs, unknown or forgotten tokens)."""
+    with _token_installations_lock:
+        return _token_installations.get(token_digest(token))
+
+# --- Rate Limiting ---
+
+class GitHubRateLimiter:
+    """Paces requests using the X-RateLimit-* and Retry-After headers GitHub returns."""
+
+    def __init__(self, reserve=RATE_LIMIT_RESERVE, max_wait=RATE_LIMIT_MAX_WAIT_SECONDS):
+        self.reserve = reserve
+        self.max_wait = max_wait
+        self.remaining = None
+        self.reset_at = 0.0
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def delay(self):
+        """Seconds to wait before the next request: non-zero only when GitHub told us to back off
+        (Retry-After) or the primary quota is nearly exhausted.
+
+        Raises GitHubRateLimited if that is longer than max_wait, so the Celery task can be
+        retried once the limit resets rather than holding a worker slot until then.
+        """
+        with self.lock:
+            now = time.time()
+            delay = max(self.blocked_until - now, 0.0)
+            if self.remaining is not None and self.remaining <= self.reserve:
+                delay = max(delay, self.reset_at - now)
+        if delay > self.max_wait:
+            raise GitHubRateLimited(delay)
+        if delay > 0:
+            logger.info(f"GitHub rate limit: waiting {delay:.1f}s before the next request.")
+        return delay
+
+    def update(self, response):
+        headers = response.headers
+        with self.lock:
+            if "X-RateLimit-Remaining" in headers:
+                self.remaining = int(headers["X-RateLimit-Remaining"])
+            if "X-RateLimit-Reset" in headers:
+                self.reset_at = float(headers["X-RateLimit-Reset"])
+            retry_after = headers.get("Retry-After")
+            if retry_after is not None:
+                self.blocked_until = time.time() + float(retry_after)
+            elif response.status_code in (403, 429) and self.remaining == 0:
+                self.blocked_until = self.reset_at
+
+    @staticmethod
+    def is_rate_limited(response):
+        if response.status_code == 429:
+            return True
+        # Secondary rate limits are reported as 403 with Retry-After or an exhausted quota
+        return response.status_code == 403 and (
+            "Retry-After" in response.headers or response.headers.get("X-RateLimit-Remaining") == "0"
+        )
+
+# --- Conditional Request Cache ---
+
+class ETagCache:
+    """LRU of GET responses keyed by URL, Accept and token, replayed when GitHub answers 304."""
+
+    def __init__(self, max_entries=GITHUB_ETAG_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(url, accept, token):
+        # Responses depend on who asks, but raw tokens should not sit around as dict keys
+        return (url, accept, token_digest(token))
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, response):
+        validators = {}
+        if response.headers.get("ETag"):
+            validators["If-None-Match"] = response.headers["ETag"]
+        if response.headers.get("Last-Modified"):
+            validators["If-Modified-Since"] = response.headers["Last-Modified"]
+        if not validators:
+            return
+        with self.lock:
+            self.entries[key] = (validators, response)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+# --- Clients ---
+
+def _next_link(headers):
+    """Extracts the rel="next" URL from a GitHub Link header."""
+    for part in headers.get("Link", "").split(","):
+        section = part.split(";")
+        if len(section) >= 2 and 'rel="next"' in section[1]:
+            return section[0].strip().strip("<>")
+    return None
+
+class _GitHubClientBase:
+    def __init__(self, base_url=GITHUB_API_BASE_URL):
+        self.base_url = base_url.rstrip("/")
+        self.etags = ETagCache()
+        self.rate_limiters = OrderedDict()  # LRU, at most GITHUB_RATE_LIMITERS_MAX
+        self.rate_limiters_lock = threading.Lock()
+
+    def rate_limiter(self, token):
+        """One limiter per installation (GitHub's quota unit), so throttling survives token rotation.
+
+        Tokens not issued by github_auth (e.g. the App JWT) get a limiter of their own, keyed by digest.
+        """
+        installation_id = installation_for_token(token)
+        key = f"installation:{installation_id}" if installation_id is not None else f"token:{token_digest(token)}"
+        with self.rate_limiters_lock:
+            limiter = self.rate_limiters.get(key)
+            if limiter is None:
+                limiter = self.rate_limiters[key] = GitHubRateLimiter()
+            self.rate_limiters.move_to_end(key)
+            while len(self.rate_limiters) > GITHUB_RATE_LIMITERS_MAX:
+                self.rate_limiters.popitem(last=False)
+            return limiter
+
+    def replacement_token(self, token):
+        """A fresh token to retry with once GitHub rejected `token` (401), or None.
+
+        Only installation tokens issued by github_auth can be replaced (e.g. one revoked
+        before it expired); the rejected token is dropped so no later caller is handed it.
+        """
+        installation_id = installation_for_token(token)
+        if installation_id is None:
+            return None
+        from .github_auth import get_installation_token, invalidate_installation_token  # github_auth imports this module
+        logger.warning(f"GitHub rejected the token of installation {installation_id}; retrying with a fresh one.")
+        record_retry("github_unauthorized")
+        try:
+            invalidate_installation_token(installation_id, token)
+            fresh = get_installation_token(installation_id)
+        except Exception as e:
+            logger.error(f"Failed to refresh the token of installation {installation_id}: {e}")
+            return None
+        return fresh if fresh and fresh != token else None
+
+    def url(self, path):
+        return path if path.startswith("http") else f"{self.base_url}{path}"
+
+    def headers(self, token, accept):
+        headers = {"Accept": accept, "Accept-Encoding": "gzip", "User-Agent": USER_AGENT}
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        return headers
+
+    def _prepare(self, method, path, token, accept, conditional):
+        url = self.url(path)
+        headers = self.headers(token, accept)
+        cache_key = cached = None
+        if conditional and method == "GET":
+            cache_key = self.etags.key(url, accept, token)
+            cached = self.etags.get(cache_key)
+            if cached is not None:
+                headers.update(cached[0])
+        return url, headers, cache_key, cached
+
+    def _finish(self, response, cache_key, cached):
+        if response.status_code == 304 and cached is not None:
+            # Conditional hits do not count against the rate limit
+            stored = cached[1]
+            return GitHubResponse(stored.status_code, stored.headers, stored.content, stored.url, from_cache=True)
+        if cache_key is not None and response.status_code == 200:
+            self.etags.put(cache_key, response)
+        return response
+
+class GitHubClient(_GitHubClientBase):
+    """Synchronous client backed by one pooled keep-alive requests.Session per process."""
+
+    def __init__(self, base_url=GITHUB_API_BASE_URL, pool_size=GITHUB_POOL_SIZE):
+        super().__init__(base_url)
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        self.session = requests.Session()
+        # Retry connection errors and 5xx on idempotent requests only; rate limits are handled below
+        retries = Retry(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504), allowed_methods=("GET", "HEAD"))
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method, path, token=None, accept=DEFAULT_ACCEPT, conditional=True, reauthorize=True, **kwargs):
+        url, headers, cache_key, cached = self._prepare(method, path, token, accept, conditional)
+        limiter = self.rate_limiter(token)
+        for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+            delay = limiter.delay()
+            if delay > 0:
+                time.sleep(delay)
+            raw = self.session.request(method, url, headers=headers, timeout=GITHUB_TIMEOUT_SECONDS, **kwargs)
+            response = GitHubResponse(raw.status_code, raw.headers, raw.content, url)
+            limiter.update(response)
+            if not limiter.is_rate_limited(response) or attempt == MAX_RATE_LIMIT_RETRIES:
+                break
+            logger.warning(f"GitHub rate limited {method} {url} (status {response.status_code}); retrying.")
+            record_retry("github_rate_limit")
+        if response.status_code == 401 and reauthorize:
+            fresh = self.replacement_token(token)
+            if fresh is not None:
+                return self.request(method, path, fresh, accept, conditional, reauthorize=False, **kwargs)
+        return self._finish(response, cache_key, cached)
+
+    def get(self, path, token=None, **kwargs):
+        return self.request("GET", path, token, **kwargs)
+
+    def post(self, path, token=None, **kwargs):
+        return self.request("POST", path, token, **kwargs)
+
+    def paginate(self, path, token=None, per_page=100, **kwargs):
+        """Yields items from every page of a list endpoint, following Link headers."""
+        separator = "&" if "?" in path else "?"
+        url = f"{path}{separator}per_page={per_page}"
+        while url:
+            response = self.get(url, token, **kwargs)
+            response.raise_for_status()
+            yield from response.json()
+            url = _next_link(response.headers)
+
+    def stream(self, path, token=None, accept=DEFAULT_ACCEPT, chunk_size=64 * 1024, reauthorize=True):
+        """Yields the body of a GET in byte chunks without holding it in memory (e.g. huge diffs).
+
+        Raises GitHubAPIError before the first chunk on an error status. Streamed bodies
+        bypass the ETag cache, which would otherwise have to keep a copy of them.
+        """
+        url = self.url(path)
+        headers = self.headers(token, accept)
+        limiter = self.rate_limiter(token)
+        for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+            delay = limiter.delay()
+            if delay > 0:
+                time.sleep(delay)
+            raw = self.session.get(url, headers=headers, timeout=GITHUB_TIMEOUT_SECONDS, stream=True)
+            if raw.status_code < 400:
+                limiter.update(GitHubResponse(raw.status_code, raw.headers, b"", url))
+                break
+            response = GitHubResponse(raw.status_code, raw.headers, raw.content, url)  # Error bodies are small
+            limiter.update(response)
+            if response.status_code == 401 and reauthorize:
+                fresh = self.replacement_token(token)
+                if fresh is not None:
+                    yield from self.stream(path, fresh, accept, chunk_size, reauthorize=False)
+                    return
+            if not limiter.is_rate_limited(response) or attempt == MAX_RATE_LIMIT_RETRIES:
+                raise GitHubAPIError(response)
+            logger.warning(f"GitHub rate limited GET {url} (status {response.status_code}); retrying.")
+            record_retry("github_rate_limit")
+        try:
+            yield from raw.iter_content(chunk_size)
+        finally:
+            raw.close()
+
+    def close(self):
+        self.session.close()
+
+class AsyncGitHubClient(_GitHubClientBase):
+    """Asyncio client backed by a pooled keep-alive httpx.AsyncClient."""
+
+    def __init__(self, base_url=GITHUB_API_BASE_URL, pool_size=GITHUB_POOL_SIZE):
+        super().__init__(base_url)
+        import httpx
+
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        transport = httpx.AsyncHTTPTransport(retries=3)  # Connection-level retries
+        self.client = httpx.AsyncClient(limits=limits, transport=transport, timeout=GITHUB_TIMEOUT_SECONDS)
+
+    async def request(self, method, path, token=None, accept=DEFAULT_ACCEPT, conditional=True, reauthorize=True, **kwargs):
+        import asyncio  # Imported where used: it dominates import time for sync-only callers (e.g. Lambda)
+        url, headers, cache_key, cached = self._prepare(method, path, token, accept, conditional)
+        limiter = self.rate_limiter(token)
+        for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+            delay = limiter.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            raw = await self.client.request(method, url, headers=headers, **kwargs)
+            response = GitHubResponse(raw.status_code, raw.headers, raw.content, url)
+            limiter.update(response)
+            if not limiter.is_rate_limited(response) or attempt == MAX_RATE_LIMIT_RETRIES:
+                break
+            logger.warning(f"GitHub rate limited {method} {url} (status {response.status_code}); retrying.")
+            record_retry("github_rate_limit")
+        if response.status_code == 401 and reauthorize:
+            fresh = await asyncio.to_thread(self.replacement_token, token)  # Exchanging a token blocks
+            if fresh is not None:
+                return await self.request(method, path, fresh, accept, conditional, reauthorize=False, **kwargs)
+        return self._finish(response, cache_key, cached)
+
+    async def get(self, path, token=None, **kwargs):
+        return await self.request("GET", path, token, **kwargs)
+
+    async def post(self, path, token=None, **kwargs):
+        return await self.request("POST", path, token, **kwargs)
+
+    async def paginate(self, path, token=None, per_page=100, **kwargs):
+        separator = "&" if "?" in path else "?"
+        url = f"{path}{separator}per_page={per_page}"
+        while url:
+            response = await self.get(url, token, **kwargs)
+            response.raise_for_status()
+            for item in response.json():
+                yield item
+            url = _next_link(response.headers)
+
+    async def stream(self, path, token=None, accept=DEFAULT_ACCEPT, chunk_size=64 * 1024, reauthorize=True):
+        """Async counterpart of GitHubClient.stream(): yields the body of a GET in byte chunks."""
+        import asyncio
+        url = self.url(path)
+        headers = self.headers(token, accept)
+        limiter = self.rate_limiter(token)
+        for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+            delay = limiter.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            raw = await self.client.send(self.client.build_request("GET", url, headers=headers), stream=True)
+            if raw.status_code < 400:
+                limiter.update(GitHubResponse(raw.status_code, raw.headers, b"", url))
+                break
+            response = GitHubResponse(raw.status_code, raw.headers, await raw.aread(), url)
+            await raw.aclose()
+            limiter.update(response)
+            if response.status_code == 401 and reauthorize:
+                fresh = await asyncio.to_thread(self.replacement_token, token)
+                if fresh is not None:
+                    async for chunk in self.stream(path, fresh, accept, chunk_size, reauthorize=False):
+                        yield chunk
+                    return
+            if not limiter.is_rate_limited(response) or attempt == MAX_RATE_LIMIT_RETRIES:
+                raise GitHubAPIError(response)
+            logger.warning(f"GitHub rate limited GET {url} (status {response.status_code}); retrying.")
+            record_retry("github_rate_limit")
+        try:
+            async for chunk in raw.aiter_bytes(chunk_size):
+                yield chunk
+        finally:
+            await raw.aclose()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+# --- Per-Process Instances ---
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+def get_github_client():
+    """Returns this process's shared sync client (re-created after a Celery prefork fork)."""
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                _client = GitHubClient()
+                _client_pid = os.getpid()
+    return _client
+
+_async_clients = {}
+
+def get_async_github_client():
+    """Returns the shared async client for the running event loop (httpx clients are loop-bound)."""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = AsyncGitHubClient()
+    return client
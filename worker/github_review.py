@@ -0,0 +1,203 @@
+# worker/github_review.py
+
+import os
+import logging
+import threading
+
+from .github_client import get_github_client, GitHubAPIError, PLACEHOLDER_GITHUB_TOKEN
+from .metrics import stage_timer
+from .fingerprints import assign_fingerprints, fingerprint_marker
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# GitHub rejects (or silently times out on) reviews carrying very many inline comments
+MAX_COMMENTS_PER_REVIEW = int(os.getenv("GITHUB_MAX_COMMENTS_PER_REVIEW", "50"))
+# GitHub's hard limit on a comment or review body
+MAX_BODY_CHARS = 65536
+# After the first finding streams in, wait this long for more before posting the early review
+EARLY_REVIEW_LINGER_SECONDS = float(os.getenv("GITHUB_EARLY_REVIEW_LINGER_SECONDS", "2"))
+
+# --- Review Construction ---
+
+def finding_key(finding):
+    """Identity used to dedupe findings across chunks and reviews."""
+    return (finding.get("file_path"), finding.get("line"), finding.get("type"))
+
+def format_finding_comment(finding):
+    """Builds the markdown body for a single finding (concise, actionable)."""
+    # The hidden fingerprint marker must survive truncation; it is how re-runs recognize the comment
+    marker = fingerprint_marker(finding)
+    return (
+        f"**CodeGuardian AI Security Finding:**\n\n"
+        f"**Type:** {finding.get('type', 'N/A')}\n"
+        f"**Risk:** {finding.get('risk', 'N/A')}\n\n"
+        f"**Suggestion:** {finding.get('suggestion', 'N/A')}"
+    )[:MAX_BODY_CHARS - len(marker)] + marker
+
+def commentable_lines(file_diffs):
+    """Returns {path: set(line numbers)} for new-side lines that GitHub accepts inline comments on."""
+    lines_by_path = {}
+    for file_diff in file_diffs:
+        lines = lines_by_path.setdefault(file_diff.path, set())
+        for hunk in file_diff.hunks:
+            new_line = hunk.new_start
+            for diff_line in hunk.lines:
+                if diff_line.startswith("-") or diff_line.startswith("\\"):
+                    continue
+                lines.add(new_line)
+                new_line += 1
+    return lines_by_path
+
+def build_review_comment(finding):
+    return {"path": finding["file_path"], "line": finding["line"], "side": "RIGHT", "body": format_finding_comment(finding)}
+
+def split_anchored_findings(findings, file_diffs):
+    """Splits findings into ones that can be inline comments and ones that cannot be anchored to the diff."""
+    anchors = commentable_lines(file_diffs)
+    anchored, unanchored = [], []
+    for finding in findings:
+        try:
+            line = int(finding.get("line"))
+        except (TypeError, ValueError):
+            line = None
+        if line in anchors.get(finding.get("file_path"), ()):
+            anchored.append(dict(finding, line=line))
+        else:
+            unanchored.append(finding)
+    return anchored, unanchored
+
+def build_review_body(total_findings, unanchored, part=None, parts=None):
+    body = f"**CodeGuardian AI** found {total_findings} potential security issue(s) in this pull request."
+    if parts and parts > 1:
+        body += f" (review {part} of {parts})"
+    if unanchored:
+        body += "\n\nThe following findings could not be attached to a changed line:\n"
+        for finding in unanchored:
+            location = f"`{finding.get('file_path', 'unknown_file')}`"
+            if finding.get("line"):
+                location += f" line {finding.get('line')}"
+            body += f"\n- {location}: **{finding.get('type', 'N/A')}** - {finding.get('suggestion', 'N/A')}"
+            body += fingerprint_marker(finding).replace("\n", " ")
+    if len(body) > MAX_BODY_CHARS:
+        body = body[:MAX_BODY_CHARS - 20] + "\n\n...(truncated)"
+    return body
+
+# --- Posting ---
+
+def post_pr_review(token, repo_full_name, pr_number, commit_id, body, comments):
+    """Posts one PR review (event COMMENT) carrying all given inline comments."""
+    if token == PLACEHOLDER_GITHUB_TOKEN:
+        logger.info(f"Simulating posting review with {len(comments)} comment(s) to {repo_full_name}# {pr_number}")
+        return None
+    data = {"commit_id": commit_id, "body": body, "event": "COMMENT", "comments": comments}
+    # Pacing comes from the client's rate limiter, driven by GitHub's rate-limit headers
+    response = get_github_client().post(f"/repos/{repo_full_name}/pulls/{pr_number}/reviews", token, json=data)
+    response.raise_for_status()
+    return response.json()
+
+def post_findings_review(token, repo_full_name, pr_number, commit_id, findings, file_diffs, posted=None):
+    """Posts all findings as as few PR reviews as GitHub's per-review limits allow.
+
+    With posted (the PR's PostedFindings), findings already on the PR are skipped and the
+    posted ones are added to it. Returns the number of reviews created.
+    """
+    with stage_timer("post"):
+        return _post_findings_review(token, repo_full_name, pr_number, commit_id, findings, file_diffs, posted)
+
+def _post_findings_review(token, repo_full_name, pr_number, commit_id, findings, file_diffs, posted):
+    assign_fingerprints(findings, file_diffs)
+    if posted is not None:
+        new_findings = posted.new_findings(findings)
+        if len(new_findings) < len(findings):
+            logger.info(
+                f"Skipping {len(findings) - len(new_findings)} finding(s) already posted to {repo_full_name}# {pr_number}."
+            )
+        findings = new_findings
+        if not findings:
+            return 0
+    anchored, unanchored = split_anchored_findings(findings, file_diffs)
+    batches = [anchored[i:i + MAX_COMMENTS_PER_REVIEW] for i in range(0, len(anchored), MAX_COMMENTS_PER_REVIEW)] or [[]]
+
+    for part, batch in enumerate(batches, start=1):
+        # Unanchored findings are listed once, in the first review's body
+        listed = unanchored if part == 1 else []
+        body = build_review_body(len(findings), listed, part, len(batches))
+        comments = [build_review_comment(finding) for finding in batch]
+        try:
+            post_pr_review(token, repo_full_name, pr_number, commit_id, body, comments)
+        except GitHubAPIError as e:
+            if e.status_code != 422 or not batch:
+                raise
+            # A stale anchor rejects the whole review; keep the findings by moving them into the body
+            logger.warning(f"GitHub rejected inline comments for {repo_full_name}# {pr_number}; posting them in the review body.")
+            body = build_review_body(len(findings), listed + batch, part, len(batches))
+            post_pr_review(token, repo_full_name, pr_number, commit_id, body, [])
+        if posted is not None:
+            posted.record(listed + batch)
+    return len(batches)
+
+class EarlyReviewPoster:
+    """Posts the first findings of an analysis while the LLM is still generating the rest.
+
+    Findings handed to add() as they stream in are collected for EARLY_REVIEW_LINGER_SECONDS
+    after the first one and posted as one review; finish() posts whatever was not covered.
+    That cuts time-to-first-comment to roughly the first finding's latency while keeping
+    the PR to at most one review more than a non-streaming run.
+    """
+
+    def __init__(self, token, repo_full_name, pr_number, commit_id, file_diffs, should_post=None,
+                 linger=EARLY_REVIEW_LINGER_SECONDS, posted=None):
+        self.token = token
+        self.repo_full_name = repo_full_name
+        self.pr_number = pr_number
+        self.commit_id = commit_id
+        self.file_diffs = file_diffs
+        self.should_post = should_post  # e.g. lambda: not superseded
+        self.linger = linger
+        self.posted = posted  # The PR's PostedFindings, when findings are deduped against the PR
+        self.lock = threading.Lock()
+        self.pending = []
+        self.posted_keys = set()
+        self.timer = None
+        self.reviews_posted = 0
+
+    def add(self, finding):
+        with self.lock:
+            if self.timer is None:
+                self.timer = threading.Timer(self.linger, self._post_early)
+                self.timer.daemon = True
+                self.timer.start()
+            elif not self.timer.is_alive():
+                return  # The early review is out; finish() posts the rest
+            self.pending.append(finding)
+
+    def _post_early(self):
+        with self.lock:
+            batch, self.pending = self.pending, []
+        if not batch or (self.should_post is not None and not self.should_post()):
+            return
+        try:
+            self.reviews_posted += post_findings_review(
+                self.token, self.repo_full_name, self.pr_number, self.commit_id, batch, self.file_diffs, self.posted,
+            )
+        except Exception as e:
+            # Not fatal: finish() posts these along with the rest
+            logger.warning(f"Early review for {self.repo_full_name}# {self.pr_number} failed: {e}")
+            return
+        self.posted_keys.update(finding_key(finding) for finding in batch)
+        logger.info(f"Posted {len(batch)} early finding(s) to {self.repo_full_name}# {self.pr_number}.")
+
+    def finish(self, findings):
+        """Posts every finding not already covered by the early review; returns reviews posted in total."""
+        with self.lock:
+            timer = self.timer
+        if timer is not None:
+            timer.cancel()  # No-op if the early post already started; join() then waits for it
+            timer.join()
+        remaining = [finding for finding in findings if finding_key(finding) not in self.posted_keys]
+        if remaining:
+            self.reviews_posted += post_findings_review(
+                self.token, self.repo_full_name, self.pr_number, self.commit_id, remaining, self.file_diffs, self.posted,
+            )
+        return self.reviews_posted
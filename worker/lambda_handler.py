@@ -0,0 +1,79 @@
+# worker/lambda_handler.py
+"""AWS Lambda entry point for the SQS-triggered analysis worker (worker.lambda_handler.handler).
+
+Cold starts only pay for this module: secrets, the analysis pipeline and its SDKs are
+loaded on the first invocation, and Celery is never imported. Everything created then
+(secrets in os.environ, the pooled GitHub client, the OpenAI client, the installation
+token cache) lives in module globals and is reused by every warm invocation.
+"""
+
+import os
+import json
+import logging
+
+logger = logging.getLogger()
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+# --- Configuration ---
+# Name of the app_secrets entry (infra/__main__.py); its JSON keys become environment variables
+SECRETS_MANAGER_SECRET_NAME = os.getenv("SECRETS_MANAGER_SECRET_NAME")
+# Initial secret values deployed by infra that must not be mistaken for real configuration
+PLACEHOLDER_SECRET_PREFIXES = ("YOUR_", "placeholder")
+
+_secrets_loaded = False
+_run_pr_analysis = None
+
+def load_secrets():
+    """Copies the Secrets Manager entry into os.environ, once per container.
+
+    Variables already set on the function take precedence over the secret.
+    """
+    global _secrets_loaded
+    if _secrets_loaded or not SECRETS_MANAGER_SECRET_NAME:
+        return
+    import boto3  # botocore alone costs more import time than the rest of the worker
+
+    client = boto3.client("secretsmanager", region_name=os.getenv("AWS_REGION"))
+    secret = json.loads(client.get_secret_value(SecretId=SECRETS_MANAGER_SECRET_NAME)["SecretString"])
+    loaded = []
+    for key, value in secret.items():
+        value = str(value)
+        if not value or value.startswith(PLACEHOLDER_SECRET_PREFIXES) or key in os.environ:
+            continue
+        os.environ[key] = value
+        loaded.append(key)
+    _secrets_loaded = True
+    logger.info(f"Loaded {len(loaded)} secret(s) from {SECRETS_MANAGER_SECRET_NAME}.")
+
+def get_pipeline():
+    """Imports the analysis pipeline on first use - after the secrets, since its configuration is read at import."""
+    global _run_pr_analysis
+    if _run_pr_analysis is None:
+        load_secrets()
+        from .analysis import run_pr_analysis
+        _run_pr_analysis = run_pr_analysis
+    return _run_pr_analysis
+
+def handler(event, context):
+    """Analyzes the PRs in an SQS batch; each record body is the webhook's task_data JSON.
+
+    Returns a partial batch response: only failed messages (and later messages of the
+    same FIFO group) are redelivered after their visibility timeout, and eventually
+    dead-lettered, which takes the place of Celery's task retries.
+    """
+    run_pr_analysis = get_pipeline()
+    from .coalescing import AnalysisSuperseded
+    from .sqs_batch import process_sqs_batch, decode_record
+
+    def process_record(record):
+        pr_data = decode_record(record)
+        try:
+            result = run_pr_analysis(pr_data)
+        except AnalysisSuperseded as e:
+            result = {"status": "superseded", "message": str(e)}
+        logger.info(f"Message {record.get('messageId')} ({pr_data.get('repo_full_name')}# {pr_data.get('pr_number')}): {result}")
+
+    response = process_sqs_batch(event.get("Records", []), process_record)
+    if response["batchItemFailures"]:
+        logger.warning(f"{len(response['batchItemFailures'])} of {len(event.get('Records', []))} message(s) failed.")
+    return response
@@ -0,0 +1,220 @@
+# worker/llm_cache.py
+
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+LLM_CACHE_SQLITE_PATH = os.getenv("LLM_CACHE_SQLITE_PATH", "/tmp/codeguardian_llm_cache.sqlite3")
+# Only enforced by the SQLite fallback; Redis relies on TTLs plus its own maxmemory-policy (allkeys-lru)
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "50000"))
+
+KEY_PREFIX = "codeguardian:llm_cache:"
+STATS_KEY = "codeguardian:llm_cache:stats"
+
+HUNK_HEADER_RE = re.compile(r"^@@ -\d+(?:,\d+)? \+\d+(?:,\d+)? @@")
+
+# --- Keys & Normalization ---
+
+def normalize_chunk_text(chunk):
+    """Returns the chunk's diff text with everything position- or blob-specific removed.
+
+    Hunk line numbers and "index <sha>..<sha>" lines change whenever an unrelated part of
+    the file changes, so they are dropped; trailing whitespace and CRLF endings are ignored.
+    """
+    lines = []
+    for file_diff, hunks in chunk.parts:
+        lines.append(f"file {file_diff.path}")
+        for hunk in hunks:
+            lines.append(HUNK_HEADER_RE.sub("@@", hunk.header))
+            lines.extend(line.rstrip() for line in hunk.lines)
+    return "\n".join(lines)
+
+def make_cache_key(chunk, model_name, prompt_version):
+    """Content-addressed key: normalized hunks + model + prompt version."""
+    digest = hashlib.sha256()
+    for part in (model_name, prompt_version, normalize_chunk_text(chunk)):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def _hunks_for(chunk):
+    return [hunk for _, hunks in chunk.parts for hunk in hunks]
+
+def relativize_findings(findings, chunk):
+    """Rewrites absolute line numbers as (hunk index, offset) so cached results survive line shifts."""
+    hunks = _hunks_for(chunk)
+    stored = []
+    for finding in findings:
+        finding = dict(finding)
+        line = finding.get("line")
+        if isinstance(line, int):
+            for index, hunk in enumerate(hunks):
+                if hunk.file_path == finding.get("file_path") and hunk.new_start <= line < hunk.new_start + max(hunk.new_length, 1):
+                    finding["line"] = {"hunk": index, "offset": line - hunk.new_start}
+                    break
+        stored.append(finding)
+    return stored
+
+def absolutize_findings(stored, chunk):
+    """Inverse of relativize_findings, using the hunk positions of the current diff."""
+    hunks = _hunks_for(chunk)
+    findings = []
+    for finding in stored:
+        finding = dict(finding)
+        line = finding.get("line")
+        if isinstance(line, dict):
+            index = line.get("hunk", 0)
+            if index < len(hunks):
+                finding["line"] = hunks[index].new_start + line.get("offset", 0)
+            else:
+                finding["line"] = 1
+        findings.append(finding)
+    return findings
+
+# --- Backends ---
+
+class RedisCacheBackend:
+    """Shares cached results across all workers through the Celery Redis instance."""
+
+    name = "redis"
+
+    def __init__(self, redis_url):
+        import redis  # Imported lazily so the SQLite fallback works without a Redis server
+        self.client = redis.Redis.from_url(redis_url, socket_timeout=2, socket_connect_timeout=2)
+        self.client.ping()
+
+    def get(self, key):
+        value = self.client.get(KEY_PREFIX + key)
+        return value.decode("utf-8") if value is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.set(KEY_PREFIX + key, value, ex=ttl)
+
+    def incr_stat(self, field):
+        self.client.hincrby(STATS_KEY, field, 1)
+
+class SQLiteCacheBackend:
+    """Local fallback with TTL expiry and LRU eviction once LLM_CACHE_MAX_ENTRIES is reached."""
+
+    name = "sqlite"
+
+    def __init__(self, path, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_last_access ON llm_cache (last_access)")
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value, expires_at FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at < now:
+                self.conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                return None
+            self.conn.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (now, key))
+            return value
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, now + ttl, now),
+            )
+            self._evict(now)
+
+    def _evict(self, now):
+        self.conn.execute("DELETE FROM llm_cache WHERE expires_at < ?", (now,))
+        (count,) = self.conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self.conn.execute(
+                "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY last_access LIMIT ?)",
+                (overflow,),
+            )
+
+    def incr_stat(self, field):
+        pass  # Local counters in LLMResultCache.stats are the source of truth for SQLite
+
+# --- Cache ---
+
+class LLMResultCache:
+    """Caches parsed LLM findings per diff chunk, keyed by normalized hunk content."""
+
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+        self.stats = {"hits": 0, "misses": 0, "errors": 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, field):
+        with self._stats_lock:
+            self.stats[field] += 1
+        try:
+            self.backend.incr_stat(field)
+        except Exception as e:
+            logger.debug(f"Failed to record LLM cache {field}: {e}")
+
+    def get(self, chunk, model_name, prompt_version):
+        """Returns cached findings for the chunk, or None on a miss."""
+        key = make_cache_key(chunk, model_name, prompt_version)
+        try:
+            value = self.backend.get(key)
+        except Exception as e:
+            logger.warning(f"LLM cache lookup failed ({self.backend.name}): {e}")
+            self._count("errors")
+            return None
+        if value is None:
+            self._count("misses")
+            return None
+        self._count("hits")
+        return absolutize_findings(json.loads(value), chunk)
+
+    def set(self, chunk, model_name, prompt_version, findings):
+        key = make_cache_key(chunk, model_name, prompt_version)
+        try:
+            self.backend.set(key, json.dumps(relativize_findings(findings, chunk)), self.ttl)
+        except Exception as e:
+            logger.warning(f"LLM cache write failed ({self.backend.name}): {e}")
+            self._count("errors")
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_llm_cache():
+    """Returns the process-wide cache (Redis if reachable, else SQLite), or None when disabled."""
+    global _cache
+    if not LLM_CACHE_ENABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                try:
+                    backend = RedisCacheBackend(REDIS_URL)
+                except Exception as e:
+                    logger.warning(f"Redis unavailable for LLM cache ({e}); falling back to SQLite at {LLM_CACHE_SQLITE_PATH}.")
+                    backend = SQLiteCacheBackend(LLM_CACHE_SQLITE_PATH, LLM_CACHE_MAX_ENTRIES)
+                _cache = LLMResultCache(backend, LLM_CACHE_TTL_SECONDS)
+                logger.info(f"LLM result cache enabled using the {backend.name} backend.")
+    return _cache
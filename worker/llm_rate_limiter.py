@@ -0,0 +1,227 @@
+# worker/llm_rate_limiter.py
+
+import os
+import time
+import random
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Set these to the provider quota for LLM_MODEL_NAME (shared by every worker)
+LLM_REQUESTS_PER_MINUTE = int(os.getenv("LLM_REQUESTS_PER_MINUTE", "500"))
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", "30000"))
+# Longest a call waits for capacity before the task is retried later instead
+LLM_RATE_LIMIT_MAX_WAIT_SECONDS = float(os.getenv("LLM_RATE_LIMIT_MAX_WAIT_SECONDS", "30"))
+
+KEY_PREFIX = "codeguardian:llm_rate:"
+
+class LLMCapacityUnavailable(Exception):
+    """No LLM capacity within the maximum wait; retry_after says when to try again."""
+
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        super().__init__(f"LLM rate limit capacity unavailable for another {retry_after:.1f}s")
+
+# Token bucket over two dimensions (requests and tokens per minute), refilled continuously.
+# Uses Redis server time so worker clock skew doesn't matter. Returns "0" once capacity
+# is reserved, otherwise the number of seconds to wait (as a string to keep fractions).
+_RESERVE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local blocked_until = tonumber(redis.call('GET', KEYS[3]) or '0')
+if blocked_until > now then
+  return tostring(blocked_until - now)
+end
+local function level(key, capacity)
+  local v = redis.call('HMGET', key, 'level', 'ts')
+  local lvl = tonumber(v[1]) or capacity
+  local ts = tonumber(v[2]) or now
+  return math.min(capacity, lvl + (now - ts) * capacity / 60.0)
+end
+local req_capacity = tonumber(ARGV[1])
+local tok_capacity = tonumber(ARGV[2])
+local need = math.min(tonumber(ARGV[3]), tok_capacity)
+local requests = level(KEYS[1], req_capacity)
+local tokens = level(KEYS[2], tok_capacity)
+local wait = 0
+if requests < 1 then wait = math.max(wait, (1 - requests) * 60.0 / req_capacity) end
+if tokens < need then wait = math.max(wait, (need - tokens) * 60.0 / tok_capacity) end
+if wait > 0 then
+  return tostring(wait)
+end
+redis.call('HSET', KEYS[1], 'level', requests - 1, 'ts', now)
+redis.call('HSET', KEYS[2], 'level', tokens - need, 'ts', now)
+redis.call('EXPIRE', KEYS[1], 120)
+redis.call('EXPIRE', KEYS[2], 120)
+return '0'
+"""
+
+# Corrects the token bucket once the provider reports actual usage (delta may be negative)
+_ADJUST_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local capacity = tonumber(ARGV[1])
+local v = redis.call('HMGET', KEYS[1], 'level', 'ts')
+local lvl = tonumber(v[1]) or capacity
+local ts = tonumber(v[2]) or now
+lvl = math.min(capacity, lvl + (now - ts) * capacity / 60.0) - tonumber(ARGV[2])
+redis.call('HSET', KEYS[1], 'level', lvl, 'ts', now)
+redis.call('EXPIRE', KEYS[1], 120)
+return tostring(lvl)
+"""
+
+# --- Backends ---
+
+class RedisBucketBackend:
+    """Shares capacity across all Celery workers."""
+
+    def __init__(self, client, scope):
+        self.client = client
+        self.keys = [f"{KEY_PREFIX}{scope}:requests", f"{KEY_PREFIX}{scope}:tokens", f"{KEY_PREFIX}{scope}:blocked_until"]
+        self.reserve_script = client.register_script(_RESERVE_SCRIPT)
+        self.adjust_script = client.register_script(_ADJUST_SCRIPT)
+
+    def try_reserve(self, rpm, tpm, tokens):
+        return float(self.reserve_script(keys=self.keys, args=[rpm, tpm, tokens]))
+
+    def adjust(self, tpm, delta):
+        self.adjust_script(keys=[self.keys[1]], args=[tpm, delta])
+
+    def block_for(self, seconds):
+        # Server time would be ideal, but a Retry-After is coarse enough for the local clock
+        self.client.set(self.keys[2], time.time() + seconds, ex=max(int(seconds) + 1, 1))
+
+class LocalBucketBackend:
+    """In-process fallback used when Redis is unreachable (limits then apply per worker)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.levels = {}
+        self.blocked_until = 0.0
+
+    def _level(self, name, capacity, now):
+        level, ts = self.levels.get(name, (capacity, now))
+        return min(capacity, level + (now - ts) * capacity / 60.0)
+
+    def try_reserve(self, rpm, tpm, tokens):
+        with self.lock:
+            now = time.time()
+            if self.blocked_until > now:
+                return self.blocked_until - now
+            need = min(tokens, tpm)
+            requests = self._level("requests", rpm, now)
+            available_tokens = self._level("tokens", tpm, now)
+            wait = 0.0
+            if requests < 1:
+                wait = max(wait, (1 - requests) * 60.0 / rpm)
+            if available_tokens < need:
+                wait = max(wait, (need - available_tokens) * 60.0 / tpm)
+            if wait > 0:
+                return wait
+            self.levels["requests"] = (requests - 1, now)
+            self.levels["tokens"] = (available_tokens - need, now)
+            return 0.0
+
+    def adjust(self, tpm, delta):
+        with self.lock:
+            now = time.time()
+            self.levels["tokens"] = (self._level("tokens", tpm, now) - delta, now)
+
+    def block_for(self, seconds):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.time() + seconds)
+
+# --- Limiter ---
+
+class LLMRateLimiter:
+    """Reserves requests/min and tokens/min capacity before every LLM call."""
+
+    def __init__(self, backend, requests_per_minute=LLM_REQUESTS_PER_MINUTE, tokens_per_minute=LLM_TOKENS_PER_MINUTE,
+                 max_wait=LLM_RATE_LIMIT_MAX_WAIT_SECONDS):
+        self.backend = backend
+        self.rpm = requests_per_minute
+        self.tpm = tokens_per_minute
+        self.max_wait = max_wait
+
+    def acquire(self, estimated_tokens):
+        """Blocks until capacity for one request of estimated_tokens is reserved.
+
+        Raises LLMCapacityUnavailable if that would take longer than max_wait, so the
+        Celery task can be retried later rather than holding a worker slot.
+        """
+        deadline = time.time() + self.max_wait
+        while True:
+            try:
+                wait = self.backend.try_reserve(self.rpm, self.tpm, estimated_tokens)
+            except Exception as e:
+                logger.warning(f"LLM rate limiter unavailable ({e}); proceeding without a reservation.")
+                return
+            if wait <= 0:
+                return
+            if time.time() + wait > deadline:
+                raise LLMCapacityUnavailable(wait)
+            # Jitter spreads waiting workers out so they don't all retry at the same instant
+            time.sleep(wait + random.uniform(0, min(wait, 1.0)))
+
+    def try_acquire(self, estimated_tokens):
+        """Reserves capacity only if it is available right now (for optional requests such as hedges)."""
+        try:
+            return self.backend.try_reserve(self.rpm, self.tpm, estimated_tokens) <= 0
+        except Exception as e:
+            logger.debug(f"LLM rate limiter unavailable ({e}); not reserving.")
+            return False
+
+    def record_usage(self, estimated_tokens, actual_tokens):
+        """Charges the bucket for tokens used beyond the reservation.
+
+        Unused reservation is not credited back: providers count max_tokens against the
+        tokens/min quota when the request is admitted, not when it completes.
+        """
+        if actual_tokens is None or actual_tokens <= estimated_tokens:
+            return
+        try:
+            self.backend.adjust(self.tpm, actual_tokens - estimated_tokens)
+        except Exception as e:
+            logger.debug(f"Failed to reconcile LLM token usage: {e}")
+
+    def block_for(self, seconds):
+        """Pauses every worker after the provider answered 429 with Retry-After."""
+        logger.warning(f"LLM provider asked us to back off for {seconds:.1f}s.")
+        try:
+            self.backend.block_for(seconds)
+        except Exception as e:
+            logger.debug(f"Failed to share LLM back-off: {e}")
+
+def retry_after_seconds(error, default=None):
+    """Reads Retry-After (or OpenAI's retry-after-ms) from a rate limit error's response."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000.0
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return default
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_llm_rate_limiter(model_name):
+    """Returns the process-wide limiter for a model (quotas are per model)."""
+    with _limiters_lock:
+        if model_name not in _limiters:
+            try:
+                import redis
+                client = redis.Redis.from_url(REDIS_URL, socket_timeout=2, socket_connect_timeout=2)
+                client.ping()
+                backend = RedisBucketBackend(client, model_name)
+            except Exception as e:
+                logger.warning(f"Redis unavailable for the LLM rate limiter ({e}); limiting per process.")
+                backend = LocalBucketBackend()
+            _limiters[model_name] = LLMRateLimiter(backend)
+        return _limiters[model_name]
@@ -0,0 +1,401 @@
+# worker/llm_resilience.py
+"""Deadlines, hedged requests and a circuit breaker for LLM calls.
+
+- Every analysis gets a wall-clock budget (ANALYSIS_TIME_BUDGET_SECONDS); each LLM call's
+  timeout is capped by what is left of it, so a stuck request cannot hold a worker slot
+  past the budget. The retried task resumes from the LLM result cache.
+- Once a call has produced no output for the observed p95 latency of its model, a second
+  identical request is sent and whichever answers first is used. Hedges need spare rate
+  limit capacity and are capped at LLM_HEDGE_MAX_RATIO of recent calls, so a provider
+  that is slow across the board is not hit with twice the load.
+- Consecutive provider failures (timeouts, connection errors, 5xx) open a per-model
+  circuit shared through Redis; while it is open, calls fail fast with LLMCircuitOpen,
+  which retries the task after the circuit's remaining open time.
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+import contextvars
+from collections import deque
+
+from .llm_rate_limiter import LLMCapacityUnavailable
+from .metrics import record_llm_hedge, record_circuit_transition
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Wall-clock budget for one analysis attempt; LLM calls that would run past it are cut short (0 disables)
+ANALYSIS_TIME_BUDGET_SECONDS = float(os.getenv("ANALYSIS_TIME_BUDGET_SECONDS", "600"))
+# Below this much remaining budget, calls are not started at all
+LLM_MIN_CALL_SECONDS = float(os.getenv("LLM_MIN_CALL_SECONDS", "5"))
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "true").lower() in ("1", "true", "yes")
+LLM_HEDGE_QUANTILE = float(os.getenv("LLM_HEDGE_QUANTILE", "0.95"))
+# Hedging starts once this many latencies of a model were observed, and never earlier than the floor
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_HEDGE_MIN_DELAY_SECONDS = float(os.getenv("LLM_HEDGE_MIN_DELAY_SECONDS", "1"))
+LLM_HEDGE_MAX_RATIO = float(os.getenv("LLM_HEDGE_MAX_RATIO", "0.1"))
+LLM_LATENCY_WINDOW = int(os.getenv("LLM_LATENCY_WINDOW", "200"))
+LLM_BREAKER_FAILURE_THRESHOLD = int(os.getenv("LLM_BREAKER_FAILURE_THRESHOLD", "5"))
+LLM_BREAKER_OPEN_SECONDS = float(os.getenv("LLM_BREAKER_OPEN_SECONDS", "30"))
+
+KEY_PREFIX = "codeguardian:llm_breaker:"
+
+class LLMDeadlineExceeded(TimeoutError):
+    """An LLM call ran past its deadline, or the analysis has no time budget left for one."""
+
+class LLMCircuitOpen(LLMCapacityUnavailable):
+    """The model's circuit is open; retry_after is the remaining open time."""
+
+    def __init__(self, model, retry_after):
+        super().__init__(retry_after)
+        self.model = model
+
+    def __str__(self):
+        return f"LLM circuit for {self.model} is open for another {self.retry_after:.1f}s"
+
+# --- Time Budget ---
+
+_deadline = contextvars.ContextVar("codeguardian_llm_deadline", default=None)
+
+def bind_time_budget(seconds=ANALYSIS_TIME_BUDGET_SECONDS):
+    """Starts the analysis time budget for this context (and contexts copied from it)."""
+    _deadline.set(time.monotonic() + seconds if seconds > 0 else None)
+
+def call_timeout(timeout):
+    """The timeout for the next call: timeout, capped by the remaining time budget."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return timeout
+    remaining = deadline - time.monotonic()
+    if remaining < LLM_MIN_CALL_SECONDS:
+        raise LLMDeadlineExceeded(f"Analysis time budget exhausted ({max(remaining, 0):.1f}s left)")
+    return min(timeout, remaining)
+
+# --- Latency & Hedging ---
+
+class LatencyTracker:
+    """Recent latencies of one model (time to first token when streaming) and how many calls were hedged."""
+
+    def __init__(self, window=LLM_LATENCY_WINDOW):
+        self.latencies = deque(maxlen=window)
+        self.hedged = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def quantile(self, q):
+        with self.lock:
+            if len(self.latencies) < LLM_HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+    def record_call(self, hedged):
+        with self.lock:
+            self.hedged.append(1 if hedged else 0)
+
+    def hedge_ratio(self):
+        with self.lock:
+            return sum(self.hedged) / len(self.hedged) if self.hedged else 0.0
+
+_trackers = {}
+_trackers_lock = threading.Lock()
+
+def get_latency_tracker(model, streaming):
+    key = (model, streaming)
+    with _trackers_lock:
+        if key not in _trackers:
+            _trackers[key] = LatencyTracker()
+        return _trackers[key]
+
+def hedge_delay(tracker):
+    """Seconds without output after which to hedge a call, or None if it should not be hedged."""
+    if not LLM_HEDGE_ENABLED:
+        return None
+    p = tracker.quantile(LLM_HEDGE_QUANTILE)
+    if p is None:
+        return None
+    return max(p, LLM_HEDGE_MIN_DELAY_SECONDS)
+
+def hedge_allowed(tracker, limiter, estimated_tokens, model):
+    """Whether a hedge may be sent now: under the hedge ratio cap and with spare rate limit capacity."""
+    if tracker.hedge_ratio() >= LLM_HEDGE_MAX_RATIO or not limiter.try_acquire(estimated_tokens):
+        record_llm_hedge(model, "skipped")
+        return False
+    record_llm_hedge(model, "sent")
+    return True
+
+def run_hedged(attempt, timeout, hedge_after=None, on_delta=None, may_hedge=None):
+    """Runs attempt(emit, cancelled) on a thread; returns (result, index of the attempt that won).
+
+    If the first attempt has produced no output after hedge_after seconds and may_hedge()
+    allows it, a second one is started. The first to emit a delta or return wins: its
+    deltas are passed on to on_delta (on the calling thread) and the other is cancelled
+    (attempts close their stream once cancelled is set; blocking calls are abandoned and
+    end at their own timeout). Raises LLMDeadlineExceeded if nothing is returned within
+    timeout, or the error of the last attempt if all of them fail.
+    """
+    events = queue.Queue()
+    cancels = []
+
+    def start(index):
+        cancelled = threading.Event()
+        cancels.append(cancelled)
+
+        def run():
+            try:
+                result = attempt(lambda text: events.put((index, "delta", text)), cancelled)
+                events.put((index, "done", result))
+            except BaseException as e:
+                events.put((index, "error", e))
+
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(run,), name=f"llm-attempt-{index}", daemon=True).start()
+
+    def cancel_others(winner):
+        for index, cancelled in enumerate(cancels):
+            if index != winner:
+                cancelled.set()
+
+    started = time.monotonic()
+    deadline = started + timeout
+    start(0)
+    running, winner, hedge_pending = 1, None, hedge_after is not None
+    while True:
+        now = time.monotonic()
+        if now >= deadline:
+            cancel_others(None)
+            raise LLMDeadlineExceeded(f"LLM call did not finish within {timeout:.1f}s")
+        wait = deadline - now
+        if hedge_pending:
+            wait = min(wait, max(started + hedge_after - now, 0))
+        try:
+            index, kind, value = events.get(timeout=wait)
+        except queue.Empty:
+            if hedge_pending and time.monotonic() >= started + hedge_after:
+                hedge_pending = False
+                if may_hedge is None or may_hedge():
+                    start(len(cancels))
+                    running += 1
+            continue
+        if winner is None and kind != "error":
+            winner = index
+            hedge_pending = False
+            cancel_others(winner)
+        if kind == "error":
+            running -= 1
+            if winner is None and running > 0:
+                continue  # The other attempt may still succeed
+            if winner is None or index == winner:
+                cancel_others(None)
+                raise value
+        elif index != winner:
+            continue
+        elif kind == "delta":
+            if on_delta is not None:
+                on_delta(value)
+        else:
+            return value, winner
+
+# --- Circuit Breaker ---
+
+class CircuitBreaker:
+    """Per-model breaker: closed -> open -> half-open (one probe call) -> closed.
+
+    Failures are counted per process; an open circuit is shared through Redis (when
+    available), so every worker fails fast once one of them has seen the provider fail.
+    """
+
+    def __init__(self, model, threshold=LLM_BREAKER_FAILURE_THRESHOLD, open_seconds=LLM_BREAKER_OPEN_SECONDS):
+        self.model = model
+        self.threshold = threshold
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+        self.redis = None
+        self.key = f"{KEY_PREFIX}{model}:open_until"
+        try:
+            import redis
+            self.redis = redis.Redis.from_url(REDIS_URL, socket_timeout=2, socket_connect_timeout=2)
+            self.redis.ping()
+        except Exception as e:
+            logger.warning(f"Redis unavailable for the LLM circuit breaker ({e}); breaking per process.")
+            self.redis = None
+
+    def _shared_open_until(self):
+        if self.redis is None:
+            return 0.0
+        try:
+            value = self.redis.get(self.key)
+            return float(value) if value else 0.0
+        except Exception as e:
+            logger.debug(f"Failed to read the shared LLM circuit state: {e}")
+            return 0.0
+
+    def before_call(self):
+        """Raises LLMCircuitOpen while the circuit is open (or another call is probing it).
+
+        Returns True when the caller is the half-open probe; prefer call(), which
+        guarantees the probe is settled however the call ends.
+        """
+        now = time.time()
+        remaining = max(self.open_until, self._shared_open_until()) - now
+        if remaining > 0:
+            raise LLMCircuitOpen(self.model, remaining)
+        with self.lock:
+            if self.state == "open":
+                self._transition("half_open")
+            if self.state == "half_open":
+                if self.probing:
+                    raise LLMCircuitOpen(self.model, min(5.0, self.open_seconds))
+                self.probing = True
+                return True
+        return False
+
+    def call(self):
+        """before_call() wrapped in a BreakerCall context that settles the probe on exit."""
+        return BreakerCall(self, self.before_call())
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.probing = False
+            if self.state != "closed":
+                self._transition("closed")
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.threshold):
+                self._open()
+
+    def _open(self):
+        self.open_until = time.time() + self.open_seconds
+        self._transition("open")
+        logger.warning(
+            f"LLM circuit for {self.model} opened after {self.failures} failure(s); failing fast for {self.open_seconds:g}s."
+        )
+        if self.redis is not None:
+            try:
+                self.redis.set(self.key, self.open_until, ex=max(int(self.open_seconds) + 1, 1))
+            except Exception as e:
+                logger.debug(f"Failed to share the open LLM circuit: {e}")
+
+    def _transition(self, state):
+        self.state = state
+        record_circuit_transition(self.model, state)
+
+class BreakerCall:
+    """One guarded call: report success() or failure(); anything else counts as a failure for a probe.
+
+    A probe that ends without a verdict (rate limited, cut short by the deadline, an
+    unexpected error) must still end the half-open state, or every later call would
+    be refused as "another call is probing".
+    """
+
+    def __init__(self, breaker, probe):
+        self.breaker = breaker
+        self.probe = probe
+        self.settled = False
+
+    def success(self):
+        self.settled = True
+        self.breaker.record_success()
+
+    def failure(self):
+        self.settled = True
+        self.breaker.record_failure()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.probe and not self.settled:
+            self.failure()
+        return False
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(model):
+    """Returns the process-wide circuit breaker for a model."""
+    with _breakers_lock:
+        if model not in _breakers:
+            _breakers[model] = CircuitBreaker(model)
+        return _breakers[model]
+
+async def run_hedged_async(attempt, timeout, hedge_after=None, on_delta=None, may_hedge=None):
+    """Async counterpart of run_hedged(): attempt(emit) is a coroutine function and losers are cancelled.
+
+    may_hedge() is called on a thread (it may touch Redis).
+    """
+    import asyncio
+    events = asyncio.Queue()
+    tasks = []
+
+    def start(index):
+        async def run():
+            try:
+                result = await attempt(lambda text: events.put_nowait((index, "delta", text)))
+                events.put_nowait((index, "done", result))
+            except Exception as e:
+                events.put_nowait((index, "error", e))
+        tasks.append(asyncio.ensure_future(run()))
+
+    def cancel_others(winner):
+        for index, task in enumerate(tasks):
+            if index != winner:
+                task.cancel()
+
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    deadline = started + timeout
+    start(0)
+    running, winner, hedge_pending = 1, None, hedge_after is not None
+    try:
+        while True:
+            now = loop.time()
+            if now >= deadline:
+                raise LLMDeadlineExceeded(f"LLM call did not finish within {timeout:.1f}s")
+            wait = deadline - now
+            if hedge_pending:
+                wait = min(wait, max(started + hedge_after - now, 0))
+            try:
+                index, kind, value = await asyncio.wait_for(events.get(), wait)
+            except asyncio.TimeoutError:
+                if hedge_pending and loop.time() >= started + hedge_after:
+                    hedge_pending = False
+                    if may_hedge is None or await asyncio.to_thread(may_hedge):
+                        start(len(tasks))
+                        running += 1
+                continue
+            if winner is None and kind != "error":
+                winner = index
+                hedge_pending = False
+                cancel_others(winner)
+            if kind == "error":
+                running -= 1
+                if winner is None and running > 0:
+                    continue
+                if winner is None or index == winner:
+                    raise value
+            elif index != winner:
+                continue
+            elif kind == "delta":
+                if on_delta is not None:
+                    on_delta(value)
+            else:
+                return value, winner
+    finally:
+        # Also on success: the winner is done, and a late loser must not keep its stream open
+        cancel_others(winner)
@@ -0,0 +1,80 @@
+# worker/llm_stream.py
+
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+class FindingsStreamParser:
+    """Incrementally extracts finding objects from a streamed JSON response.
+
+    Accepts either {"findings": [{...}, ...]} or a bare top-level [{...}, ...] and returns
+    each finding from feed() as soon as its closing brace arrives, so a truncated
+    response still yields every finding that was completed before the cut-off.
+    """
+
+    def __init__(self):
+        self.depth = 0            # Current container nesting depth
+        self.array_depth = None   # Depth inside the findings array once it has been entered
+        self.in_string = False
+        self.escaped = False
+        self.string_chars = []    # Current string at depth 1, kept to recognize the "findings" key
+        self.last_key = None
+        self.item = None          # Characters of the finding object being read
+        self.done = False
+
+    def feed(self, text):
+        """Consumes the next piece of model output; returns the findings it completed."""
+        completed = []
+        for char in text:
+            if self.done:
+                break
+            if self.item is not None:
+                self.item.append(char)
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.depth == 1 and self.array_depth is None:
+                        self.last_key = "".join(self.string_chars)
+                elif self.depth == 1 and self.array_depth is None:
+                    self.string_chars.append(char)
+                continue
+
+            if char == '"':
+                self.in_string = True
+                self.string_chars = []
+            elif char in "{[":
+                if char == "[" and self.array_depth is None and (
+                    self.depth == 0 or (self.depth == 1 and self.last_key == "findings")
+                ):
+                    self.array_depth = self.depth + 1
+                elif char == "{" and self.array_depth is not None and self.depth == self.array_depth:
+                    self.item = [char]
+                self.depth += 1
+            elif char in "}]":
+                self.depth -= 1
+                if self.array_depth is not None and self.depth == self.array_depth and self.item is not None:
+                    finding = self._decode("".join(self.item))
+                    self.item = None
+                    if finding is not None:
+                        completed.append(finding)
+                elif self.array_depth is not None and self.depth < self.array_depth:
+                    self.done = True  # The findings array closed; ignore anything after it
+        return completed
+
+    @staticmethod
+    def _decode(text):
+        try:
+            finding = json.loads(text)
+        except json.JSONDecodeError as e:
+            logger.warning(f"Skipping malformed finding in LLM response: {e}")
+            return None
+        return finding if isinstance(finding, dict) else None
+
+def iter_findings(response_content):
+    """Returns every complete finding in a (possibly truncated) JSON response."""
+    return FindingsStreamParser().feed(response_content)
@@ -0,0 +1,286 @@
+# worker/metrics.py
+"""Prometheus instrumentation shared by the webhook backend and the analysis worker.
+
+Uses prometheus_client when it is installed (with multi-process aggregation when
+PROMETHEUS_MULTIPROC_DIR is set, e.g. for prefork Celery workers or several uvicorn
+workers). Without it, a small in-process registry renders the same metrics in the
+Prometheus text format, so instrumentation calls never need guarding.
+"""
+
+import os
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+# prometheus_client's multi-process mode; must be an empty, writable directory shared by the processes
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+WEBHOOK_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+QUEUE_WAIT_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 900, 1800, 3600)
+
+FALLBACK_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+# --- Fallback Registry ---
+
+class _FallbackMetric:
+    """Counter or histogram with labels, rendered in the Prometheus text format (one process only)."""
+
+    def __init__(self, kind, name, documentation, labelnames, buckets=None):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets or ())
+        self.values = {}  # label values -> count, or [per-bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        return _FallbackChild(self, tuple(str(value) for value in values))
+
+    def inc(self, amount=1):
+        self._inc((), amount)
+
+    def observe(self, value):
+        self._observe((), value)
+
+    def _inc(self, key, amount):
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def _observe(self, key, value):
+        with self.lock:
+            series = self.values.setdefault(key, [0] * (len(self.buckets) + 2))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        name = self.name + "_total" if self.kind == "counter" else self.name
+        lines = [f"# HELP {name} {self.documentation}", f"# TYPE {name} {self.kind}"]
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            labels = [f'{label}="{_escape(v)}"' for label, v in zip(self.labelnames, key)]
+            if self.kind == "counter":
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+                continue
+            for bound, count in zip(self.buckets + ("+Inf",), value[:-2] + value[-1:]):
+                bucket_labels = labels + [f'le="{bound}"']
+                lines.append(f"{name}_bucket{_format_labels(bucket_labels)} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {value[-2]}")
+            lines.append(f"{name}_count{_format_labels(labels)} {value[-1]}")
+        return lines
+
+class _FallbackChild:
+    def __init__(self, metric, key):
+        self.metric = metric
+        self.key = key
+
+    def inc(self, amount=1):
+        self.metric._inc(self.key, amount)
+
+    def observe(self, value):
+        self.metric._observe(self.key, value)
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labels):
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+_fallback_metrics = []
+
+def _counter(name, documentation, labelnames):
+    if prometheus_client is not None:
+        return prometheus_client.Counter(name, documentation, labelnames)
+    metric = _FallbackMetric("counter", name, documentation, labelnames)
+    _fallback_metrics.append(metric)
+    return metric
+
+def _histogram(name, documentation, labelnames, buckets):
+    if prometheus_client is not None:
+        return prometheus_client.Histogram(name, documentation, labelnames, buckets=buckets)
+    metric = _FallbackMetric("histogram", name, documentation, labelnames, buckets)
+    _fallback_metrics.append(metric)
+    return metric
+
+# --- Metrics ---
+
+STAGE_SECONDS = _histogram(
+    "codeguardian_stage_duration_seconds", "Time spent in each analysis pipeline stage.", ["stage"], STAGE_BUCKETS,
+)
+LLM_TOKENS = _counter(
+    "codeguardian_llm_tokens", "LLM tokens used, by installation, model and kind (prompt/completion).",
+    ["installation", "model", "kind"],
+)
+PROMPT_TOKENS_REMOVED = _counter(
+    "codeguardian_prompt_tokens_removed", "Estimated prompt tokens saved, by installation and reason (compaction/overflow).",
+    ["installation", "reason"],
+)
+TRIAGE_HUNKS = _counter(
+    "codeguardian_triage_hunks", "Hunks judged by the triage tier, by verdict (escalated/cleared/failed_open).",
+    ["verdict"],
+)
+LLM_CACHE_REQUESTS = _counter("codeguardian_llm_cache_requests", "LLM result cache lookups.", ["result"])
+RETRIES = _counter(
+    "codeguardian_retries", "Retries, by kind (task, llm_rate_limit, github_rate_limit).", ["kind"],
+)
+LLM_HEDGES = _counter(
+    "codeguardian_llm_hedges", "Hedged LLM requests, by model and outcome (sent/won/skipped).", ["model", "outcome"],
+)
+LLM_FAILURES = _counter(
+    "codeguardian_llm_failures", "Failed LLM calls, by model and reason (timeout/deadline/error/circuit_open).",
+    ["model", "reason"],
+)
+LLM_CIRCUIT_TRANSITIONS = _counter(
+    "codeguardian_llm_circuit_transitions", "LLM circuit breaker state changes, by model and new state.",
+    ["model", "state"],
+)
+TASKS = _counter("codeguardian_tasks", "Finished Celery tasks, by task and status.", ["task", "status"])
+TASK_SECONDS = _histogram("codeguardian_task_duration_seconds", "Celery task run time.", ["task"], STAGE_BUCKETS)
+QUEUE_WAIT_SECONDS = _histogram(
+    "codeguardian_queue_wait_seconds", "Time analysis tasks waited between becoming ready and starting.", [],
+    QUEUE_WAIT_BUCKETS,
+)
+WEBHOOKS = _counter("codeguardian_webhooks", "GitHub webhook deliveries, by event and status.", ["event", "status"])
+WEBHOOK_SECONDS = _histogram(
+    "codeguardian_webhook_duration_seconds", "Webhook handling time until the response.", ["event"], WEBHOOK_BUCKETS,
+)
+
+# --- Recording ---
+
+# Installation the current analysis belongs to, for per-installation token accounting
+_installation = contextvars.ContextVar("codeguardian_installation", default="unknown")
+
+def bind_installation(installation_id):
+    """Attributes LLM usage in this context (and contexts copied from it) to the installation."""
+    _installation.set(str(installation_id) if installation_id else "unknown")
+
+@contextmanager
+def stage_timer(stage):
+    """Observes the duration of the with-block as a pipeline stage, whether or not it raises."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if METRICS_ENABLED:
+            STAGE_SECONDS.labels(stage).observe(time.perf_counter() - started)
+
+def record_llm_usage(model, usage):
+    """Counts the prompt/completion tokens of an OpenAI usage object (ignored when missing)."""
+    if not METRICS_ENABLED or usage is None:
+        return
+    installation = _installation.get()
+    LLM_TOKENS.labels(installation, model, "prompt").inc(getattr(usage, "prompt_tokens", 0) or 0)
+    LLM_TOKENS.labels(installation, model, "completion").inc(getattr(usage, "completion_tokens", 0) or 0)
+
+def record_prompt_tokens_removed(reason, tokens):
+    if METRICS_ENABLED and tokens > 0:
+        PROMPT_TOKENS_REMOVED.labels(_installation.get(), reason).inc(tokens)
+
+def record_triage(verdicts, failed_open=False):
+    """Counts triage verdicts; hunks escalated only because triage failed are counted as failed_open."""
+    if not METRICS_ENABLED:
+        return
+    escalated = sum(verdicts)
+    TRIAGE_HUNKS.labels("failed_open" if failed_open else "escalated").inc(escalated)
+    TRIAGE_HUNKS.labels("cleared").inc(len(verdicts) - escalated)
+
+def record_cache_lookup(hit):
+    if METRICS_ENABLED:
+        LLM_CACHE_REQUESTS.labels("hit" if hit else "miss").inc()
+
+def record_retry(kind):
+    if METRICS_ENABLED:
+        RETRIES.labels(kind).inc()
+
+def record_llm_hedge(model, outcome):
+    if METRICS_ENABLED:
+        LLM_HEDGES.labels(model, outcome).inc()
+
+def record_llm_failure(model, reason):
+    if METRICS_ENABLED:
+        LLM_FAILURES.labels(model, reason).inc()
+
+def record_circuit_transition(model, state):
+    if METRICS_ENABLED:
+        LLM_CIRCUIT_TRANSITIONS.labels(model, state).inc()
+
+def record_task(task_name, status, seconds=None):
+    if not METRICS_ENABLED:
+        return
+    TASKS.labels(task_name, status).inc()
+    if seconds is not None:
+        TASK_SECONDS.labels(task_name).observe(seconds)
+
+def record_queue_wait(seconds):
+    if METRICS_ENABLED:
+        QUEUE_WAIT_SECONDS.observe(seconds)
+
+def record_webhook(event, status, seconds):
+    """event must come from a fixed set (the backend maps unhandled events to "other")."""
+    if not METRICS_ENABLED:
+        return
+    event = event or "unknown"
+    WEBHOOKS.labels(event, status).inc()
+    WEBHOOK_SECONDS.labels(event).observe(seconds)
+
+# --- Exposition ---
+
+def render_metrics():
+    """Returns (body, content_type) for a /metrics response."""
+    if prometheus_client is None:
+        lines = [line for metric in _fallback_metrics for line in metric.render()]
+        return ("\n".join(lines) + "\n").encode("utf-8"), FALLBACK_CONTENT_TYPE
+    if PROMETHEUS_MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
+    return prometheus_client.generate_latest(), prometheus_client.CONTENT_TYPE_LATEST
+
+def start_metrics_server(port, host="0.0.0.0"):
+    """Serves /metrics on a daemon thread (for processes without a web app, i.e. the worker)."""
+    # Imported here: http.server alone would double the Lambda pipeline's import time
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body, content_type = render_metrics()
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scrapes every few seconds would drown the worker log
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info(f"Serving Prometheus metrics on {host}:{port}/metrics.")
+    return server
+
+def mark_process_dead(pid):
+    """Drops a finished process's live gauges in multi-process mode (counters and histograms are kept)."""
+    if prometheus_client is not None and PROMETHEUS_MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,145 @@
+# worker/pr_state.py
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+PR_STATE_TTL_SECONDS = int(os.getenv("PR_STATE_TTL_SECONDS", str(30 * 24 * 3600)))
+PR_STATE_SQLITE_PATH = os.getenv("PR_STATE_SQLITE_PATH", "/tmp/codeguardian_pr_state.sqlite3")
+
+KEY_PREFIX = "codeguardian:pr_state:"
+
+# --- Storage ---
+
+def _state_key(repo_full_name, pr_number):
+    return f"{repo_full_name}#{pr_number}"
+
+class PRStateStore:
+    """Remembers the last successfully analyzed head SHA (and its findings) for each PR."""
+
+    def __init__(self):
+        self.redis = None
+        self.conn = None
+        self.lock = threading.Lock()
+        try:
+            import redis
+            self.redis = redis.Redis.from_url(REDIS_URL, socket_timeout=2, socket_connect_timeout=2)
+            self.redis.ping()
+        except Exception as e:
+            logger.warning(f"Redis unavailable for PR state ({e}); falling back to SQLite at {PR_STATE_SQLITE_PATH}.")
+            self.redis = None
+            self.conn = sqlite3.connect(PR_STATE_SQLITE_PATH, check_same_thread=False, isolation_level=None)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS pr_state (key TEXT PRIMARY KEY, value TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+
+    def load(self, repo_full_name, pr_number):
+        """Returns {"head_sha": ..., "findings": [...]} or None if the PR was never analyzed."""
+        key = _state_key(repo_full_name, pr_number)
+        try:
+            if self.redis is not None:
+                value = self.redis.get(KEY_PREFIX + key)
+            else:
+                with self.lock:
+                    row = self.conn.execute("SELECT value FROM pr_state WHERE key = ?", (key,)).fetchone()
+                value = row[0] if row else None
+        except Exception as e:
+            logger.warning(f"Failed to load PR state for {key}: {e}")
+            return None
+        return json.loads(value) if value else None
+
+    def save(self, repo_full_name, pr_number, head_sha, findings):
+        key = _state_key(repo_full_name, pr_number)
+        value = json.dumps({"head_sha": head_sha, "findings": findings, "analyzed_at": time.time()})
+        try:
+            if self.redis is not None:
+                self.redis.set(KEY_PREFIX + key, value, ex=PR_STATE_TTL_SECONDS)
+            else:
+                with self.lock:
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO pr_state (key, value, updated_at) VALUES (?, ?, ?)",
+                        (key, value, time.time()),
+                    )
+        except Exception as e:
+            # Losing state only costs a full re-analysis on the next push
+            logger.warning(f"Failed to save PR state for {key}: {e}")
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_pr_state_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = PRStateStore()
+    return _store
+
+# --- Carrying Findings Forward ---
+
+def _remap_line(line, hunks):
+    """Maps a line number on the old side of the delta to the new side, or None if it was changed."""
+    offset = 0
+    for hunk in hunks:
+        if hunk.old_length == 0:
+            # Pure insertion after line old_start
+            if line <= hunk.old_start:
+                break
+            offset += hunk.new_length
+            continue
+        old_end = hunk.old_start + hunk.old_length  # exclusive
+        if line < hunk.old_start:
+            break
+        if line < old_end:
+            # Inside the hunk: only untouched context lines survive
+            old_line, new_line = hunk.old_start, hunk.new_start
+            for diff_line in hunk.lines:
+                if diff_line.startswith("-"):
+                    if old_line == line:
+                        return None
+                    old_line += 1
+                elif diff_line.startswith("+"):
+                    new_line += 1
+                elif not diff_line.startswith("\\"):
+                    if old_line == line:
+                        return new_line
+                    old_line += 1
+                    new_line += 1
+            return None
+        offset += hunk.new_length - hunk.old_length
+    return line + offset
+
+def carry_forward_findings(previous_findings, delta_file_diffs):
+    """Keeps previous findings whose lines the delta did not touch, shifting them to new line numbers."""
+    delta_by_old_path = {file_diff.old_path: file_diff for file_diff in delta_file_diffs if file_diff.old_path}
+    deleted_paths = {
+        file_diff.path for file_diff in delta_file_diffs
+        if any(header.startswith("deleted file mode") for header in file_diff.header_lines)
+    }
+
+    carried = []
+    for finding in previous_findings:
+        path = finding.get("file_path")
+        if path in deleted_paths:
+            continue
+        file_diff = delta_by_old_path.get(path)
+        if file_diff is None:
+            carried.append(finding)
+            continue
+
+        finding = dict(finding, file_path=file_diff.path)
+        line = finding.get("line")
+        if isinstance(line, int):
+            new_line = _remap_line(line, file_diff.hunks)
+            if new_line is None:
+                continue  # The flagged line changed; the delta analysis re-evaluates it
+            finding["line"] = new_line
+        carried.append(finding)
+    return carried
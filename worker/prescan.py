@@ -0,0 +1,190 @@
+# worker/prescan.py
+
+import os
+import re
+import ast
+import logging
+import textwrap
+from dataclasses import dataclass, field
+
+from .diff_chunker import FileDiff
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+PRESCAN_ENABLED = os.getenv("PRESCAN_ENABLED", "true").lower() in ("1", "true", "yes")
+# Hunks scoring below this never reach the LLM
+PRESCAN_THRESHOLD = float(os.getenv("PRESCAN_THRESHOLD", "1.0"))
+
+# Files that cannot introduce Python vulnerabilities worth an LLM call
+SKIPPED_SUFFIXES = (
+    ".md", ".rst", ".txt", ".lock", ".json", ".svg", ".png", ".jpg", ".gif", ".css", ".csv",
+)
+SKIPPED_FILENAMES = {"poetry.lock", "Pipfile.lock", "package-lock.json", "yarn.lock", "CHANGELOG", "LICENSE"}
+TEST_PATH_RE = re.compile(r"(^|/)(tests?|testing)/|(^|/)test_[^/]*\.py$|_test\.py$|(^|/)conftest\.py$")
+DOCS_PATH_RE = re.compile(r"(^|/)docs?/")
+
+# (kind, weight, pattern) - sinks are scored on added lines. All patterns are compiled into one
+# alternation, so flags must be scoped, e.g. (?i:...)
+SINK_PATTERNS = [
+    ("command execution (os.system/os.popen)", 3.0, r"\bos\.(?:system|popen|exec[lv]p?e?|spawn[lv]p?e?)\s*\("),
+    ("subprocess with shell=True", 3.0, r"\bsubprocess\.\w+\s*\([^\n]*shell\s*=\s*True"),
+    ("subprocess call", 1.0, r"\bsubprocess\.(?:run|call|check_call|check_output|Popen)\s*\("),
+    ("dynamic code execution (eval/exec)", 3.0, r"(?<![\w.])(?:eval|exec|compile)\s*\("),
+    ("dynamic import", 1.5, r"\b__import__\s*\(|\bimportlib\.import_module\s*\("),
+    ("insecure deserialization (pickle/marshal/shelve/dill)", 3.0, r"\b(?:c?pickle|marshal|dill|shelve)\.(?:loads?|open|Unpickler)\b"),
+    ("yaml.load without SafeLoader", 2.5, r"\byaml\.(?:load|load_all|unsafe_load)\s*\((?![^\n]*SafeLoader)"),
+    ("raw SQL built with string formatting", 3.0,
+     r"\.(?:execute|executemany|executescript|raw|extra)\s*\(\s*(?:f[\"']|[\"'][^\"'\n]*[\"']\s*(?:%|\.format\b|\+))"),
+    ("SQL text built with string formatting", 2.0,
+     r"(?i:f[\"'][^\"'\n]*\b(?:select|insert|update|delete)\b[^\"'\n]*\b(?:from|into|set|where)\b[^\"'\n]*\{)"),
+    ("weak hash (md5/sha1)", 1.5, r"\bhashlib\.(?:md5|sha1)\s*\(|\bhashlib\.new\s*\(\s*[\"'](?:md5|sha1)[\"']"),
+    ("weak cipher or mode", 2.0, r"\b(?:DES|ARC4|Blowfish)\.new\s*\(|\bMODE_ECB\b"),
+    ("TLS verification disabled", 2.5, r"\bverify\s*=\s*False\b|_create_unverified_context\s*\(|CERT_NONE\b"),
+    ("template rendering from string (XSS/SSTI)", 2.5, r"\brender_template_string\s*\(|\bMarkup\s*\(|\|\s*safe\b|mark_safe\s*\("),
+    ("insecure temp file", 1.5, r"\btempfile\.mktemp\s*\("),
+    ("XML parsing (XXE)", 1.5, r"\b(?:xml\.etree\.ElementTree|lxml\.etree|xml\.dom\.minidom|xml\.sax)\b"),
+    ("JWT verification disabled", 2.5, r"verify_signature[\"']?\s*:\s*False|\bverify\s*=\s*False\b[^\n]*jwt|algorithms\s*=\s*\[\s*[\"']none"),
+    ("debug mode enabled", 1.5, r"\bdebug\s*=\s*True\b|\bDEBUG\s*=\s*True\b"),
+    ("hardcoded secret", 2.0, r"(?i:\b(?:password|passwd|secret|api_key|apikey|token|private_key)\s*=\s*[\"'][^\"'\s]{6,}[\"'])"),
+    ("path built from input (traversal)", 1.0, r"\bopen\s*\([^\n]*(?:\+|\.format\b|f[\"'])|\bsend_file\s*\("),
+    ("insecure randomness for secrets", 1.0, r"\brandom\.(?:random|randint|choice|getrandbits)\s*\([^\n]*$"),
+    ("access control / auth logic", 1.0, r"(?i:\b(?:is_admin|is_superuser|has_perm\w*|permission\w*|login_required|authenticate|authorize\w*|csrf_exempt)\b)"),
+]
+
+# Untrusted input sources; their presence amplifies sink scores in the same hunk
+SOURCE_PATTERNS = [
+    ("HTTP request data", r"\brequest\.(?:args|form|values|json|data|files|cookies|headers|GET|POST|body|query_params)\b"),
+    ("user input", r"(?<![\w.])input\s*\("),
+    ("command-line arguments", r"\bsys\.argv\b"),
+    ("environment variables", r"\bos\.(?:environ|getenv)\b"),
+]
+SOURCE_MULTIPLIER = 1.5
+
+_SINK_INDEX = re.compile("|".join(f"(?P<s{i}>{pattern})" for i, (_, _, pattern) in enumerate(SINK_PATTERNS)))
+_SOURCE_INDEX = re.compile("|".join(f"(?P<r{i}>{pattern})" for i, (_, pattern) in enumerate(SOURCE_PATTERNS)))
+
+# --- Records ---
+
+@dataclass
+class HunkScore:
+    score: float = 0.0
+    hints: list = field(default_factory=list)
+
+# --- File Triage ---
+
+def skip_reason(path):
+    """Returns why a file is skipped outright, or None if its hunks should be scanned."""
+    name = path.rsplit("/", 1)[-1]
+    if name in SKIPPED_FILENAMES or path.endswith(SKIPPED_SUFFIXES):
+        return "docs/data/lockfile"
+    if TEST_PATH_RE.search(path):
+        return "test code"
+    if DOCS_PATH_RE.search(path):
+        return "documentation"
+    if not path.endswith(".py"):
+        return "not Python"
+    return None
+
+# --- Hunk Scanning ---
+
+def _added_lines(hunk):
+    """Yields (new file line number, text) for each added line of the hunk."""
+    new_line = hunk.new_start
+    for line in hunk.lines:
+        if line.startswith("+"):
+            yield new_line, line[1:]
+            new_line += 1
+        elif not line.startswith("-") and not line.startswith("\\"):
+            new_line += 1
+
+def _ast_hints(code, line_numbers):
+    """Precise checks on added code that parses on its own; returns [(line, kind, weight)]."""
+    try:
+        tree = ast.parse(textwrap.dedent(code))
+    except (SyntaxError, ValueError):
+        return []  # Hunk fragments often don't parse; the regex index still applies
+
+    hints = []
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        line = line_numbers[node.lineno - 1] if 0 < node.lineno <= len(line_numbers) else None
+        func = ast.unparse(node.func) if hasattr(ast, "unparse") else ""
+        keywords = {kw.arg: kw.value for kw in node.keywords if kw.arg}
+        shell = keywords.get("shell")
+        if func.startswith("subprocess.") and isinstance(shell, ast.Constant) and shell.value is True:
+            hints.append((line, "subprocess with shell=True", 3.0))
+        if func.endswith((".execute", ".executemany", ".raw")) and node.args:
+            query = node.args[0]
+            if isinstance(query, ast.JoinedStr) or (
+                isinstance(query, ast.BinOp) and isinstance(query.op, (ast.Mod, ast.Add))
+            ) or (
+                isinstance(query, ast.Call) and isinstance(query.func, ast.Attribute) and query.func.attr == "format"
+            ):
+                hints.append((line, "raw SQL built with string formatting", 3.0))
+    return hints
+
+def scan_hunk(hunk):
+    """Scores a hunk by the dangerous sinks (and untrusted sources) on its added lines."""
+    added = list(_added_lines(hunk))
+    if not added:
+        return HunkScore()  # Deletion-only hunks cannot introduce a vulnerability
+
+    seen = set()
+    hints = []
+    score = 0.0
+    for line_number, text in added:
+        for match in _SINK_INDEX.finditer(text):
+            kind, weight, _ = SINK_PATTERNS[int(match.lastgroup[1:])]
+            if (line_number, kind) not in seen:
+                seen.add((line_number, kind))
+                hints.append(f"line {line_number}: {kind}")
+                score += weight
+
+    code = "\n".join(text for _, text in added)
+    for line_number, kind, weight in _ast_hints(code, [n for n, _ in added]):
+        if (line_number, kind) not in seen:
+            seen.add((line_number, kind))
+            hints.append(f"line {line_number}: {kind}")
+            score += weight
+
+    sources = sorted({SOURCE_PATTERNS[int(m.lastgroup[1:])][0] for m in _SOURCE_INDEX.finditer(code)})
+    if sources and score:
+        score *= SOURCE_MULTIPLIER
+        hints.append(f"untrusted input in the same hunk: {', '.join(sources)}")
+    return HunkScore(score=score, hints=hints)
+
+def prescan_diff(file_diffs, threshold=PRESCAN_THRESHOLD):
+    """Keeps only hunks scoring at least threshold, each annotated with its pre-scan hints.
+
+    Returns (filtered FileDiffs, stats dict).
+    """
+    stats = {"files": 0, "hunks": 0, "hunks_kept": 0, "files_skipped": 0}
+    kept_files = []
+    for file_diff in file_diffs:
+        stats["files"] += 1
+        stats["hunks"] += len(file_diff.hunks)
+        if file_diff.is_binary or skip_reason(file_diff.path):
+            stats["files_skipped"] += 1
+            continue
+        kept_hunks = []
+        for hunk in file_diff.hunks:
+            result = scan_hunk(hunk)
+            if result.score >= threshold:
+                hunk.hints = result.hints
+                kept_hunks.append(hunk)
+        if kept_hunks:
+            stats["hunks_kept"] += len(kept_hunks)
+            kept_files.append(FileDiff(
+                path=file_diff.path,
+                old_path=file_diff.old_path,
+                header_lines=file_diff.header_lines,
+                hunks=kept_hunks,
+                is_binary=file_diff.is_binary,
+            ))
+    logger.debug(
+        f"Pre-scan kept {stats['hunks_kept']}/{stats['hunks']} hunk(s) "
+        f"({stats['files_skipped']}/{stats['files']} file(s) skipped outright)."
+    )
+    return kept_files, stats
@@ -0,0 +1,113 @@
+# worker/profiling.py
+"""Optional sampling profiler for slow analysis tasks.
+
+While a task runs, a background thread samples the Python stacks of the process's
+threads every TASK_PROFILER_INTERVAL_SECONDS (sys._current_frames(), no tracing hooks,
+so the task runs at full speed). Tasks that take longer than TASK_PROFILER_SLOW_SECONDS
+get their samples written in folded format ("thread;module:func;module:func count"),
+ready for flamegraph.pl or speedscope, and the hottest stacks logged.
+
+All threads are sampled because an analysis fans out to LLM chunk threads (or runs on
+the async event loop thread); with several tasks per process their samples overlap.
+"""
+
+import os
+import re
+import sys
+import time
+import logging
+import threading
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+TASK_PROFILER_ENABLED = os.getenv("TASK_PROFILER_ENABLED", "false").lower() in ("1", "true", "yes")
+TASK_PROFILER_SLOW_SECONDS = float(os.getenv("TASK_PROFILER_SLOW_SECONDS", "30"))
+TASK_PROFILER_INTERVAL_SECONDS = float(os.getenv("TASK_PROFILER_INTERVAL_SECONDS", "0.01"))
+TASK_PROFILER_OUTPUT_DIR = os.getenv("TASK_PROFILER_OUTPUT_DIR", "/tmp/codeguardian_profiles")
+TASK_PROFILER_TOP_STACKS = 5
+
+# Pool threads are numbered ("llm-chunk_3"); fold them into one flame graph root
+THREAD_NUMBER_RE = re.compile(r"[-_]\d+$")
+
+class SamplingProfiler:
+    """Collects folded stack samples of every other thread until stop() is called."""
+
+    def __init__(self, interval=TASK_PROFILER_INTERVAL_SECONDS):
+        self.interval = interval
+        self.samples = Counter()
+        self.started_at = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        self.thread = threading.Thread(target=self._run, name="task-profiler", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stops sampling and returns the elapsed seconds."""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        return time.perf_counter() - self.started_at
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    self.samples[self._fold(names.get(thread_id, str(thread_id)), frame)] += 1
+
+    @staticmethod
+    def _fold(thread_name, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{frame.f_globals.get('__name__', '?')}:{code.co_name}")
+            frame = frame.f_back
+        stack.append(THREAD_NUMBER_RE.sub("", thread_name))
+        return ";".join(reversed(stack))
+
+    def write(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+    def top_stacks(self, limit=TASK_PROFILER_TOP_STACKS):
+        return self.samples.most_common(limit)
+
+# --- Task Hooks ---
+
+_profilers = {}
+_profilers_lock = threading.Lock()
+
+def start_task_profile(task_id):
+    """Starts profiling a task if the profiler is enabled (called from Celery's task_prerun)."""
+    if not TASK_PROFILER_ENABLED or not task_id:
+        return
+    with _profilers_lock:
+        _profilers[task_id] = SamplingProfiler().start()
+
+def finish_task_profile(task_id, task_name):
+    """Stops a task's profiler and keeps the profile only if the task was slow. Returns its path."""
+    with _profilers_lock:
+        profiler = _profilers.pop(task_id, None)
+    if profiler is None:
+        return None
+    elapsed = profiler.stop()
+    if elapsed < TASK_PROFILER_SLOW_SECONDS:
+        return None
+    path = os.path.join(TASK_PROFILER_OUTPUT_DIR, f"{task_name}-{task_id}.folded")
+    try:
+        profiler.write(path)
+    except OSError as e:
+        logger.warning(f"Failed to write profile for slow task {task_id}: {e}")
+        return None
+    hottest = "\n".join(f"  {count:6d}  ...;{';'.join(stack.split(';')[-3:])}" for stack, count in profiler.top_stacks())
+    logger.warning(f"Task {task_name}[{task_id}] took {elapsed:.1f}s; profile written to {path}. Hottest stacks:\n{hottest}")
+    return path
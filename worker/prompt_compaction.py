@@ -0,0 +1,254 @@
+# worker/prompt_compaction.py
+
+import os
+import re
+import logging
+from collections import Counter
+
+from .diff_chunker import DiffHunk, FileDiff, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+PROMPT_COMPACTION_ENABLED = os.getenv("PROMPT_COMPACTION_ENABLED", "true").lower() in ("1", "true", "yes")
+# Unchanged lines kept around each change; longer context runs are dropped and the hunk split there
+PROMPT_CONTEXT_LINES = int(os.getenv("PROMPT_CONTEXT_LINES", "1"))
+# String literals longer than this are cut down to a prefix (embedded data, SQL dumps, base64...)
+PROMPT_MAX_LITERAL_CHARS = int(os.getenv("PROMPT_MAX_LITERAL_CHARS", "120"))
+PROMPT_MAX_LINE_CHARS = int(os.getenv("PROMPT_MAX_LINE_CHARS", "400"))
+# Hard ceiling for one user prompt (template, hints and diff); the system prompt and output come on top
+LLM_PROMPT_TOKEN_BUDGET = int(os.getenv("LLM_PROMPT_TOKEN_BUDGET", "7000"))
+# What to do with a prompt over budget: "truncate" (drop hints, then the diff's tail) or "fail"
+LLM_PROMPT_OVERFLOW = os.getenv("LLM_PROMPT_OVERFLOW", "truncate").lower()
+
+# Deleting one of these can open a hole, so deletion-only hunks touching them still go to the LLM
+SECURITY_CONTROL_RE = re.compile(
+    r"(?i)auth|login_required|permission|csrf|verify|validat|sanitiz|escape|allowed|whitelist|allowlist|"
+    r"is_admin|is_staff|check_|require|token|secret|password|ssl|tls|cert"
+)
+# Header lines the LLM needs; "index", mode and similarity lines are dropped
+KEPT_HEADER_PREFIXES = ("--- ", "+++ ", "rename from ", "rename to ", "new file mode", "deleted file mode")
+STRING_LITERAL_RE = re.compile(r"""(?P<quote>["'])(?P<body>(?:\\.|(?!(?P=quote))[^\\\n])*)(?P=quote)""")
+LINE_HINT_RE = re.compile(r"^line (\d+):")
+WHITESPACE_RE = re.compile(r"\s+")
+TRUNCATION_MARKER = "...[+{} chars]"
+
+class PromptBudgetExceeded(ValueError):
+    """A prompt did not fit LLM_PROMPT_TOKEN_BUDGET and LLM_PROMPT_OVERFLOW is "fail"."""
+
+# --- Lines ---
+
+def shorten_line(line, stats=None):
+    """Cuts oversized string literals (and, failing that, the line itself) down to size."""
+    if len(line) <= PROMPT_MAX_LITERAL_CHARS:
+        return line
+
+    def shorten(match):
+        body = match.group("body")
+        if len(body) <= PROMPT_MAX_LITERAL_CHARS:
+            return match.group(0)
+        if stats is not None:
+            stats["literals_truncated"] += 1
+        quote = match.group("quote")
+        kept = body[:PROMPT_MAX_LITERAL_CHARS // 2]
+        return f"{quote}{kept}{TRUNCATION_MARKER.format(len(body) - len(kept))}{quote}"
+
+    line = STRING_LITERAL_RE.sub(shorten, line)
+    if len(line) > PROMPT_MAX_LINE_CHARS:
+        if stats is not None:
+            stats["lines_truncated"] += 1
+        line = line[:PROMPT_MAX_LINE_CHARS] + TRUNCATION_MARKER.format(len(line) - PROMPT_MAX_LINE_CHARS)
+    return line
+
+def _churn_key(text):
+    """The line with interior whitespace runs collapsed and trailing whitespace dropped.
+
+    Leading indentation is kept verbatim: in Python it is control flow, so a call moved
+    out of an `if is_admin(...)` block must stay a change.
+    """
+    body = text.lstrip(" \t")
+    return text[:len(text) - len(body)] + WHITESPACE_RE.sub(" ", body).rstrip()
+
+def _fold_whitespace_churn(lines, stats):
+    """Turns added lines that only re-space (never re-indent) a removed line of the same block into context."""
+    result, block = [], []
+
+    def flush():
+        removed = Counter(_churn_key(line[1:]) for line in block if line.startswith("-"))
+        matched = Counter()
+        added = []
+        for line in block:
+            if not line.startswith("+"):
+                continue
+            key = _churn_key(line[1:])
+            if removed[key] > matched[key]:
+                matched[key] += 1
+                added.append(" " + line[1:])
+                stats["whitespace_lines"] += 1
+            else:
+                added.append(line)
+        # Removed lines whose content survives are dropped; the new side keeps its line positions
+        for line in block:
+            if line.startswith("-"):
+                key = _churn_key(line[1:])
+                if matched[key]:
+                    matched[key] -= 1
+                    continue
+                result.append(line)
+        result.extend(added)
+        block.clear()
+
+    for line in lines:
+        if line.startswith(("-", "+")):
+            block.append(line)
+        else:
+            if block:
+                flush()
+            result.append(line)
+    if block:
+        flush()
+    return result
+
+# --- Hunks ---
+
+def _split_at_context(hunk, lines, context_lines, stats):
+    """Keeps context within context_lines of a change and splits the hunk where longer runs were dropped.
+
+    Each piece gets a recomputed header, so line numbers in the new file stay exact.
+    """
+    changed = [i for i, line in enumerate(lines) if line.startswith(("+", "-"))]
+    keep = set()
+    for i in changed:
+        keep.update(range(max(0, i - context_lines), min(len(lines), i + context_lines + 1)))
+
+    pieces = []
+    old_line, new_line = hunk.old_start, hunk.new_start
+    current = None
+    for i, line in enumerate(lines):
+        # "\ No newline at end of file" belongs to the line before it
+        kept = i in keep or (line.startswith("\\") and i - 1 in keep)
+        if kept:
+            if current is None:
+                current = DiffHunk(
+                    file_path=hunk.file_path, old_start=old_line, old_length=0,
+                    new_start=new_line, new_length=0, section=hunk.section,
+                )
+                pieces.append(current)
+            current.lines.append(shorten_line(line, stats))
+        else:
+            current = None
+            stats["context_lines_dropped"] += 1
+        if line.startswith("+"):
+            new_line += 1
+            if kept:
+                current.new_length += 1
+        elif line.startswith("-"):
+            old_line += 1
+            if kept:
+                current.old_length += 1
+        elif not line.startswith("\\"):
+            old_line += 1
+            new_line += 1
+            if kept:
+                current.old_length += 1
+                current.new_length += 1
+
+    # Line-specific pre-scan hints follow their line; the others stay with the first piece
+    for index, piece in enumerate(pieces):
+        for hint in hunk.hints:
+            match = LINE_HINT_RE.match(hint)
+            if match:
+                if piece.new_start <= int(match.group(1)) < piece.new_start + max(piece.new_length, 1):
+                    piece.hints.append(hint)
+            elif index == 0:
+                piece.hints.append(hint)
+    return pieces
+
+def compact_hunk(hunk, context_lines=PROMPT_CONTEXT_LINES, stats=None):
+    """Returns the hunk reduced to what can matter for security review, as zero or more hunks."""
+    stats = stats if stats is not None else Counter()
+    lines = _fold_whitespace_churn(hunk.lines, stats)
+    if not any(line.startswith("+") for line in lines):
+        # Deletion-only (or whitespace-only) hunks cannot add vulnerable code, unless they remove a control
+        removed = [line for line in lines if line.startswith("-")]
+        if not any(SECURITY_CONTROL_RE.search(line) for line in removed):
+            stats["hunks_dropped"] += 1
+            return []
+    return _split_at_context(hunk, lines, context_lines, stats)
+
+def compact_diff(file_diffs, context_lines=PROMPT_CONTEXT_LINES):
+    """Compacts every hunk of the diff before it is chunked into prompts.
+
+    Returns (compacted FileDiffs, stats dict) - stats include the estimated prompt tokens
+    before and after, so callers can report what compaction saved.
+    """
+    stats = Counter()
+    compacted_files = []
+    for file_diff in file_diffs:
+        hunks = []
+        for hunk in file_diff.hunks:
+            stats["tokens_before"] += estimate_tokens(hunk.text())
+            hunks.extend(compact_hunk(hunk, context_lines, stats))
+        header_lines = [line for line in file_diff.header_lines if line.startswith(KEPT_HEADER_PREFIXES)]
+        stats["tokens_before"] += estimate_tokens(file_diff.header_text())
+        if not hunks:
+            continue
+        stats["tokens_after"] += estimate_tokens("\n".join(header_lines))
+        stats["tokens_after"] += sum(estimate_tokens(hunk.text()) for hunk in hunks)
+        compacted_files.append(FileDiff(
+            path=file_diff.path,
+            old_path=file_diff.old_path,
+            header_lines=header_lines,
+            hunks=hunks,
+            is_binary=file_diff.is_binary,
+        ))
+    stats = dict(stats)
+    stats["tokens_saved"] = stats.get("tokens_before", 0) - stats.get("tokens_after", 0)
+    logger.debug(f"Prompt compaction: {stats}")
+    return compacted_files, stats
+
+# --- Prompt Budget ---
+
+def fit_prompt(render, diff_text, hints, budget=LLM_PROMPT_TOKEN_BUDGET, overflow=LLM_PROMPT_OVERFLOW):
+    """Renders render(diff_text, hints) within budget tokens. Returns (prompt, tokens cut).
+
+    Over budget, hints are dropped from the end first, then diff lines from the end (an
+    omission note tells the LLM); with overflow="fail", PromptBudgetExceeded is raised instead.
+    """
+    prompt = render(diff_text, hints)
+    tokens = estimate_tokens(prompt)
+    if tokens <= budget:
+        return prompt, 0
+    if overflow == "fail":
+        raise PromptBudgetExceeded(f"Prompt needs ~{tokens} tokens, over the budget of {budget}")
+
+    base_tokens = estimate_tokens(render("", []))
+    kept_hints, used = [], base_tokens + estimate_tokens(diff_text)
+    for hint in hints or []:
+        cost = estimate_tokens(hint) + 1
+        if used + cost > budget:
+            break
+        kept_hints.append(hint)
+        used += cost
+
+    prompt = render(diff_text, kept_hints)
+    if estimate_tokens(prompt) > budget:
+        available_chars = max(budget - estimate_tokens(render("", kept_hints)) - 20, 0) * 4
+        kept_lines, size = [], 0
+        lines = diff_text.splitlines()
+        for line in lines:
+            if size + len(line) + 1 > available_chars:
+                break
+            kept_lines.append(line)
+            size += len(line) + 1
+        if not kept_lines and lines:
+            kept_lines = [lines[0][:available_chars]]  # A single giant line: keep its start
+        omitted = len(lines) - len(kept_lines)
+        kept_lines.append(f"[... {omitted} more diff line(s) omitted to fit the prompt budget]")
+        prompt = render("\n".join(kept_lines) + "\n", kept_hints)
+    cut = tokens - estimate_tokens(prompt)
+    logger.warning(
+        f"Prompt over budget ({tokens} > {budget} tokens); dropped {len(hints or []) - len(kept_hints)} hint(s) "
+        f"and cut ~{cut} token(s)."
+    )
+    return prompt, cut
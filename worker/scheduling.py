@@ -0,0 +1,224 @@
+# worker/scheduling.py
+
+import os
+import json
+import time
+import logging
+import threading
+
+from .metrics import record_queue_wait
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Priority lanes, consumed in this order (see broker_transport_options in celery_app.py)
+HIGH_PRIORITY_QUEUE = "analysis.high"
+DEFAULT_QUEUE = "analysis.default"
+LOW_PRIORITY_QUEUE = "analysis.low"
+ANALYSIS_QUEUES = (HIGH_PRIORITY_QUEUE, DEFAULT_QUEUE, LOW_PRIORITY_QUEUE)
+# PRs changing at most this many lines jump to the high lane; larger than LARGE go to the low lane
+SMALL_PR_MAX_CHANGES = int(os.getenv("SMALL_PR_MAX_CHANGES", "200"))
+LARGE_PR_MIN_CHANGES = int(os.getenv("LARGE_PR_MIN_CHANGES", "5000"))
+# Comma-separated installation IDs (e.g. paid tiers) that always use the high lane
+PRIORITY_INSTALLATION_IDS = {i.strip() for i in os.getenv("PRIORITY_INSTALLATION_IDS", "").split(",") if i.strip()}
+# Weighted round-robin: "installation_id:weight,..." (default weight 1) = tasks dispatched per turn
+INSTALLATION_WEIGHTS = {
+    pair.split(":")[0].strip(): int(pair.split(":")[1])
+    for pair in os.getenv("INSTALLATION_WEIGHTS", "").split(",") if ":" in pair
+}
+# Analyses allowed to run at once per installation
+INSTALLATION_MAX_CONCURRENCY = int(os.getenv("INSTALLATION_MAX_CONCURRENCY", "3"))
+# A running slot is considered leaked (e.g. worker killed) after this long
+SLOT_TIMEOUT_SECONDS = int(os.getenv("INSTALLATION_SLOT_TIMEOUT_SECONDS", "900"))
+QUEUE_WAIT_SAMPLES = 1000
+
+KEY_PREFIX = "codeguardian:fair:"
+RING_KEY = KEY_PREFIX + "ring"
+ACTIVE_KEY = KEY_PREFIX + "active"
+DISPATCH_LOCK_KEY = KEY_PREFIX + "dispatch_lock"
+
+# Appends work for an installation and, if it was idle, adds it to the round-robin ring
+_SUBMIT_SCRIPT = """
+redis.call('RPUSH', KEYS[1], ARGV[2])
+if redis.call('SADD', KEYS[2], ARGV[1]) == 1 then
+  redis.call('RPUSH', KEYS[3], ARGV[1])
+end
+return 1
+"""
+
+# Removes an installation from the ring only if nothing was submitted for it meanwhile
+_RETIRE_SCRIPT = """
+if redis.call('LLEN', KEYS[1]) == 0 then
+  redis.call('SREM', KEYS[2], ARGV[1])
+  redis.call('LREM', KEYS[3], 0, ARGV[1])
+  return 1
+end
+return 0
+"""
+
+def _pending_key(installation_id):
+    return f"{KEY_PREFIX}pending:{installation_id}"
+
+def _running_key(installation_id):
+    return f"{KEY_PREFIX}running:{installation_id}"
+
+def _queue_wait_key(installation_id):
+    return f"{KEY_PREFIX}queue_wait:{installation_id}"
+
+_redis = None
+_redis_lock = threading.Lock()
+
+def get_redis():
+    global _redis
+    if _redis is None:
+        with _redis_lock:
+            if _redis is None:
+                try:
+                    import redis
+                    client = redis.Redis.from_url(REDIS_URL, socket_timeout=2, socket_connect_timeout=2)
+                    client.ping()
+                    _redis = client
+                except Exception as e:
+                    logger.warning(f"Redis unavailable for fair scheduling: {e}")
+                    return None
+    return _redis
+
+# --- Lanes ---
+
+def choose_queue(task_data):
+    """Picks the priority lane: priority installations and small PRs first, huge PRs last."""
+    if str(task_data.get("installation_id")) in PRIORITY_INSTALLATION_IDS:
+        return HIGH_PRIORITY_QUEUE
+    changes = task_data.get("additions")
+    if changes is None:
+        return DEFAULT_QUEUE
+    changes += task_data.get("deletions") or 0
+    if changes <= SMALL_PR_MAX_CHANGES:
+        return HIGH_PRIORITY_QUEUE
+    if changes >= LARGE_PR_MIN_CHANGES:
+        return LOW_PRIORITY_QUEUE
+    return DEFAULT_QUEUE
+
+# --- Submission ---
+
+def submit_analysis(task, task_data, task_id, countdown=0):
+    """Queues an analysis behind its installation's fair-share queue.
+
+    The task is handed to Celery by dispatch_pending() once it is ready (after countdown)
+    and the installation has a free slot. Without Redis it goes to Celery directly.
+    """
+    now = time.time()
+    task_data = dict(task_data, enqueued_at=now, ready_at=now + countdown)
+    client = get_redis()
+    if client is None:
+        return task.apply_async((task_data,), task_id=task_id, countdown=countdown, queue=choose_queue(task_data))
+
+    installation_id = str(task_data["installation_id"])
+    item = json.dumps({"task_id": task_id, "task_data": task_data})
+    client.eval(_SUBMIT_SCRIPT, 3, _pending_key(installation_id), ACTIVE_KEY, RING_KEY, installation_id, item)
+    if countdown <= 0:
+        dispatch_pending(task)
+    return task_id
+
+# --- Dispatch ---
+
+def running_count(client, installation_id):
+    key = _running_key(installation_id)
+    client.zremrangebyscore(key, "-inf", time.time() - SLOT_TIMEOUT_SECONDS)
+    return client.zcard(key)
+
+def release_slot(installation_id, task_id):
+    """Frees the installation slot held by a finished (or retrying) task."""
+    client = get_redis()
+    if client is None or installation_id is None:
+        return
+    try:
+        client.zrem(_running_key(installation_id), task_id)
+    except Exception as e:
+        logger.warning(f"Failed to release slot for installation {installation_id}: {e}")
+
+def dispatch_pending(task, is_stale=None, max_dispatch=100):
+    """Moves ready work to Celery, weighted round-robin across installations.
+
+    Each installation gets up to its weight in tasks per turn, never exceeding
+    INSTALLATION_MAX_CONCURRENCY running at once. is_stale(task_data) lets the caller drop
+    work that no longer needs doing (e.g. a superseded head). Returns the number dispatched.
+    """
+    client = get_redis()
+    if client is None:
+        return 0
+    lock = client.lock(DISPATCH_LOCK_KEY, timeout=30)
+    if not lock.acquire(blocking=False):
+        return 0  # Another process is dispatching; the next tick or completion picks up the rest
+    dispatched = 0
+    try:
+        for _ in range(client.llen(RING_KEY)):
+            if dispatched >= max_dispatch:
+                break
+            raw_id = client.rpoplpush(RING_KEY, RING_KEY)  # Rotate the ring by one installation
+            if raw_id is None:
+                break
+            installation_id = raw_id.decode("utf-8")
+            pending_key = _pending_key(installation_id)
+            for _ in range(INSTALLATION_WEIGHTS.get(installation_id, 1)):
+                if running_count(client, installation_id) >= INSTALLATION_MAX_CONCURRENCY:
+                    break
+                raw_item = client.lindex(pending_key, 0)
+                if raw_item is None:
+                    client.eval(_RETIRE_SCRIPT, 3, pending_key, ACTIVE_KEY, RING_KEY, installation_id)
+                    break
+                item = json.loads(raw_item)
+                task_data = item["task_data"]
+                if task_data.get("ready_at", 0) > time.time():
+                    break  # Still inside its debounce window
+                client.lpop(pending_key)
+                if is_stale is not None and is_stale(task_data):
+                    continue
+                client.zadd(_running_key(installation_id), {item["task_id"]: time.time()})
+                task.apply_async((task_data,), task_id=item["task_id"], queue=choose_queue(task_data))
+                dispatched += 1
+    finally:
+        try:
+            lock.release()
+        except Exception:
+            pass
+    if dispatched:
+        logger.info(f"Dispatched {dispatched} pending analysis task(s).")
+    return dispatched
+
+# --- Queue Wait Metrics ---
+
+def observe_queue_wait(task_data):
+    """Records how long a task waited between becoming ready and starting. Returns the wait in seconds."""
+    ready_at = task_data.get("ready_at") or task_data.get("enqueued_at")
+    if not ready_at:
+        return None
+    wait = max(time.time() - ready_at, 0.0)
+    record_queue_wait(wait)
+    client = get_redis()
+    if client is not None:
+        try:
+            key = _queue_wait_key(task_data.get("installation_id"))
+            pipe = client.pipeline()
+            pipe.lpush(key, f"{wait:.3f}")
+            pipe.ltrim(key, 0, QUEUE_WAIT_SAMPLES - 1)
+            pipe.expire(key, 7 * 24 * 3600)
+            pipe.execute()
+        except Exception as e:
+            logger.debug(f"Failed to record queue wait: {e}")
+    return wait
+
+def queue_wait_stats(installation_id):
+    """Returns p50/p95/p99/max queue wait (seconds) over the installation's recent tasks."""
+    client = get_redis()
+    if client is None:
+        return {}
+    samples = sorted(float(v) for v in client.lrange(_queue_wait_key(installation_id), 0, -1))
+    if not samples:
+        return {"count": 0}
+
+    def pct(p):
+        return samples[min(len(samples) - 1, int(p / 100 * len(samples)))]
+
+    return {"count": len(samples), "p50": pct(50), "p95": pct(95), "p99": pct(99), "max": samples[-1]}
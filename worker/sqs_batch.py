@@ -0,0 +1,59 @@
+# worker/sqs_batch.py
+
+import os
+import json
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# Message groups of one batch processed at once (records within a group always run in order)
+SQS_BATCH_MAX_CONCURRENCY = int(os.getenv("SQS_BATCH_MAX_CONCURRENCY", "4"))
+
+def message_group_id(record):
+    """FIFO group of a record (the PR, as set by the producer); standard queues have none."""
+    return (record.get("attributes") or {}).get("MessageGroupId")
+
+def group_records(records):
+    """Splits records into ordered groups. Without a group ID every record is its own group."""
+    groups = OrderedDict()
+    for position, record in enumerate(records):
+        key = message_group_id(record) or f"__ungrouped__{position}"
+        groups.setdefault(key, []).append(record)
+    return list(groups.values())
+
+def process_sqs_batch(records, process_record, max_concurrency=SQS_BATCH_MAX_CONCURRENCY):
+    """Processes an SQS batch and returns the Lambda partial batch response.
+
+    Message groups run concurrently, records inside a group strictly in order. Once a
+    record fails, the rest of its group is not attempted and is reported failed too, as
+    FIFO queues require to keep the group's order on redelivery. process_record(record)
+    raises to fail a record; only failed messages are returned to the queue.
+    """
+    groups = group_records(records)
+
+    def run_group(group):
+        failed = []
+        for position, record in enumerate(group):
+            try:
+                process_record(record)
+            except Exception as e:
+                logger.error(f"SQS message {record.get('messageId')} failed: {e}", exc_info=True)
+                failed = [r["messageId"] for r in group[position:]]
+                if len(failed) > 1:
+                    logger.warning(f"Deferring {len(failed) - 1} later message(s) of group {message_group_id(record)}.")
+                break
+        return failed
+
+    failures = []
+    if groups:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(groups))), thread_name_prefix="sqs-group") as executor:
+            for failed in executor.map(run_group, groups):
+                failures.extend(failed)
+    return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in failures]}
+
+def decode_record(record):
+    """Returns the task_data carried by a record (the JSON the webhook would pass to the Celery task)."""
+    return json.loads(record["body"])
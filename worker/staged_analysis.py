@@ -0,0 +1,186 @@
+# worker/staged_analysis.py
+"""The PR analysis pipeline split into stages for the staged Celery canvas (ANALYSIS_MODE=staged).
+
+    fetch (analysis.* lanes) -> chord[analyze chunk ... (analysis.llm)] -> aggregate (analysis.aggregate)
+    -> post (analysis.post)
+
+Each stage is its own task with its own retries, so a failure is retried from the stage
+that failed: a post retry does not re-run the LLM, a chunk retry redoes only that chunk.
+Stages pass nothing but the run id; the diff, the chunks and the findings are stored as
+compressed artifacts (artifacts.py). The run id is the id of the analyze_pull_request
+task, which also holds the installation's fair-share slot until the run ends.
+"""
+
+import logging
+
+from . import analysis
+from .analysis import (
+    fetch_pr_diff, fetch_commit_range_diff, get_github_installation_token, analyze_diff_chunk, merge_findings,
+    prepare_llm_chunks, plan_diff_fetch, ingest_diff, carried_findings_for, post_findings, analysis_result,
+    finish_analysis,
+)
+from .artifacts import get_artifact_store, chunk_to_dict, chunk_from_dict, file_diff_to_dict, file_diff_from_dict
+from .triage import LLM_TRIAGE_ENABLED, CascadeStats
+from .pr_state import get_pr_state_store
+from .fingerprints import FINDING_DEDUPE_ENABLED, load_posted_findings
+from .coalescing import ensure_not_superseded
+from .llm_resilience import bind_time_budget
+from .metrics import stage_timer, bind_installation
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = "manifest"
+FILE_DIFFS = "file_diffs"
+FINDINGS = "findings"
+
+def _chunk_name(index):
+    return f"chunk_{index}"
+
+def _chunk_findings_name(index):
+    return f"chunk_{index}_findings"
+
+def _log_prefix(pr_data):
+    return f"PR Analysis - {pr_data.get('repo_full_name')}# {pr_data.get('pr_number')}:"
+
+def load_manifest(run_id):
+    """The run's pr_data, mode, chunk count and carried findings; raises ArtifactMissing once the run is gone."""
+    return get_artifact_store().get(run_id, MANIFEST)
+
+def discard_run(run_id):
+    get_artifact_store().delete_run(run_id)
+
+# --- Stage 1: Fetch ---
+
+def fetch_stage(pr_data, run_id):
+    """Fetches and chunks the diff and stores it for the later stages.
+
+    Returns (result, chunk_count): chunk_count is None when the run already ended here
+    (head unchanged or no analyzable diff), in which case result is the final result.
+    """
+    repo_full_name = pr_data.get("repo_full_name")
+    pr_number = pr_data.get("pr_number")
+    installation_id = pr_data.get("installation_id")
+    commit_id = pr_data.get("pr_head_sha")
+    log_prefix = _log_prefix(pr_data)
+    bind_installation(installation_id)
+
+    if not installation_id:
+        raise ValueError("Missing installation_id")
+    if not analysis.get_openai_client():
+        raise ValueError("OpenAI client not configured.")
+    ensure_not_superseded(repo_full_name, pr_number, commit_id)
+
+    with stage_timer("token"):
+        github_token = get_github_installation_token(installation_id)
+    if not github_token:
+        raise ValueError("Failed to get GitHub token")
+
+    previous_state = get_pr_state_store().load(repo_full_name, pr_number)
+    plan = plan_diff_fetch(previous_state, commit_id, log_prefix)
+    if plan == "unchanged":
+        return analysis_result("unchanged"), None
+    diff_spool = None
+    if plan == "incremental":
+        with stage_timer("diff_fetch"):
+            diff_spool = fetch_commit_range_diff(github_token, repo_full_name, previous_state["head_sha"], commit_id)
+    mode = "full" if diff_spool is None else "incremental"
+    if mode == "full":
+        with stage_timer("diff_fetch"):
+            diff_spool = fetch_pr_diff(github_token, repo_full_name, pr_number)
+    file_diffs = ingest_diff(diff_spool, log_prefix)
+    carried_findings = carried_findings_for(mode, previous_state, file_diffs, commit_id, log_prefix)
+    if not file_diffs:
+        logger.info(f"{log_prefix} No analyzable diff content found or fetched.")
+        return finish_analysis(pr_data, analysis_result(mode), carried_findings), None
+
+    chunks, tokens_saved = prepare_llm_chunks(file_diffs, log_prefix)
+
+    # Chunks first and the manifest last: a run with a manifest is complete
+    store = get_artifact_store()
+    stored_bytes = store.put(run_id, FILE_DIFFS, [file_diff_to_dict(file_diff) for file_diff in file_diffs])
+    for chunk in chunks:
+        stored_bytes += store.put(run_id, _chunk_name(chunk.index), chunk_to_dict(chunk))
+    store.put(run_id, MANIFEST, {
+        "pr_data": pr_data, "mode": mode, "chunk_count": len(chunks), "carried_findings": carried_findings,
+        "prompt_tokens_saved": tokens_saved,
+    })
+    logger.info(f"{log_prefix} Staged {len(chunks)} chunk(s) ({mode}, {stored_bytes} compressed bytes) as run {run_id}.")
+    return {"status": "dispatched", "run_id": run_id, "chunks": len(chunks), "mode": mode}, len(chunks)
+
+# --- Stage 2: Analyze Chunks ---
+
+def analyze_chunk_stage(run_id, index):
+    """Runs one chunk through triage and the LLM and stores its findings. Redelivered chunks are skipped."""
+    store = get_artifact_store()
+    manifest = load_manifest(run_id)
+    pr_data = manifest["pr_data"]
+    bind_installation(pr_data.get("installation_id"))
+    bind_time_budget()
+    if store.exists(run_id, _chunk_findings_name(index)):
+        return {"status": "success", "chunk": index, "cached": True}
+    ensure_not_superseded(pr_data.get("repo_full_name"), pr_data.get("pr_number"), pr_data.get("pr_head_sha"))
+
+    chunk = chunk_from_dict(store.get(run_id, _chunk_name(index)))
+    cascade_stats = CascadeStats() if LLM_TRIAGE_ENABLED else None
+    findings = analyze_diff_chunk(chunk, cascade_stats=cascade_stats)
+    store.put(run_id, _chunk_findings_name(index), {
+        "findings": findings, "triage": cascade_stats.as_dict() if cascade_stats else None,
+    })
+    return {"status": "success", "chunk": index, "findings_count": len(findings)}
+
+# --- Stage 3: Aggregate ---
+
+def aggregate_stage(run_id):
+    """Merges the per-chunk findings in chunk order into the run's findings artifact."""
+    store = get_artifact_store()
+    manifest = load_manifest(run_id)
+    results, triage = [], None
+    for index in range(manifest["chunk_count"]):
+        # A chunk whose task gave up has no findings artifact; ArtifactMissing ends the run
+        stored = store.get(run_id, _chunk_findings_name(index))
+        results.append(stored["findings"])
+        if stored.get("triage"):
+            triage = triage or {"hunks": 0, "escalated": 0, "failed_open": 0}
+            for key in triage:
+                triage[key] += stored["triage"].get(key, 0)
+    if triage:
+        triage["escalation_rate"] = round(triage["escalated"] / triage["hunks"], 3) if triage["hunks"] else 0.0
+    findings = merge_findings(results)
+    store.put(run_id, FINDINGS, {"findings": findings, "triage": triage})
+    logger.info(f"{_log_prefix(manifest['pr_data'])} Aggregated {len(findings)} finding(s) from run {run_id}.")
+    return {"status": "success", "findings_count": len(findings)}
+
+# --- Stage 4: Post ---
+
+def post_stage(run_id):
+    """Posts the run's findings, saves the PR state and returns the final result dict.
+
+    Posting is idempotent through finding fingerprints, so a retried post does not
+    duplicate the reviews that made it out before the failure.
+    """
+    store = get_artifact_store()
+    manifest = load_manifest(run_id)
+    pr_data = manifest["pr_data"]
+    repo_full_name = pr_data.get("repo_full_name")
+    pr_number = pr_data.get("pr_number")
+    commit_id = pr_data.get("pr_head_sha")
+    log_prefix = _log_prefix(pr_data)
+    bind_installation(pr_data.get("installation_id"))
+    ensure_not_superseded(repo_full_name, pr_number, commit_id)
+
+    aggregated = store.get(run_id, FINDINGS)
+    findings = aggregated["findings"]
+    carried_findings = manifest["carried_findings"]
+    file_diffs = [file_diff_from_dict(data) for data in store.get(run_id, FILE_DIFFS)]
+    github_token = get_github_installation_token(pr_data.get("installation_id"))
+    if not github_token:
+        raise ValueError("Failed to get GitHub token")
+
+    posted_findings = None
+    if FINDING_DEDUPE_ENABLED:
+        posted_findings = load_posted_findings(github_token, repo_full_name, pr_number)
+    post_findings(github_token, pr_data, findings, carried_findings, file_diffs, posted_findings)
+
+    logger.info(f"{log_prefix} Successfully completed staged analysis (run {run_id}).")
+    result = analysis_result(manifest["mode"], len(findings), manifest["prompt_tokens_saved"], aggregated.get("triage"))
+    return finish_analysis(pr_data, result, carried_findings + findings)
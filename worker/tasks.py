@@ -2,10 +2,21 @@
 
 import os
 import time
+import random
 import logging
+from celery import chain, chord
+from celery.signals import (
+    task_revoked, task_prerun, task_postrun, task_retry, worker_init, worker_process_shutdown,
+)
 from .celery_app import app
-from openai import OpenAI, RateLimitError, APIError
-import requests # Placeholder for GitHub API calls
+from .analysis import run_pr_analysis
+from .coalescing import AnalysisSuperseded, is_superseded
+from .scheduling import dispatch_pending, release_slot, observe_queue_wait
+from .llm_rate_limiter import LLMCapacityUnavailable
+from .github_client import GitHubRateLimited
+from .artifacts import ArtifactMissing
+from .metrics import start_metrics_server, record_task, record_retry, mark_process_dead
+from .profiling import start_task_profile, finish_task_profile
 from dotenv import load_dotenv
 
 # Load .env for local dev if needed (Celery might load it differently)
@@ -14,144 +25,14 @@ load_dotenv()
 logger = logging.getLogger(__name__)
 
 # --- Configuration ---
-# In production, use dependency injection or a config object
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-LLM_MODEL_NAME = os.getenv("LLM_MODEL_NAME", "gpt-4o") # Or your preferred model
-GITHUB_API_BASE_URL = "https://api.github.com"
-
-# Initialize OpenAI client (consider initializing once per worker process)
-if OPENAI_API_KEY:
-    openai_client = OpenAI(api_key=OPENAI_API_KEY)
-else:
-    logger.warning("OPENAI_API_KEY not found in environment. LLM calls will fail.")
-    openai_client = None
-
-# --- Helper Functions (Placeholders/Simplified) ---
-
-def get_github_installation_token(installation_id):
-    """Placeholder: Fetches a short-lived installation token."""
-    # In reality, this involves creating a JWT signed with the app's private key
-    # and exchanging it for an installation token.
-    logger.info(f"Simulating fetching token for installation {installation_id}")
-    # Use a placeholder token for simulation if needed, but real calls require a valid one.
-    # return os.getenv("PLACEHOLDER_GITHUB_TOKEN")
-    return "ghs_placeholder_token" # Extremely temporary placeholder
-
-def fetch_pr_diff(token, repo_full_name, pr_number):
-    """Placeholder: Fetches the diff content of a Pull Request."""
-    # url = f"{GITHUB_API_BASE_URL}/repos/{repo_full_name}/pulls/{pr_number}"
-    # headers = {
-    #     "Authorization": f"Bearer {token}",
-    #     "Accept": "application/vnd.github.v3.diff"
-    # }
-    # response = requests.get(url, headers=headers)
-    # response.raise_for_status() # Raise exception for bad status codes
-    # return response.text
-    logger.info(f"Simulating fetching diff for {repo_full_name}# {pr_number}")
-    return """diff --git a/vulnerable.py b/vulnerable.py
-index e69de29..d1f2e7a 100644
---- a/vulnerable.py
-+++ b/vulnerable.py
-@@ -0,0 +1,5 @@
-+import os
-+
-+def execute_command(user_input):
-+    # Potential command injection vulnerability
-+    os.system(f"echo User input: {user_input}")
-""" # Sample Python diff
-
-def create_security_analysis_prompt(diff_content):
-    """Creates the prompt for the LLM to analyze the diff for security issues."""
-    # This prompt needs significant refinement and testing
-    prompt = f"""
-Analyze the following code diff for potential security vulnerabilities in Python. Focus specifically on identifying issues like command injection, SQL injection, cross-site scripting (XSS), insecure deserialization, improper access control, and use of weak cryptographic algorithms. For each vulnerability found, provide:
-1. The file path (if available in the diff).
-2. The line number where the vulnerability occurs (relative to the diff hunk).
-3. A brief description of the vulnerability type.
-4. A clear explanation of the potential security risk.
-5. A specific suggestion for how to fix the vulnerability.
-
-Format the output as a JSON list of findings. Each finding should be an object with keys: "file_path", "line", "type", "risk", "suggestion". If no vulnerabilities are found, return an empty list.
-
-Code Diff:
-```diff
-{diff_content}
-```
-
-JSON Findings:
-"""
-    return prompt
-
-def call_llm_api(prompt):
-    """Calls the configured LLM API (OpenAI)."""
-    if not openai_client:
-        raise ValueError("OpenAI client not initialized. Check API key.")
-    
-    logger.info(f"Sending prompt to LLM model: {LLM_MODEL_NAME}")
-    try:
-        response = openai_client.chat.completions.create(
-            model=LLM_MODEL_NAME,
-            messages=[
-                {"role": "system", "content": "You are an expert security code reviewer specializing in Python."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.2, # Lower temperature for more deterministic results
-            max_tokens=1024, # Adjust as needed
-            response_format={"type": "json_object"} # Request JSON output if model supports it
-        )
-        logger.info("Received LLM response.")
-        # Ensure response content is accessed correctly
-        content = response.choices[0].message.content
-        return content
-    except RateLimitError as e:
-        logger.warning(f"LLM rate limit exceeded: {e}. Retrying task.")
-        raise # Re-raise to trigger Celery retry
-    except APIError as e:
-        logger.error(f"LLM API error: {e}")
-        raise # Re-raise to trigger Celery retry
-    except Exception as e:
-        logger.error(f"Unexpected error calling LLM: {e}", exc_info=True)
-        raise # Re-raise to trigger Celery retry
-
-def parse_llm_response(response_content):
-    """Parses the JSON response from the LLM."""
-    import json
-    try:
-        # Assuming the LLM returns a JSON string within the content
-        findings_data = json.loads(response_content)
-        # Basic validation
-        if isinstance(findings_data, dict) and "findings" in findings_data and isinstance(findings_data["findings"], list):
-             return findings_data["findings"]
-        elif isinstance(findings_data, list):
-             # If the response is directly the list
-             return findings_data
-        else:
-             logger.warning(f"LLM response JSON structure unexpected: {response_content}")
-             return []
-    except json.JSONDecodeError as e:
-        logger.error(f"Failed to parse LLM JSON response: {e}\nResponse content:\n{response_content}")
-        return [] # Return empty list on parsing error
-    except Exception as e:
-        logger.error(f"Error processing LLM response: {e}", exc_info=True)
-        return []
-
-def post_pr_comment(token, repo_full_name, pr_number, comment_body, commit_id, path, line):
-    """Placeholder: Posts a single review comment to a PR."""
-    # url = f"{GITHUB_API_BASE_URL}/repos/{repo_full_name}/pulls/{pr_number}/comments"
-    # headers = {
-    #     "Authorization": f"Bearer {token}",
-    #     "Accept": "application/vnd.github.v3+json"
-    # }
-    # data = {
-    #     "body": comment_body,
-    #     "commit_id": commit_id,
-    #     "path": path,
-    #     "line": line # Line number within the diff hunk
-    # }
-    # response = requests.post(url, headers=headers, json=data)
-    # response.raise_for_status()
-    logger.info(f"Simulating posting comment to {repo_full_name}# {pr_number} on path {path}, line {line}")
-    pass
+# "async" drives every analysis of the process on one shared event loop (run the worker with -P threads);
+# "staged" splits each analysis into fetch -> per-chunk LLM -> aggregate -> post tasks (see staged_analysis.py)
+ANALYSIS_MODE = os.getenv("ANALYSIS_MODE", "sync").lower()
+# Port of the worker's /metrics endpoint (0 disables it). With the prefork pool, set
+# PROMETHEUS_MULTIPROC_DIR so the child processes' metrics are aggregated.
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9540"))
+# Errors that say when to try again (retry_after): out of LLM capacity or GitHub rate limited
+RETRY_AFTER_ERRORS = (LLMCapacityUnavailable, GitHubRateLimited)
 
 # --- Celery Task ---
 
@@ -161,80 +42,262 @@ def analyze_pull_request(self, pr_data):
     repo_full_name = pr_data.get("repo_full_name")
     pr_number = pr_data.get("pr_number")
     installation_id = pr_data.get("installation_id")
-    commit_id = pr_data.get("pr_head_sha") # Use head SHA for comments
 
     log_prefix = f"PR Analysis - {repo_full_name}# {pr_number}:"
 
+    if self.request.retries == 0:
+        queue_wait = observe_queue_wait(pr_data)
+        if queue_wait is not None:
+            logger.info(f"{log_prefix} Waited {queue_wait:.1f}s in queue (installation {installation_id}).")
+
+    handed_off = False
     try:
         logger.info(f"{log_prefix} Starting analysis.")
 
-        if not installation_id:
-            raise ValueError("Missing installation_id")
-        if not openai_client:
-             raise ValueError("OpenAI client not configured.")
-
-        # 1. Get GitHub Token (Placeholder)
-        github_token = get_github_installation_token(installation_id)
-        if not github_token:
-             raise ValueError("Failed to get GitHub token")
-
-        # 2. Fetch PR Diff (Placeholder)
-        diff_content = fetch_pr_diff(github_token, repo_full_name, pr_number)
-        if not diff_content:
-            logger.info(f"{log_prefix} No diff content found or fetched.")
-            return {"status": "success", "findings_count": 0}
-        logger.info(f"{log_prefix} Fetched PR diff.")
-
-        # 3. Prepare & Call LLM
-        prompt = create_security_analysis_prompt(diff_content)
-        llm_response_content = call_llm_api(prompt)
-        if not llm_response_content:
-            raise ValueError("Received empty response from LLM")
-        logger.info(f"{log_prefix} Received LLM response.")
-
-        # 4. Parse LLM Response
-        findings = parse_llm_response(llm_response_content)
-        logger.info(f"{log_prefix} Parsed {len(findings)} findings from LLM response.")
-
-        # 5. Post Findings as PR Comments (Placeholder)
-        if findings:
-            logger.info(f"{log_prefix} Posting {len(findings)} findings to PR...")
-            for finding in findings:
-                # Construct comment body (apply behavioral principles here - concise, actionable)
-                comment_body = (
-                    f"**CodeGuardian AI Security Finding:**\n\n" 
-                    f"**Type:** {finding.get('type', 'N/A')}\n" 
-                    f"**Risk:** {finding.get('risk', 'N/A')}\n\n" 
-                    f"**Suggestion:** {finding.get('suggestion', 'N/A')}"
-                )
-                # Post comment (ensure path and line are correctly extracted/mapped)
-                post_pr_comment(
-                    github_token,
-                    repo_full_name,
-                    pr_number,
-                    comment_body,
-                    commit_id,
-                    finding.get("file_path", "unknown_file"), # Requires robust path extraction
-                    finding.get("line", 1) # Requires robust line mapping
-                )
-                time.sleep(0.5) # Avoid hitting rate limits when posting multiple comments
-            logger.info(f"{log_prefix} Finished posting findings.")
-        else:
-            logger.info(f"{log_prefix} No findings to report.")
-            # Optionally post a "no issues found" comment or status check
-
-        logger.info(f"{log_prefix} Successfully completed analysis.")
-        return {"status": "success", "findings_count": len(findings)}
+        if ANALYSIS_MODE == "staged":
+            # This task is the fetch stage; the run (and the installation slot) ends in post_findings
+            from .staged_analysis import fetch_stage
+            result, chunk_count = fetch_stage(pr_data, self.request.id)
+            if chunk_count is not None:
+                launch_staged_pipeline(self.request.id, chunk_count)
+                handed_off = True
+            return result
+
+        if ANALYSIS_MODE == "async":
+            # Same result dicts and exceptions, so the retry handling below applies unchanged
+            from .async_analysis import run_on_event_loop, analyze_pull_request_async
+            return run_on_event_loop(analyze_pull_request_async(pr_data))
+
+        return run_pr_analysis(pr_data)
 
+    except AnalysisSuperseded as e:
+        logger.info(f"{log_prefix} Stopping analysis: {e}.")
+        return {"status": "superseded", "message": str(e)}
     except Exception as e:
         logger.error(f"{log_prefix} Error during analysis: {e}", exc_info=True)
         try:
             # Retry the task if it's a potentially transient error (e.g., network, rate limit)
+            if isinstance(e, RETRY_AFTER_ERRORS):
+                # Come back when capacity frees up, jittered so waiting tasks don't retry in lockstep
+                self.retry(exc=e, countdown=e.retry_after + random.uniform(0, 5))
             self.retry(exc=e)
         except self.MaxRetriesExceededError:
             logger.error(f"{log_prefix} Max retries exceeded. Task failed permanently.")
             # Optionally notify someone or update status in DB
             return {"status": "failed", "message": f"Max retries exceeded: {e}"}
         return {"status": "retrying", "message": str(e)}
+    finally:
+        # Free this installation's slot (retries re-enter Celery directly) and let queued work in
+        finish_slot(None if handed_off else installation_id, self.request.id)
+
+def finish_slot(installation_id, task_id):
+    """Releases a slot (when installation_id is given) and dispatches queued work, never raising.
+
+    Runs in finally blocks: a Redis error here must not replace the task's result or retry,
+    and a failed dispatch must not keep the slot from being released.
+    """
+    if installation_id is not None:
+        try:
+            release_slot(installation_id, task_id)
+        except Exception as e:
+            logger.warning(f"Failed to release slot of task {task_id} (installation {installation_id}): {e}")
+    try:
+        dispatch_pending(analyze_pull_request, is_stale=is_superseded)
+    except Exception as e:
+        # The periodic dispatch_pending_analyses task picks the work up on its next tick
+        logger.warning(f"Failed to dispatch pending analyses after task {task_id}: {e}")
+
+@task_revoked.connect
+def release_revoked_slot(request=None, **kwargs):
+    """Superseded tasks revoked before starting never reach the finally block above."""
+    if request is not None and request.task == analyze_pull_request.name and request.args:
+        try:
+            release_slot(request.args[0].get("installation_id"), request.id)
+        except Exception as e:
+            logger.warning(f"Failed to release slot of revoked task {request.id}: {e}")
+
+@app.task(ignore_result=True)
+def dispatch_pending_analyses():
+    """Periodic (beat) task: dispatches fair-share queued analyses that became ready."""
+    return dispatch_pending(analyze_pull_request, is_stale=is_superseded)
+
+# --- Staged Pipeline ---
+# Queues come from task_routes in celery_app.py, so each stage's worker pool scales on its own
+
+def launch_staged_pipeline(run_id, chunk_count):
+    """Starts chord[analyze_chunk ...] -> aggregate_findings -> post_findings for a fetched run."""
+    tail = chain(aggregate_findings.si(run_id), post_findings.si(run_id))
+    if chunk_count == 0:
+        return tail.apply_async()
+    return chord([analyze_chunk.si(run_id, index) for index in range(chunk_count)], tail).apply_async()
+
+def end_staged_run(run_id):
+    """Frees the run's installation slot and artifacts (after the post stage, or once a stage gave up)."""
+    from .staged_analysis import load_manifest, discard_run
+    try:
+        installation_id = load_manifest(run_id)["pr_data"].get("installation_id")
+    except ArtifactMissing:
+        installation_id = None  # Already ended by another stage
+    except Exception as e:
+        # The slot then frees itself after SLOT_TIMEOUT_SECONDS
+        logger.warning(f"Failed to load the manifest of run {run_id} to release its slot: {e}")
+        installation_id = None
+    try:
+        discard_run(run_id)
+    except Exception as e:
+        logger.warning(f"Failed to discard run {run_id}: {e}")
+    finish_slot(installation_id, run_id)
+
+def run_stage(task, stage, run_id, *args):
+    """Runs one stage function with the same retry policy as analyze_pull_request.
+
+    Stages never raise past their retries: a chord member that raised would leave the
+    aggregate stage waiting, so giving up ends the run and returns a "failed" result;
+    the remaining stages then find its artifacts gone and stop.
+    """
+    from . import staged_analysis
+    stage_function = getattr(staged_analysis, f"{stage}_stage")
+    log_prefix = f"Staged analysis {run_id} ({stage}):"
+    try:
+        return stage_function(run_id, *args)
+    except ArtifactMissing as e:
+        logger.info(f"{log_prefix} Run has already ended ({e} is gone); stopping.")
+        return {"status": "abandoned"}
+    except AnalysisSuperseded as e:
+        logger.info(f"{log_prefix} Stopping analysis: {e}.")
+        end_staged_run(run_id)
+        return {"status": "superseded", "message": str(e)}
+    except Exception as e:
+        logger.error(f"{log_prefix} Error: {e}", exc_info=True)
+        try:
+            if isinstance(e, RETRY_AFTER_ERRORS):
+                task.retry(exc=e, countdown=e.retry_after + random.uniform(0, 5))
+            task.retry(exc=e)
+        except task.MaxRetriesExceededError:
+            logger.error(f"{log_prefix} Max retries exceeded. Ending the run.")
+            end_staged_run(run_id)
+            return {"status": "failed", "message": f"Max retries exceeded: {e}"}
+        return {"status": "retrying", "message": str(e)}
+
+@app.task(bind=True, max_retries=3, default_retry_delay=60)
+def analyze_chunk(self, run_id, index):
+    """Stage 2 (one per chunk): triage + LLM review of one chunk."""
+    return run_stage(self, "analyze_chunk", run_id, index)
+
+@app.task(bind=True, max_retries=3, default_retry_delay=10)
+def aggregate_findings(self, run_id):
+    """Stage 3: merges the chunks' findings once the chord completes."""
+    return run_stage(self, "aggregate", run_id)
+
+@app.task(bind=True, max_retries=5, default_retry_delay=30)
+def post_findings(self, run_id):
+    """Stage 4: posts the findings and saves the PR state, then ends the run."""
+    result = run_stage(self, "post", run_id)
+    if result.get("status") == "success":
+        end_staged_run(run_id)
+    return result
+
+# --- Repository Baseline Scans ---
+# Routed to analysis.baseline (celery_app.py); none of these take an installation slot
+
+# Polling a shard's batch does not count against this; only errors do
+BASELINE_MAX_ERRORS = int(os.getenv("BASELINE_MAX_ERRORS", "5"))
+
+@app.task(bind=True, max_retries=3, default_retry_delay=300)
+def scan_repository_baseline(self, installation_id, repo_full_name):
+    """Prepares (or resumes) the baseline of a repository's default branch and launches its shards."""
+    from .baseline_scan import prepare_stage
+    log_prefix = f"Baseline - {repo_full_name}:"
+    try:
+        run_id, manifest, completed = prepare_stage(installation_id, repo_full_name)
+    except Exception as e:
+        logger.error(f"{log_prefix} Error while preparing: {e}", exc_info=True)
+        try:
+            if isinstance(e, GitHubRateLimited):
+                self.retry(exc=e, countdown=e.retry_after + random.uniform(0, 5))
+            self.retry(exc=e)
+        except self.MaxRetriesExceededError:
+            return {"status": "failed", "message": f"Max retries exceeded: {e}"}
+        return {"status": "retrying", "message": str(e)}
+    if completed:
+        logger.info(f"{log_prefix} Head {manifest['head_sha'][:7]} already has a baseline.")
+        return {"status": "success", "run_id": run_id, "cached": True}
+    shard_count = manifest["shard_count"]
+    if shard_count == 0:
+        finalize_baseline.delay(run_id)
+    else:
+        chord([scan_baseline_shard.si(run_id, index) for index in range(shard_count)], finalize_baseline.si(run_id)).apply_async()
+    logger.info(f"{log_prefix} Launched {shard_count} shard(s) as run {run_id}.")
+    return {"status": "dispatched", "run_id": run_id, "shards": shard_count}
+
+@app.task(bind=True, max_retries=None)
+def scan_baseline_shard(self, run_id, index, errors=0):
+    """Submits one shard's batch, then polls it every BASELINE_BATCH_POLL_SECONDS until its findings are stored.
+
+    Never raises past its retries (a raising chord member would leave finalize waiting).
+    """
+    from .baseline_scan import scan_shard_stage, BASELINE_BATCH_POLL_SECONDS
+    log_prefix = f"Baseline {run_id} (shard {index}):"
+    try:
+        result = scan_shard_stage(run_id, index)
+    except ArtifactMissing as e:
+        logger.info(f"{log_prefix} Run has already ended ({e} is gone); stopping.")
+        return {"status": "abandoned"}
+    except Exception as e:
+        logger.error(f"{log_prefix} Error: {e}", exc_info=True)
+        if errors >= BASELINE_MAX_ERRORS:
+            logger.error(f"{log_prefix} Giving up after {errors} error(s); the scan can be resumed later.")
+            return {"status": "failed", "message": str(e)}
+        self.retry(exc=e, kwargs={"errors": errors + 1}, countdown=60 * 2 ** errors + random.uniform(0, 5))
+    if result["status"] == "pending":
+        # A retry frees the worker while the batch runs; the shard's checkpoint says where to pick up
+        self.retry(kwargs={"errors": errors}, countdown=BASELINE_BATCH_POLL_SECONDS + random.uniform(0, 5))
+    return result
+
+@app.task(bind=True, max_retries=3, default_retry_delay=60)
+def finalize_baseline(self, run_id):
+    """Records the baseline's findings once every shard finished."""
+    from .baseline_scan import finalize_stage
+    try:
+        return finalize_stage(run_id)
+    except ArtifactMissing as e:
+        logger.info(f"Baseline {run_id}: Run has already ended ({e} is gone); stopping.")
+        return {"status": "abandoned"}
+    except Exception as e:
+        logger.error(f"Baseline {run_id}: Error while finalizing: {e}", exc_info=True)
+        try:
+            self.retry(exc=e)
+        except self.MaxRetriesExceededError:
+            return {"status": "failed", "message": f"Max retries exceeded: {e}"}
+        return {"status": "retrying", "message": str(e)}
+
+# --- Instrumentation ---
+
+_task_started_at = {}
+
+@worker_init.connect
+def start_worker_metrics(**kwargs):
+    if WORKER_METRICS_PORT:
+        start_metrics_server(WORKER_METRICS_PORT)
+
+@worker_process_shutdown.connect
+def release_process_metrics(pid=None, **kwargs):
+    mark_process_dead(pid or os.getpid())
+
+@task_prerun.connect
+def start_task_instrumentation(task_id=None, task=None, **kwargs):
+    _task_started_at[task_id] = time.perf_counter()
+    start_task_profile(task_id)
 
+@task_postrun.connect
+def finish_task_instrumentation(task_id=None, task=None, retval=None, state=None, **kwargs):
+    started_at = _task_started_at.pop(task_id, None)
+    task_name = task.name if task is not None else "unknown"
+    # analyze_pull_request reports "failed"/"superseded" in its result rather than raising
+    status = retval.get("status") if isinstance(retval, dict) and retval.get("status") else (state or "unknown").lower()
+    record_task(task_name, status, time.perf_counter() - started_at if started_at is not None else None)
+    finish_task_profile(task_id, task_name)
 
+@task_retry.connect
+def count_task_retry(**kwargs):
+    record_retry("task")
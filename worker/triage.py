@@ -0,0 +1,95 @@
+# worker/triage.py
+
+import os
+import json
+import logging
+import threading
+
+from .diff_chunker import DiffChunk, estimate_tokens
+from .prescan import scan_hunk
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# Two-tier cascade: a cheap model answers yes/no per hunk and only flagged hunks reach LLM_MODEL_NAME
+LLM_TRIAGE_ENABLED = os.getenv("LLM_TRIAGE_ENABLED", "false").lower() in ("1", "true", "yes")
+# "local" uses the static pre-scan score instead of a model (no API calls; for tests and benchmarks)
+LLM_TRIAGE_MODEL_NAME = os.getenv("LLM_TRIAGE_MODEL_NAME", "gpt-4o-mini")
+LLM_TRIAGE_TIMEOUT_SECONDS = float(os.getenv("LLM_TRIAGE_TIMEOUT_SECONDS", "15"))
+# Pre-scan score a hunk needs to be escalated by the local stand-in
+LLM_TRIAGE_LOCAL_THRESHOLD = float(os.getenv("LLM_TRIAGE_LOCAL_THRESHOLD", "2.0"))
+LOCAL_TRIAGE_MODEL = "local"
+
+TRIAGE_SYSTEM_PROMPT = "You triage code changes for a security review. You answer only with JSON."
+
+# --- Prompt & Verdicts ---
+
+def chunk_hunks(chunk):
+    """The (FileDiff, DiffHunk) pairs of a chunk, in prompt order."""
+    return [(file_diff, hunk) for file_diff, hunks in chunk.parts for hunk in hunks]
+
+def create_triage_prompt(hunks):
+    """Asks for the numbers of the hunks that deserve a full review."""
+    sections = [f"Hunk {number} ({hunk.file_path}):\n{hunk.text()}" for number, (_, hunk) in enumerate(hunks, start=1)]
+    return (
+        "For each numbered Python diff hunk below, decide whether it could plausibly introduce a security "
+        "vulnerability (injection, unsafe deserialization, weak cryptography, access-control or authentication "
+        "changes, secrets, path traversal, SSRF, ...). When unsure, flag it.\n"
+        'Respond with a JSON object {"flagged": [numbers of the hunks that need a full security review]}.\n\n'
+        + "\n\n".join(sections)
+    )
+
+def triage_max_output_tokens(hunk_count):
+    return min(16 + 4 * hunk_count, 512)
+
+def parse_triage_response(content, hunk_count):
+    """Returns one verdict per hunk (True = escalate), or None if the response is unusable."""
+    try:
+        flagged = json.loads(content).get("flagged")
+        numbers = {int(number) for number in flagged}
+    except (ValueError, TypeError, AttributeError):
+        return None
+    return [number in numbers for number in range(1, hunk_count + 1)]
+
+def local_triage(hunks, threshold=LLM_TRIAGE_LOCAL_THRESHOLD):
+    """Stand-in for the triage model: escalates hunks whose pre-scan score reaches threshold."""
+    return [scan_hunk(hunk).score >= threshold for _, hunk in hunks]
+
+def reduce_chunk(chunk, hunks, verdicts):
+    """Returns a chunk with only the escalated hunks (same index), or None if none was escalated."""
+    reduced = DiffChunk(index=chunk.index)
+    for (file_diff, hunk), escalate in zip(hunks, verdicts):
+        if not escalate:
+            continue
+        if not reduced.parts or reduced.parts[-1][0] is not file_diff:
+            reduced.parts.append((file_diff, []))
+            reduced.token_estimate += estimate_tokens(file_diff.header_text())
+        reduced.parts[-1][1].append(hunk)
+        reduced.token_estimate += estimate_tokens(hunk.text())
+    return reduced if reduced.parts else None
+
+# --- Stats ---
+
+class CascadeStats:
+    """Per-analysis escalation counts, updated from the LLM chunk threads."""
+
+    def __init__(self):
+        self.hunks = 0
+        self.escalated = 0
+        self.failed_open = 0  # Hunks escalated because triage timed out or answered garbage
+        self.lock = threading.Lock()
+
+    def add(self, verdicts, failed_open=False):
+        with self.lock:
+            self.hunks += len(verdicts)
+            self.escalated += sum(verdicts)
+            if failed_open:
+                self.failed_open += len(verdicts)
+
+    def as_dict(self):
+        with self.lock:
+            rate = self.escalated / self.hunks if self.hunks else 0.0
+            return {
+                "hunks": self.hunks, "escalated": self.escalated, "failed_open": self.failed_open,
+                "escalation_rate": round(rate, 3),
+            }